@@ -0,0 +1,86 @@
+"""Benchmark the iterative `flatten` / `flatten_ordered` against the previous
+recursive implementation on wide and deep nested inputs.
+
+Usage:
+    python benchmarks/bench_flatten_json.py
+"""
+from __future__ import print_function
+import sys
+import timeit
+from collections import OrderedDict
+
+import six
+
+from kipoi_utils.external.flatten_json import flatten, flatten_ordered, Mapping
+
+
+def flatten_recursive(dd, separator='_', prefix='', is_list_fn=lambda x: isinstance(x, list)):
+    """Previous (recursive) implementation of `flatten`
+    """
+    if isinstance(dd, Mapping):
+        return {prefix + separator + k if prefix else k: v
+                for kk, vv in six.iteritems(dd)
+                for k, v in six.iteritems(flatten_recursive(vv, separator, kk, is_list_fn))
+                }
+    elif is_list_fn(dd):
+        return {prefix + separator + k if prefix else k: v
+                for kk, vv in enumerate(dd)
+                for k, v in six.iteritems(flatten_recursive(vv, separator, str(kk), is_list_fn))
+                }
+    else:
+        return {prefix: dd}
+
+
+def flatten_ordered_recursive(dd, separator='_', prefix='', is_list_fn=lambda x: isinstance(x, list)):
+    """Previous (recursive) implementation of `flatten_ordered`
+    """
+    if isinstance(dd, Mapping):
+        if not dd:
+            return dd
+        return OrderedDict([(prefix + separator + k if prefix else k, v)
+                            for kk, vv in six.iteritems(dd)
+                            for k, v in six.iteritems(flatten_ordered_recursive(vv, separator, kk,
+                                                                                is_list_fn))
+                            ])
+    elif is_list_fn(dd):
+        if not dd:
+            return dd
+        return OrderedDict([(prefix + separator + k if prefix else k, v)
+                            for kk, vv in enumerate(dd)
+                            for k, v in six.iteritems(flatten_ordered_recursive(vv, separator, str(kk),
+                                                                                is_list_fn))
+                            ])
+    else:
+        return OrderedDict([(prefix, dd)])
+
+
+def wide_input(n_keys=2000, n_list=10):
+    """Shallow structure with many keys
+    """
+    return {"key{}".format(i): {"a": i, "b": list(range(n_list)), "c": {"d": "x"}}
+            for i in range(n_keys)}
+
+
+def deep_input(depth=400, width=3):
+    """Narrow structure with a long chain of nested dictionaries
+    """
+    dd = {"leaf": 0}
+    for i in range(depth):
+        dd = {"level{}".format(i): dd, "sibling": list(range(width))}
+    return dd
+
+
+def bench(name, new_fn, old_fn, dd, number):
+    assert new_fn(dd) == old_fn(dd)
+    t_new = min(timeit.repeat(lambda: new_fn(dd), number=number, repeat=3)) / number
+    t_old = min(timeit.repeat(lambda: old_fn(dd), number=number, repeat=3)) / number
+    print("{:<30} recursive: {:9.3f} ms  iterative: {:9.3f} ms  speedup: {:5.1f}x"
+          .format(name, t_old * 1e3, t_new * 1e3, t_old / t_new))
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    for label, dd, number in [("wide", wide_input(), 10),
+                              ("deep", deep_input(), 10)]:
+        bench("flatten/" + label, flatten, flatten_recursive, dd, number)
+        bench("flatten_ordered/" + label, flatten_ordered, flatten_ordered_recursive, dd, number)
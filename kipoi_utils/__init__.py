@@ -11,4 +11,5 @@ from . import external
 
 
 from . utils import _get_arg_name_values
-from . utils import *
\ No newline at end of file
+from . utils import *
+
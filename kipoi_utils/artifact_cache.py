@@ -0,0 +1,322 @@
+"""Content-addressed cache of downloaded files shared across models
+
+Files are stored once under their sha256 digest and linked (hardlink,
+symlink or copy) to the requested paths:
+
+>>> cache = ArtifactCache("~/.kipoi/artifacts", max_bytes=50 * 1024 ** 3)
+>>> cache.fetch("https://zenodo.org/record/1466073/files/weights.h5", "model1/weights.h5",
+...             md5="2a6e3e2c8fa1d7af41b6f5e0c3b2f7ee")
+
+The files are looked up by their sha256 and md5 digests. The url is only
+used if no digest is given.
+Concurrent processes are synchronized with file locks and the least
+recently used files are evicted once the cache exceeds `max_bytes`.
+"""
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+from contextlib import contextmanager
+
+import six
+
+from kipoi_utils.external.torchvision.dataset_utils import (_download_with_fallback, _hash_file,
+                                                            makedir_exist_ok)
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path, poll_interval=0.1):
+    """Exclusive lock across processes (and threads) using the lock file `path`
+    """
+    if fcntl is not None:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+    else:
+        lock_path = path + ".excl"
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                time.sleep(poll_interval)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+
+def _replace(src, dst):
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        os.rename(src, dst)
+
+
+class ArtifactCache(object):
+    """Content-addressed file cache with LRU eviction
+
+    Layout of the cache directory:
+    - objects/<sha256[:2]>/<sha256>: cached files (read-only)
+    - index.json: sizes and last access times of the objects and
+      the aliases (md5 digests and urls) pointing to them
+    - locks/: lock files
+
+    Args:
+      root: cache directory
+      max_bytes: byte budget. The least recently used files are evicted
+        when the cache is larger. None for no limit
+      link: how to materialize the cached files: 'hardlink', 'symlink' or 'copy'.
+        Hardlinks fall back to copies across file systems. Note: evicting a
+        file breaks its symlinks but not its hardlinks or copies
+    """
+
+    def __init__(self, root, max_bytes=None, link="hardlink"):
+        if link not in ("hardlink", "symlink", "copy"):
+            raise ValueError("link has to be one of 'hardlink', 'symlink' or 'copy'")
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_bytes = max_bytes
+        self.link = link
+        makedir_exist_ok(os.path.join(self.root, "objects"))
+        makedir_exist_ok(os.path.join(self.root, "locks"))
+        makedir_exist_ok(os.path.join(self.root, "tmp"))
+        self._index_path = os.path.join(self.root, "index.json")
+
+    def __repr__(self):
+        return "ArtifactCache({0!r}, max_bytes={1!r}, link={2!r})".format(self.root, self.max_bytes,
+                                                                          self.link)
+
+    # index
+    @contextmanager
+    def _index(self):
+        """Lock, read and (after the block) write the index
+        """
+        with file_lock(os.path.join(self.root, "locks", "index.lock")):
+            try:
+                with open(self._index_path, "r") as f:
+                    index = json.load(f)
+            except (IOError, OSError, ValueError):
+                index = {"objects": {}, "aliases": {}}
+            yield index
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            _replace(tmp_path, self._index_path)
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, "objects", sha256[:2], sha256)
+
+    @staticmethod
+    def _aliases(url=None, md5=None, sha256=None):
+        aliases = []
+        if sha256:
+            aliases.append("sha256:" + sha256.lower())
+        if md5:
+            aliases.append("md5:" + md5.lower())
+        if url:
+            aliases.append("url:" + url)
+        return aliases
+
+    def _lookup(self, index, aliases):
+        """Get the sha256 of the cached object matching the aliases
+
+        If digest aliases (sha256, md5) are given, the object has to match all of them
+        and the url is not used: the file behind the url might have changed.
+        Otherwise the object of the url is returned.
+        """
+        digest_aliases = [a for a in aliases if not a.startswith("url:")]
+        if digest_aliases:
+            keys = set([index["aliases"].get(alias,
+                                             alias[7:] if alias.startswith("sha256:") else None)
+                        for alias in digest_aliases])
+            if len(keys) != 1:
+                return None
+            sha256 = keys.pop()
+        elif aliases:
+            sha256 = index["aliases"].get(aliases[0])
+        else:
+            return None
+        if sha256 in index["objects"] and os.path.isfile(self.object_path(sha256)):
+            return sha256
+        return None
+
+    def get(self, url=None, md5=None, sha256=None):
+        """Path of the cached file matching the given sha256 and md5 digests. If no digest is
+        given, the file last downloaded from the url. None if the file is not cached
+        """
+        with self._index() as index:
+            key = self._lookup(index, self._aliases(url, md5, sha256))
+            if key is None:
+                return None
+            index["objects"][key]["last_access"] = time.time()
+            return self.object_path(key)
+
+    def add(self, fpath, url=None, md5=None, move=False):
+        """Add a file to the cache
+
+        Args:
+          fpath: file path
+          url: url the file was downloaded from
+          md5: expected md5 digest of the file (checked)
+          move: if True, move the file into the cache instead of copying it
+
+        Returns:
+          path of the cached file
+        """
+        if not move:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+            os.close(fd)
+            shutil.copyfile(fpath, tmp_path)
+            fpath = tmp_path
+        digests = _hash_file(fpath, ["sha256", "md5"])
+        if md5 and md5.lower() != digests["md5"]:
+            if not move:
+                os.remove(fpath)
+            raise ValueError("md5 digest of {0} is {1}, not {2}".format(fpath, digests["md5"], md5))
+        return self._add_object(fpath, digests["sha256"], self._aliases(url, digests["md5"]))
+
+    def _add_object(self, fpath, sha256, aliases):
+        """Move the file `fpath` into the cache
+        """
+        obj_path = self.object_path(sha256)
+        size = os.path.getsize(fpath)
+        with self._index() as index:
+            if os.path.isfile(obj_path):
+                os.remove(fpath)
+            else:
+                makedir_exist_ok(os.path.dirname(obj_path))
+                # hardlinks share the permissions -> protect the cached file from modifications
+                os.chmod(fpath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                _replace(fpath, obj_path)
+            index["objects"][sha256] = {"size": size, "last_access": time.time()}
+            for alias in aliases:
+                index["aliases"][alias] = sha256
+            self._evict(index, keep=sha256)
+        return obj_path
+
+    def fetch(self, url, dest, md5=None, sha256=None, **kwargs):
+        """Make the file available at `dest`, downloading it into the cache if needed
+
+        Args:
+          url: url of the file
+          dest: output path
+          md5, sha256: expected digests (also used as cache keys)
+          **kwargs: additional arguments to
+            `kipoi_utils.external.torchvision.dataset_utils.download_url`
+
+        Returns:
+          dest
+        """
+        aliases = self._aliases(url, md5, sha256)
+        # prevent downloading the same file concurrently
+        lock_name = hashlib.sha1(aliases[0].encode("utf-8")).hexdigest() + ".lock"
+        with file_lock(os.path.join(self.root, "locks", lock_name)):
+            if self._materialize_cached(aliases, dest):
+                return dest
+            tmp_dir = tempfile.mkdtemp(dir=os.path.join(self.root, "tmp"))
+            try:
+                tmp_path = os.path.join(tmp_dir, "download")
+                expected = dict([(a, d) for a, d in [("md5", md5), ("sha256", sha256)] if d])
+                digests = _download_with_fallback(url, tmp_path, expected,
+                                                  algorithms=("sha256", "md5"), **kwargs)
+                self._add_object(tmp_path, digests["sha256"],
+                                 aliases + self._aliases(md5=digests["md5"]))
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not self._materialize_cached(aliases, dest):
+                raise IOError("File evicted from the cache before it could be used. "
+                              "Increase max_bytes of {0}".format(self))
+        return dest
+
+    def _materialize_cached(self, aliases, dest):
+        """Link the cached object to dest. Returns False if the object is not cached
+        """
+        with self._index() as index:
+            key = self._lookup(index, aliases)
+            if key is None:
+                return False
+            index["objects"][key]["last_access"] = time.time()
+            self.materialize(self.object_path(key), dest)
+            return True
+
+    def materialize(self, obj_path, dest):
+        """Atomically link or copy the cached file to dest
+        """
+        dest = os.path.abspath(dest)
+        dest_dir = os.path.dirname(dest)
+        makedir_exist_ok(dest_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=".tmp")
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            if self.link == "symlink":
+                os.symlink(obj_path, tmp_path)
+            elif self.link == "hardlink" and hasattr(os, "link"):
+                try:
+                    os.link(obj_path, tmp_path)
+                except OSError:
+                    # different file system
+                    shutil.copyfile(obj_path, tmp_path)
+            else:
+                shutil.copyfile(obj_path, tmp_path)
+            _replace(tmp_path, dest)
+        except Exception:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    # eviction
+    def _evict(self, index, max_bytes=None, keep=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return
+        objects = index["objects"]
+        total = sum([o["size"] for o in six.itervalues(objects)])
+        for key in sorted(objects, key=lambda k: objects[k]["last_access"]):
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            obj_path = self.object_path(key)
+            if os.path.isfile(obj_path):
+                os.chmod(obj_path, stat.S_IWUSR | stat.S_IRUSR)
+                os.remove(obj_path)
+            total -= objects.pop(key)["size"]
+        # remove the dangling aliases
+        index["aliases"] = dict([(a, k) for a, k in six.iteritems(index["aliases"])
+                                 if k in objects])
+
+    def evict(self, max_bytes=None):
+        """Evict the least recently used files until the cache is smaller than
+        `max_bytes` (default: the `max_bytes` of the cache)
+        """
+        with self._index() as index:
+            self._evict(index, max_bytes)
+
+    def total_bytes(self):
+        """Size of the cached files in bytes
+        """
+        with self._index() as index:
+            return sum([o["size"] for o in six.itervalues(index["objects"])])
+
+    def __len__(self):
+        with self._index() as index:
+            return len(index["objects"])
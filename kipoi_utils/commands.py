@@ -0,0 +1,192 @@
+"""Run many shell commands concurrently (asyncio-based)
+
+Asynchronous counterpart of `kipoi_utils.utils._call_command` for
+running many commands (say setting up or checking conda environments)
+at once:
+
+>>> results = run_commands([["conda", "env", "list"], ["pip", "--version"]],
+...                        max_concurrent=2, timeout=60)
+>>> [r.returncode for r in results]
+[0, 0]
+
+The output of each command is streamed without blocking and only the
+last `tail_lines` lines of stdout and stderr are kept.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import collections
+import logging
+import time
+import warnings
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# chunk size used to read the command output
+_CHUNK_SIZE = 1 << 16
+
+
+class CommandResult(object):
+    """Result of a command run with `run_command`
+
+    Attributes:
+      cmd: command (list of arguments)
+      returncode: exit code. None if the command couldn't be started or timed out
+      wall_time: wall time in seconds
+      stdout_tail: list of the last lines of stdout
+      stderr_tail: list of the last lines of stderr
+      timed_out: True if the command was killed after the timeout
+      error: error message if the command couldn't be started
+    """
+
+    def __init__(self, cmd, returncode=None, wall_time=0.0, stdout_tail=None,
+                 stderr_tail=None, timed_out=False, error=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.wall_time = wall_time
+        self.stdout_tail = stdout_tail or []
+        self.stderr_tail = stderr_tail or []
+        self.timed_out = timed_out
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return ("CommandResult(cmd={0!r}, returncode={1!r}, wall_time={2:.2f}, timed_out={3!r})"
+                .format(self.cmd, self.returncode, self.wall_time, self.timed_out))
+
+
+async def _pump(stream, buf, on_line=None, stream_name=None):
+    """Read the stream until EOF and append the decoded lines to `buf`
+
+    Reads in chunks, so arbitrarily long lines don't fail.
+    Partial lines longer than the chunk size are split.
+    """
+    partial = b""
+    while True:
+        chunk = await stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+        if len(partial) > _CHUNK_SIZE:
+            lines.append(partial)
+            partial = b""
+        for line in lines:
+            line = line.rstrip(b"\r").decode("utf-8", errors="replace")
+            buf.append(line)
+            if on_line is not None:
+                on_line(stream_name, line)
+    if partial:
+        line = partial.decode("utf-8", errors="replace")
+        buf.append(line)
+        if on_line is not None:
+            on_line(stream_name, line)
+
+
+async def run_command(cmd, timeout=None, tail_lines=100, on_line=None, **kwargs):
+    """Run a single command asynchronously
+
+    Args:
+      cmd: list of command arguments
+      timeout: timeout in seconds. The command is killed after the timeout
+      tail_lines: number of last stdout/stderr lines to keep
+      on_line: optional callback `on_line(stream_name, line)` called for
+        each line of the output ('stdout' or 'stderr')
+      **kwargs: additional arguments to `asyncio.create_subprocess_exec`
+        (say cwd or env)
+
+    Returns:
+      CommandResult
+    """
+    cmd = list(cmd)
+    stdout_buf = collections.deque(maxlen=tail_lines)
+    stderr_buf = collections.deque(maxlen=tail_lines)
+    start = time.time()
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE,
+                                                    **kwargs)
+    except OSError as e:
+        return CommandResult(cmd, wall_time=time.time() - start,
+                             error="could not invoke {0}\n".format(cmd) + str(e))
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.gather(_pump(proc.stdout, stdout_buf, on_line, "stdout"),
+                                              _pump(proc.stderr, stderr_buf, on_line, "stderr"),
+                                              proc.wait()),
+                               timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        logger.warning("Command {0} timed out after {1}s. Killing it".format(cmd, timeout))
+    finally:
+        # timeout or cancellation
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+    return CommandResult(cmd,
+                         returncode=None if timed_out else proc.returncode,
+                         wall_time=time.time() - start,
+                         stdout_tail=list(stdout_buf),
+                         stderr_tail=list(stderr_buf),
+                         timed_out=timed_out)
+
+
+async def run_commands_async(cmds, max_concurrent=4, timeout=None, tail_lines=100,
+                             on_line=None, **kwargs):
+    """Run many commands with at most `max_concurrent` running at the same time
+
+    Args:
+      cmds: list of commands (each a list of arguments)
+      max_concurrent: maximal number of concurrently running commands
+      on_line: optional callback `on_line(cmd_index, stream_name, line)`
+      other arguments: see `run_command`
+
+    Returns:
+      list of CommandResult in the order of `cmds`
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def run(i, cmd):
+        async with semaphore:
+            line_cb = None
+            if on_line is not None:
+                def line_cb(stream_name, line):
+                    on_line(i, stream_name, line)
+            return await run_command(cmd, timeout=timeout, tail_lines=tail_lines,
+                                     on_line=line_cb, **kwargs)
+
+    return list(await asyncio.gather(*[run(i, cmd) for i, cmd in enumerate(cmds)]))
+
+
+def run_commands(cmds, max_concurrent=4, timeout=None, tail_lines=100, on_line=None, **kwargs):
+    """Synchronous wrapper of `run_commands_async` (runs its own event loop)
+
+    The loop is the current event loop of the thread while running (the
+    subprocess child watcher requires it on python < 3.8). The previous
+    event loop is restored afterwards.
+    """
+    with warnings.catch_warnings():
+        # no current event loop (python >= 3.10)
+        warnings.simplefilter("ignore", DeprecationWarning)
+        try:
+            previous = asyncio.get_event_loop()
+        except RuntimeError:
+            previous = None
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(run_commands_async(cmds, max_concurrent=max_concurrent,
+                                                          timeout=timeout, tail_lines=tail_lines,
+                                                          on_line=on_line, **kwargs))
+    finally:
+        asyncio.set_event_loop(previous)
+        loop.close()
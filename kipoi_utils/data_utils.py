@@ -4,9 +4,13 @@ import numpy as np
 import sys
 import collections
 from kipoi_utils.utils import map_nested
-import pandas as pd
+from kipoi_utils.tree import tree_flatten, tree_map, Mapping, Sequence
 import six
+import logging
 from kipoi_utils.external.flatten_json import flatten
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 # string_classes
 if sys.version_info[0] == 2:
     string_classes = basestring
@@ -15,8 +19,7 @@ else:
 
 
 def _numpy_collate(stack_fn=np.stack):
-    def numpy_collate_fn(batch):
-        "Puts each data field into a tensor with outer dimension batch size"
+    def collate_leaves(batch):
         if type(batch[0]).__module__ == 'numpy':
             elem = batch[0]
             if type(elem).__name__ == 'ndarray':
@@ -33,14 +36,17 @@ def _numpy_collate(stack_fn=np.stack):
             # Also convert to a numpy array
             return np.asarray(batch)
             # return batch
-        elif isinstance(batch[0], collections.Mapping):
-            return {key: numpy_collate_fn([d[key] for d in batch]) for key in batch[0]}
-        elif isinstance(batch[0], collections.Sequence):
-            transposed = zip(*batch)
-            return [numpy_collate_fn(samples) for samples in transposed]
 
         raise TypeError(("batch must contain tensors, numbers, dicts or lists; found {}"
                          .format(type(batch[0]))))
+
+    def numpy_collate_fn(batch):
+        "Puts each data field into a tensor with outer dimension batch size"
+        # structure of the first sample is used for all the samples
+        leaves, treedef = tree_flatten(batch[0])
+        columns = [leaves] + [treedef.flatten_up_to(sample, strict=False)
+                              for sample in batch[1:]]
+        return treedef.unflatten([collate_leaves(samples) for samples in zip(*columns)])
     return numpy_collate_fn
 
 
@@ -100,23 +106,20 @@ def get_dataset_lens(data, require_numpy=False):
         # Also convert to a numpy array
         return [1]
         # return data
-    elif isinstance(data, collections.Mapping) and not type(data).__module__ == 'numpy':
+    elif isinstance(data, Mapping) and not type(data).__module__ == 'numpy':
         return sum([get_dataset_lens(data[key], require_numpy) for key in data], [])
-    elif isinstance(data, collections.Sequence) and not type(data).__module__ == 'numpy':
+    elif isinstance(data, Sequence) and not type(data).__module__ == 'numpy':
         return sum([get_dataset_lens(sample, require_numpy) for sample in data], [])
     else:
         raise ValueError("Leafs of the nested structure need to be numpy arrays")
 
 
 def get_dataset_item(data, idx):
-    if type(data).__module__ == 'numpy':
-        return data[idx]
-    elif isinstance(data, collections.Mapping):
-        return {key: get_dataset_item(data[key], idx) for key in data}
-    elif isinstance(data, collections.Sequence):
-        return [get_dataset_item(sample, idx) for sample in data]
-    else:
+    def get_item(x):
+        if type(x).__module__ == 'numpy':
+            return x[idx]
         raise ValueError("Leafs of the nested structure need to be numpy arrays")
+    return tree_map(get_item, data)
 
 
 def iterable_cycle(iterable):
@@ -152,10 +155,255 @@ def flatten_batch(batch, nested_sep="/"):
             else:
                 return collections.OrderedDict([(str(i), array2array_dict(arr[:, i]))
                                                 for i in range(arr.shape[1])])
-        elif isinstance(arr, pd.DataFrame):
+        import pandas as pd
+        if isinstance(arr, pd.DataFrame):
             return {k: v.values for k, v in six.iteritems(arr.to_dict("records"))}
         else:
             raise ValueError("Unknown data type")
 
     return flatten(map_nested(batch, array2array_dict),
                    separator=nested_sep)
+
+
+def _sample_nbytes(sample):
+    """Approximate size of a sample in bytes"""
+    from kipoi_utils.tree import tree_iter_leaves
+    return sum([x.nbytes if isinstance(x, np.ndarray) else sys.getsizeof(x)
+                for x in tree_iter_leaves(sample)])
+
+
+class _DiskCache(object):
+    """Memory-mapped cache of samples having the same structure and leaf shapes
+
+    Each leaf is stored in `cache_dir/leaf_<i>.npy` of shape (n,) + leaf shape.
+    `cache_dir/filled.npy` marks the stored samples.
+    """
+
+    def __init__(self, cache_dir, n, sample=None):
+        """Open the disk cache. If it doesn't exist yet, it is created using the
+        layout of `sample` (IOError if sample is None)
+        """
+        import os
+        import pickle
+        from kipoi_utils.artifact_cache import file_lock
+        from kipoi_utils.utils import makedir_exist_ok
+        self.cache_dir = cache_dir
+        meta_path = os.path.join(cache_dir, "meta.pkl")
+        if sample is None and not os.path.exists(meta_path):
+            raise IOError("Disk cache {0} doesn't exist".format(cache_dir))
+        makedir_exist_ok(cache_dir)
+        with file_lock(os.path.join(cache_dir, "lock")):
+            if os.path.exists(meta_path):
+                with open(meta_path, "rb") as f:
+                    meta = pickle.load(f)
+            else:
+                leaves, treedef = tree_flatten(sample)
+                arrays = [np.asarray(x) for x in leaves]
+                meta = {"n": n,
+                        "treedef": treedef,
+                        "is_array": [isinstance(x, np.ndarray) for x in leaves],
+                        "dtypes": [a.dtype for a in arrays],
+                        "shapes": [a.shape for a in arrays]}
+                if any([a.dtype.kind == "O" for a in arrays]):
+                    raise ValueError("Samples containing python objects can't be cached on disk")
+                for i, a in enumerate(arrays):
+                    np.lib.format.open_memmap(self._leaf_path(i), mode="w+", dtype=a.dtype,
+                                              shape=(n,) + a.shape)
+                np.lib.format.open_memmap(self._leaf_path("filled"), mode="w+", dtype=np.uint8,
+                                          shape=(n,))
+                with open(meta_path, "wb") as f:
+                    pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if meta["n"] != n:
+            raise ValueError("Disk cache {0} was created for a dataset of length {1} != {2}"
+                             .format(cache_dir, meta["n"], n))
+        self.meta = meta
+        self.leaves = [np.load(self._leaf_path(i), mmap_mode="r+")
+                       for i in range(len(meta["dtypes"]))]
+        self.filled = np.load(self._leaf_path("filled"), mmap_mode="r+")
+
+    def _leaf_path(self, i):
+        import os
+        return os.path.join(self.cache_dir, "leaf_{0}.npy".format(i))
+
+    def get(self, idx):
+        if not self.filled[idx]:
+            return None
+        leaves = [np.array(mm[idx]) if is_array else mm[idx].item()
+                  for mm, is_array in zip(self.leaves, self.meta["is_array"])]
+        return self.meta["treedef"].unflatten(leaves)
+
+    def put(self, idx, sample):
+        """Store the sample. Returns False if the sample doesn't fit the cache layout
+        """
+        try:
+            leaves = self.meta["treedef"].flatten_up_to(sample)
+        except ValueError:
+            return False
+        arrays = [np.asarray(x) for x in leaves]
+        for a, dtype, shape in zip(arrays, self.meta["dtypes"], self.meta["shapes"]):
+            if a.shape != shape or not np.can_cast(a.dtype, dtype, casting="safe"):
+                return False
+        for mm, a in zip(self.leaves, arrays):
+            mm[idx] = a
+        # mark as filled after the data was written
+        self.filled[idx] = 1
+        return True
+
+
+class CachedDataset(object):
+    """Dataset wrapper caching the samples (`dataset[i]`)
+
+    The samples are kept in an in-memory LRU cache bounded by `max_bytes`.
+    The in-memory cache belongs to a single process: the DataLoader worker
+    processes are started again for every epoch and lose their cache, so it
+    only helps with `num_workers=0`. With workers, use the disk cache.
+
+    The disk cache stores the samples in memory-mapped .npy files in
+    `cache_dir/<fingerprint digest>`, shared by the DataLoader worker processes
+    (and by subsequent runs). It requires all the samples to have the same
+    structure and array shapes (as learned from the first sample); other
+    samples are only cached in memory.
+
+    Note: the cached samples are shared. Don't modify them in place.
+
+    Args:
+      dataset: dataset implementing `__len__` and `__getitem__`
+      max_bytes: maximal size of the in-memory cache in bytes of the main
+        process. 0 to disable
+      cache_dir: directory of the on-disk cache. None to disable
+      worker_max_bytes: maximal size of the in-memory cache of each
+        DataLoader worker process (up to `num_workers * worker_max_bytes`
+        in total). Disabled by default
+      fingerprint: string identifying the dataset (say its arguments and the
+        versions of its input files). Datasets with different fingerprints
+        don't share the disk cache. Default: the class and the length of the
+        dataset
+    """
+
+    def __init__(self, dataset, max_bytes=1 << 30, cache_dir=None, worker_max_bytes=0,
+                 fingerprint=None):
+        self.dataset = dataset
+        self.max_bytes = max_bytes
+        self.worker_max_bytes = worker_max_bytes
+        if fingerprint is None:
+            fingerprint = "{0}.{1} {2}".format(type(dataset).__module__, type(dataset).__name__,
+                                               len(dataset))
+        self.fingerprint = fingerprint
+        self.cache_dir = cache_dir
+        self._init_cache()
+
+    def _init_cache(self):
+        self._lru = collections.OrderedDict()
+        self._nbytes = 0
+        self._disk = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # the caches are not sent to the worker processes
+        state = self.__dict__.copy()
+        for k in ["_lru", "_nbytes", "_disk", "hits", "disk_hits", "misses"]:
+            state.pop(k)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def __getattr__(self, name):
+        # expose the attributes of the wrapped dataset (say build)
+        if name == "dataset":
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _get_cached(self, idx):
+        """Get the sample from the memory or the disk cache. None if not cached
+        """
+        if idx in self._lru:
+            self.hits += 1
+            entry = self._lru.pop(idx)
+            self._lru[idx] = entry
+            return entry[0]
+        if self.cache_dir is not None and self._disk is None:
+            # the cache might have been created by another process
+            self._open_disk_cache()
+        if self._disk is not None:
+            sample = self._disk.get(idx)
+            if sample is not None:
+                self.disk_hits += 1
+                self._add(idx, sample)
+                return sample
+        return None
+
+    def _store(self, idx, sample):
+        self.misses += 1
+        if self.cache_dir is not None:
+            if self._disk is None:
+                self._open_disk_cache(sample)
+            if self._disk is not None:
+                self._disk.put(idx, sample)
+        self._add(idx, sample)
+
+    def __getitem__(self, idx):
+        sample = self._get_cached(idx)
+        if sample is None:
+            sample = self.dataset[idx]
+            self._store(idx, sample)
+        return sample
+
+    def get_batch(self, indices):
+        """Get the samples of a batch of indices. The samples which are not
+        cached are fetched together from the dataset (see `fetch_batch`)
+        """
+        from kipoi_utils.external.torch.dataset import fetch_batch
+        out = [self._get_cached(idx) for idx in indices]
+        missing = [i for i, sample in enumerate(out) if sample is None]
+        if missing:
+            samples = fetch_batch(self.dataset, [indices[i] for i in missing])
+            for i, sample in zip(missing, samples):
+                self._store(indices[i], sample)
+                out[i] = sample
+        return out
+
+    def _disk_dir(self):
+        import hashlib
+        import os
+        digest = hashlib.sha1(self.fingerprint.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, digest)
+
+    def _open_disk_cache(self, sample=None):
+        try:
+            self._disk = _DiskCache(self._disk_dir(), len(self.dataset), sample)
+        except IOError:
+            # not yet created
+            pass
+        except ValueError as e:
+            logger.warning("Disabling the disk cache: {0}".format(e))
+            self.cache_dir = None
+
+    def _budget(self):
+        """Size of the in-memory cache of the current process"""
+        from kipoi_utils.external.torch.data import get_worker_id
+        return self.max_bytes if get_worker_id() is None else self.worker_max_bytes
+
+    def _add(self, idx, sample):
+        max_bytes = self._budget()
+        if max_bytes <= 0:
+            return
+        nbytes = _sample_nbytes(sample)
+        if nbytes > max_bytes:
+            return
+        self._lru[idx] = (sample, nbytes)
+        self._nbytes += nbytes
+        while self._nbytes > max_bytes:
+            _, (_, evicted_nbytes) = self._lru.popitem(last=False)
+            self._nbytes -= evicted_nbytes
+
+    def clear(self):
+        """Clear the in-memory cache"""
+        self._lru.clear()
+        self._nbytes = 0
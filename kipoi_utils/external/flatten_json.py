@@ -23,10 +23,14 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import re
 import sys
 import json
-import collections
-from collections import Iterable, OrderedDict
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
 
 import six
 
@@ -57,6 +61,52 @@ def _construct_key(previous_key, separator, new_key):
         return new_key
 
 
+def _flatten_into(out, dd, separator, prefix, is_list_fn):
+    """Write all the leaves of `dd` into the `out` dictionary
+
+    Iterative (explicit stack) depth-first traversal. The key of each leaf is
+    built once by appending to the prefix string of its parent, hence deep
+    structures neither hit the recursion limit nor re-key intermediate dicts.
+    Key semantics are the same as of the original recursive implementation:
+    empty (falsy) keys of inner nodes are skipped.
+
+    Returns:
+      False if `dd` itself is an empty dictionary or list, True otherwise
+    """
+    if isinstance(dd, Mapping):
+        items = six.iteritems(dd)
+    elif is_list_fn(dd):
+        items = ((str(i), v) for i, v in enumerate(dd))
+    else:
+        out[prefix] = dd
+        return True
+    if len(dd) == 0:
+        return False
+
+    stack = [(items, prefix + separator if prefix else '')]
+    while stack:
+        items, pre = stack[-1]
+        for k, v in items:
+            if isinstance(v, Mapping):
+                child_items = six.iteritems(v)
+            elif is_list_fn(v):
+                child_items = ((str(i), x) for i, x in enumerate(v))
+            else:
+                # leaf
+                out[pre + k if pre else k] = v
+                continue
+            # descend into the child node, continue with `items` afterwards
+            if k:
+                stack.append((child_items, pre + k + separator))
+            else:
+                stack.append((child_items, pre))
+            break
+        else:
+            # all the items of the current node were consumed
+            stack.pop()
+    return True
+
+
 # Overrides flatten
 def flatten(dd, separator='_', prefix='', is_list_fn=lambda x: isinstance(x, list)):
     """Flatten a nested dictionary/list
@@ -67,18 +117,9 @@ def flatten(dd, separator='_', prefix='', is_list_fn=lambda x: isinstance(x, lis
       is_list_fn: function to determine whether to split the list/numpy.array into indvidual classes or
         to include the element as value.
     """
-    if isinstance(dd, collections.Mapping):
-        return {prefix + separator + k if prefix else k: v
-                for kk, vv in six.iteritems(dd)
-                for k, v in six.iteritems(flatten(vv, separator, kk, is_list_fn))
-                }
-    elif is_list_fn(dd):
-        return {prefix + separator + k if prefix else k: v
-                for kk, vv in enumerate(dd)
-                for k, v in six.iteritems(flatten(vv, separator, str(kk), is_list_fn))
-                }
-    else:
-        return {prefix: dd}
+    out = dict()
+    _flatten_into(out, dd, separator, prefix, is_list_fn)
+    return out
 
 
 def flatten_ordered(dd, separator='_', prefix='', is_list_fn=lambda x: isinstance(x, list)):
@@ -90,22 +131,11 @@ def flatten_ordered(dd, separator='_', prefix='', is_list_fn=lambda x: isinstanc
       is_list_fn: function to determine whether to split the list/numpy.array into indvidual classes or
         to include the element as value.
     """
-    if isinstance(dd, collections.Mapping):
-        if not dd:
-            return dd
-        return OrderedDict([(prefix + separator + k if prefix else k, v)
-                            for kk, vv in six.iteritems(dd)
-                            for k, v in six.iteritems(flatten_ordered(vv, separator, kk, is_list_fn))
-                            ])
-    elif is_list_fn(dd):
-        if not dd:
-            return dd
-        return OrderedDict([(prefix + separator + k if prefix else k, v)
-                            for kk, vv in enumerate(dd)
-                            for k, v in six.iteritems(flatten_ordered(vv, separator, str(kk), is_list_fn))
-                            ])
-    else:
-        return OrderedDict([(prefix, dd)])
+    out = OrderedDict()
+    if not _flatten_into(out, dd, separator, prefix, is_list_fn):
+        # empty dictionaries and lists are returned as is
+        return dd
+    return out
 
 
 # def flatten(nested_dict, separator="_", root_keys_to_ignore=set()):
@@ -160,6 +190,148 @@ def flatten_ordered(dd, separator='_', prefix='', is_list_fn=lambda x: isinstanc
 flatten_json = flatten
 
 
+class _SchemaMismatch(Exception):
+    pass
+
+
+def _learn_schema(dd, separator, pre, is_list_fn, keys):
+    """Get the structure of the inner node `dd` and append the flattened keys
+    of its leaves to `keys`. `pre` is the key prefix of the node's children.
+
+    Returns:
+      tuple (dictionary keys or None for a list, child schemas or None for leaves)
+    """
+    if isinstance(dd, Mapping):
+        schema_keys = list(dd)
+        items = [(k, dd[k]) for k in schema_keys]
+    else:
+        schema_keys = None
+        items = [(str(i), v) for i, v in enumerate(dd)]
+    children = []
+    for k, v in items:
+        if isinstance(v, Mapping) or is_list_fn(v):
+            children.append(_learn_schema(v, separator, pre + k + separator if k else pre,
+                                          is_list_fn, keys))
+        else:
+            keys.append(pre + k if pre else k)
+            children.append(None)
+    return (schema_keys, children)
+
+
+def _is_list(x):
+    return isinstance(x, list)
+
+
+def _extract_leaves(schema, dd, is_list_fn, leaf_types, out):
+    """Append the leaves of the inner node `dd` to `out`. Raises _SchemaMismatch
+    if `dd` doesn't have exactly the structure given by `schema`
+
+    Args:
+      leaf_types: set of types already known to be leaves. None if `is_list_fn`
+        doesn't depend only on the type.
+    """
+    schema_keys, children = schema
+    if schema_keys is None:
+        if (leaf_types is None or type(dd) is not list) and \
+                (isinstance(dd, Mapping) or not is_list_fn(dd)):
+            raise _SchemaMismatch()
+        values = dd
+    else:
+        if type(dd) is not dict and not isinstance(dd, Mapping):
+            raise _SchemaMismatch()
+        try:
+            values = [dd[k] for k in schema_keys]
+        except KeyError:
+            raise _SchemaMismatch()
+    # also catches extra dictionary keys
+    if len(dd) != len(children):
+        raise _SchemaMismatch()
+    for child, v in zip(children, values):
+        if child is None:
+            if leaf_types is None or type(v) not in leaf_types:
+                if isinstance(v, Mapping) or is_list_fn(v):
+                    raise _SchemaMismatch()
+                if leaf_types is not None:
+                    leaf_types.add(type(v))
+            out.append(v)
+        else:
+            _extract_leaves(child, v, is_list_fn, leaf_types, out)
+
+
+def flatten_records(records, separator='_', prefix='', is_list_fn=_is_list,
+                    fill_value=None, to_numpy=False):
+    """Flatten many nested dictionaries/lists into columns
+
+    Equivalent to flattening each record with `flatten` and transposing the
+    result, without building the per-record dictionaries. The key schema is
+    learned from the first record; records with the same structure are
+    read directly into the columns. Records with missing or extra keys fall
+    back to `flatten`: new keys get a new column and missing keys get
+    `fill_value`.
+
+    Args:
+      records: iterable of nested dictionaries/lists
+      separator: how to separate different hirearchical levels
+      prefix: what to pre-append to the function
+      is_list_fn: function to determine whether to split the list/numpy.array into indvidual classes or
+        to include the element as value.
+      fill_value: value used for keys missing in a record
+      to_numpy: if True, convert the columns to numpy arrays
+
+    Returns:
+      OrderedDict of flattened key -> list (or numpy array) with one entry per record
+    """
+    columns = OrderedDict()
+    # structure of the first record and the columns of its leaves
+    schema = None
+    schema_columns = None
+    # columns not covered by the schema
+    extra_columns = []
+    # with the default is_list_fn, being a leaf depends only on the type
+    leaf_types = set() if is_list_fn is _is_list else None
+    n = 0
+    for record in records:
+        if n == 0 and (isinstance(record, Mapping) or is_list_fn(record)):
+            keys = []
+            schema = _learn_schema(record, separator, prefix + separator if prefix else '',
+                                   is_list_fn, keys)
+            if len(set(keys)) == len(keys):
+                schema_columns = [columns.setdefault(k, []) for k in keys]
+            else:
+                # some leaves collide in the flattened keys. Always use `flatten`
+                schema = None
+
+        leaves = None
+        if schema is not None:
+            leaves = []
+            try:
+                _extract_leaves(schema, record, is_list_fn, leaf_types, leaves)
+            except _SchemaMismatch:
+                leaves = None
+
+        if leaves is not None:
+            for col, v in zip(schema_columns, leaves):
+                col.append(v)
+            for col in extra_columns:
+                col.append(fill_value)
+        else:
+            flat = flatten(record, separator, prefix, is_list_fn)
+            for k in flat:
+                if k not in columns:
+                    col = [fill_value] * n
+                    columns[k] = col
+                    extra_columns.append(col)
+            for k, col in six.iteritems(columns):
+                col.append(flat.get(k, fill_value))
+        n += 1
+
+    if to_numpy:
+        import numpy as np
+        for k in columns:
+            columns[k] = np.asarray(columns[k])
+    return columns
+
+
 def _unflatten_asserts(flat_dict, separator):
     assert isinstance(flat_dict, dict), "un_flatten requires dictionary input"
     assert isinstance(separator, six.string_types), "separator must be string"
@@ -193,52 +365,98 @@ def unflatten(flat_dict, separator='_'):
     return unflattened_dict
 
 
+class _TrieNode(object):
+    """Inner node of the key trie used by `unflatten_list`
+
+    Besides the children, it keeps track whether the node has list shape,
+    i.e. whether the children keys are exactly '0', '1', ..., 'n-1'.
+    """
+    __slots__ = ('children', 'max_index')
+
+    def __init__(self):
+        self.children = dict()
+        # largest integer key seen so far. None if a non-integer key was seen
+        self.max_index = -1
+
+    def add_child(self, key, child):
+        if self.max_index is not None:
+            if isinstance(key, six.string_types) and _INT_KEY.match(key):
+                self.max_index = max(self.max_index, int(key))
+            else:
+                self.max_index = None
+        self.children[key] = child
+
+    def is_list(self):
+        return (len(self.children) > 0 and self.max_index is not None and
+                self.max_index == len(self.children) - 1)
+
+
+_MISSING = object()
+
+# non-negative integers without leading zeros
+_INT_KEY = re.compile(r'(0|[1-9][0-9]*)\Z')
+
+
+def _as_trie_node(obj):
+    """Wrap a dictionary found as a value of the flat dictionary
+    (it gets unflattened as well)
+    """
+    node = _TrieNode()
+    for k, v in six.iteritems(obj):
+        node.add_child(k, v)
+    return node
+
+
 def unflatten_list(flat_dict, separator='_'):
     """
-    Unflattens a dictionary, first assuming no lists exist and then tries to
-    identify lists and replaces them
-    This is probably not very efficient and has not been tested extensively
-    Feel free to add test cases or rewrite the logic
-    Issues that stand out to me:
-    - Sorting all the keys in the dictionary, which specially for the root
-    dictionary can be a lot of keys
-    - Checking that numbers are consecutive is O(N) in number of keys
+    Unflattens a dictionary and identifies lists: dictionaries whose keys
+    are exactly '0', '1', ..., 'n-1' (n > 0) are converted to lists.
+
+    Each key is split once and inserted into a trie which keeps track of the
+    nodes having list shape. The nested structure is then materialized in a
+    single pass over the trie, hence the runtime is linear in the total
+    number of key parts.
     :param flat_dict: dictionary with no hierarchy
     :param separator: a string that separates keys
     :return: a dictionary with hierarchy
     """
     _unflatten_asserts(flat_dict, separator)
 
-    # First unflatten the dictionary assuming no lists exist
-    unflattened_dict = unflatten(flat_dict, separator)
-
-    def _convert_dict_to_list(object_, parent_object, parent_object_key):
-        if isinstance(object_, dict):
-            try:
-                keys = [int(key) for key in object_]
-                keys.sort()
-            except (ValueError, TypeError):
-                keys = []
-            keys_len = len(keys)
-
-            if (keys_len > 0 and sum(keys) ==
-                int(((keys_len - 1) * keys_len) / 2) and keys[0] == 0 and
-                    keys[-1] == keys_len - 1 and
-                    check_if_numbers_are_consecutive(keys)):
-
-                # The dictionary looks like a list so we're going to replace it
-                parent_object[parent_object_key] = []
-                for key_index, key in enumerate(keys):
-                    parent_object[parent_object_key].append(object_[str(key)])
-                    # The list item we just added might be a list itself
-                    # https://github.com/amirziai/flatten/issues/15
-                    _convert_dict_to_list(parent_object[parent_object_key][-1],
-                                          parent_object[parent_object_key],
-                                          key_index)
-
-            for key in object_:
-                if isinstance(object_[key], dict):
-                    _convert_dict_to_list(object_[key], object_, key)
-
-    _convert_dict_to_list(unflattened_dict, None, None)
+    root = _TrieNode()
+    for item in flat_dict:
+        keys = item.strip(separator).split(separator)
+        node = root
+        for key in keys[:-1]:
+            child = node.children.get(key, _MISSING)
+            if child is _MISSING:
+                child = _TrieNode()
+                node.add_child(key, child)
+            elif not isinstance(child, _TrieNode):
+                raise TypeError("Key {0} is nested under a non-dictionary value "
+                                "(key part: {1})".format(item, key))
+            node = child
+        if keys[-1] in node.children:
+            node.children[keys[-1]] = flat_dict[item]
+        else:
+            node.add_child(keys[-1], flat_dict[item])
+
+    # materialize the trie. The root is always returned as a dictionary
+    unflattened_dict = dict()
+    stack = [(root, unflattened_dict)]
+    while stack:
+        node, out = stack.pop()
+        for key, value in six.iteritems(node.children):
+            if isinstance(value, dict):
+                value = _as_trie_node(value)
+            if isinstance(value, _TrieNode):
+                if value.is_list():
+                    child_out = [None] * len(value.children)
+                else:
+                    child_out = dict()
+                stack.append((value, child_out))
+                value = child_out
+            if isinstance(out, list):
+                out[int(key)] = value
+            else:
+                out[key] = value
     return unflattened_dict
@@ -5,13 +5,221 @@ import logging
 
 import sys
 import os
+import time
+import hashlib
+import traceback
+import weakref
+from collections import OrderedDict
 import related
 from attr._make import fields
+from kipoi_utils.utils import load_yaml_file, _yaml_cls, yaml_ordered_dump, yaml_ordered_dump_all
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+def _parse_yaml(text):
+    """related.from_yaml using the libyaml-based loader if available
+    """
+    import yaml
+    try:
+        return related.from_yaml(text, loader_cls=_yaml_cls("Loader"))
+    except yaml.YAMLError:
+        if _yaml_cls("Loader") is yaml.Loader:
+            raise
+        return related.from_yaml(text, loader_cls=yaml.Loader)
+
+
+def _parse_yaml_file(text):
+    return _parse_yaml(text.strip())
+
+
+def _config_dict(obj):
+    return related.to_dict(obj, suppress_empty_values=True, suppress_map_key_values=True)
+
+
+def dump_yaml_all(objs, path_or_stream):
+    """Write many related objects into a single multi-document yaml file or stream
+
+    The objects are converted and written one by one (`objs` can be a generator).
+
+    Args:
+      objs: iterable of related objects
+      path_or_stream: output file path or a writable text stream
+    """
+    documents = (_config_dict(obj) for obj in objs)
+    if hasattr(path_or_stream, "write"):
+        yaml_ordered_dump_all(documents, path_or_stream, default_flow_style=False)
+    else:
+        with open(path_or_stream, "w") as f:
+            yaml_ordered_dump_all(documents, f, default_flow_style=False)
+
+
+# class -> fingerprint of its definition (see `_class_fingerprint`)
+_CLASS_FINGERPRINTS = weakref.WeakKeyDictionary()
+# bump to invalidate all the snapshots
+_SNAPSHOT_VERSION = 1
+
+
+def _source_digest(obj):
+    """sha1 digest of the source file defining obj. None if not available
+    """
+    import inspect
+    try:
+        source_file = inspect.getsourcefile(obj)
+    except TypeError:
+        return None
+    if source_file is None or not os.path.isfile(source_file):
+        return None
+    with open(source_file, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _converter_cls(converter):
+    """Class converted to by a related field converter (None if unknown)
+    """
+    try:
+        return getattr(converter, "cls", None)
+    except Exception:
+        # class name that can't be resolved
+        return None
+
+
+def _related_classes(cls):
+    """The class and the attrs classes of its fields (recursively)
+    """
+    import attr
+    classes = []
+    stack = [cls]
+    while stack:
+        klass = stack.pop()
+        if klass in classes:
+            continue
+        classes.append(klass)
+        if not attr.has(klass):
+            continue
+        for field in reversed(fields(klass)):
+            for child in (field.type, _converter_cls(field.converter)):
+                if isinstance(child, type) and attr.has(child):
+                    stack.append(child)
+    return classes
+
+
+def _class_fingerprint(cls):
+    """Fingerprint of the class definition: source files defining the class,
+    the classes of its (nested) fields, their parent classes as well as
+    the related converters
+
+    Returns None if a source file is not available.
+    """
+    fingerprint = _CLASS_FINGERPRINTS.get(cls)
+    if fingerprint is not None:
+        return fingerprint
+    from kipoi_utils.external.related import converters
+    converters_digest = _source_digest(converters)
+    if converters_digest is None:
+        return None
+    h = hashlib.sha1()
+    h.update("{0} {1} {2} {3}".format(_SNAPSHOT_VERSION, related.__version__,
+                                      sys.version_info[:2], converters_digest).encode("utf-8"))
+    for related_cls in _related_classes(cls):
+        for klass in related_cls.__mro__:
+            if klass.__module__ in ("builtins", "__builtin__"):
+                continue
+            digest = _source_digest(klass)
+            if digest is None:
+                return None
+            h.update("{0}.{1}:{2}".format(klass.__module__, klass.__name__, digest)
+                     .encode("utf-8"))
+    fingerprint = h.hexdigest()
+    _CLASS_FINGERPRINTS[cls] = fingerprint
+    return fingerprint
+
+
+def _snapshot_path(snapshot_dir, cls, path, append_path):
+    """Path of the snapshot of the model loaded from `path`. None if the class can't be
+    fingerprinted
+    """
+    fingerprint = _class_fingerprint(cls)
+    if fingerprint is None:
+        return None
+    with open(path, "rb") as f:
+        source_digest = hashlib.sha1(f.read()).hexdigest()
+    key = "{0} {1} {2} {3}".format(fingerprint, source_digest, path, append_path)
+    return os.path.join(os.path.expanduser(snapshot_dir),
+                        hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pkl")
+
+
+def _read_snapshot(snapshot_path):
+    import pickle
+    try:
+        with open(snapshot_path, "rb") as f:
+            return pickle.load(f)
+    except (IOError, OSError):
+        return None
+    except Exception:
+        logger.warning("Unable to read the snapshot {0}. Ignoring it".format(snapshot_path))
+        return None
+
+
+def _write_snapshot(snapshot_path, model):
+    import pickle
+    import tempfile
+    from kipoi_utils.utils import makedir_exist_ok
+    snapshot_dir = os.path.dirname(snapshot_path)
+    try:
+        makedir_exist_ok(snapshot_dir)
+        data = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+        fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, suffix=".tmp")
+    except Exception as e:
+        logger.warning("Unable to write the snapshot {0}: {1}".format(snapshot_path, e))
+        return
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    # atomic replace
+    if hasattr(os, "replace"):
+        os.replace(tmp_path, snapshot_path)
+    else:
+        os.rename(tmp_path, snapshot_path)
+
+
+def _load_timed(args):
+    """Load a single file in a worker process
+
+    Returns:
+      tuple (path, model or None, error message or None, load time in seconds)
+    """
+    cls, path, append_path, snapshot_dir = args
+    start = time.time()
+    try:
+        model = cls.load(path, append_path=append_path, snapshot_dir=snapshot_dir)
+        error = None
+    except Exception:
+        model = None
+        error = traceback.format_exc()
+    return path, model, error, time.time() - start
+
+
+class BulkLoadResult(object):
+    """Result of `RelatedLoadSaveMixin.load_many`
+
+    Attributes:
+      models: OrderedDict path -> loaded model
+      errors: OrderedDict path -> error message (traceback) of the files which failed to load
+      stats: dict with timing statistics: n_files, n_loaded, n_failed,
+        wall_time, total_load_time, mean_load_time, max_load_time and slowest_path
+    """
+
+    def __init__(self, models, errors, stats):
+        self.models = models
+        self.errors = errors
+        self.stats = stats
+
+    def __repr__(self):
+        return "BulkLoadResult(n_loaded={0}, n_failed={1}, wall_time={2:.2f})".format(
+            self.stats["n_loaded"], self.stats["n_failed"], self.stats["wall_time"])
+
+
 class RelatedConfigMixin(object):
     """Provides from_config and get_config to @related.immutable decorated classes
     """
@@ -43,37 +251,110 @@ class RelatedConfigMixin(object):
         return related.to_dict(self)
 
     def get_config_as_yaml(self):
-        generated_yaml = related.to_yaml(self,
-                                         suppress_empty_values=True,
-                                         suppress_map_key_values=True)
-        return generated_yaml
+        return yaml_ordered_dump(_config_dict(self), default_flow_style=False)
 
 
 class RelatedLoadSaveMixin(RelatedConfigMixin):
     """Adds load and dump on top of RelatedConfigMixin for reading and writing from a yaml file
+
+    Attributes:
+      snapshot_dir: default directory of the model snapshots (see `load`). None to disable
     """
+    snapshot_dir = None
 
     @classmethod
-    def load(cls, path, append_path=True):
+    def load(cls, path, append_path=True, snapshot_dir=None):
         """Loads model from a yaml file
+
+        Args:
+          path: yaml file path
+          append_path: if True, set the `path` field to path (if not specified in the file)
+          snapshot_dir: directory storing the pickled models (default: `cls.snapshot_dir`).
+            If set, the loaded model is stored there and subsequent loads of the same
+            file skip the yaml parsing and conversion. The snapshots are invalidated
+            if the file content or the source of the class changes
         """
-        from io import open
-        with open(path, "r", encoding='utf-8') as f:
-            original_yaml = f.read().strip()
-        parsed_dict = related.from_yaml(original_yaml)
+        snapshot_dir = snapshot_dir or cls.snapshot_dir
+        snapshot_path = None
+        if snapshot_dir is not None:
+            snapshot_path = _snapshot_path(snapshot_dir, cls, path, append_path)
+            if snapshot_path is not None:
+                model = _read_snapshot(snapshot_path)
+                if model is not None:
+                    return model
+
+        parsed_dict = load_yaml_file(path, _parse_yaml_file)
         if append_path and "path" not in parsed_dict:
             parsed_dict["path"] = path
         try:
-            return cls.from_config(parsed_dict)
+            model = cls.from_config(parsed_dict)
         except Exception as e:
             raise Exception("Unable to load file {0} into class {1}.\nError: \n{2}".
                             format(os.path.abspath(path), cls, str(e)))
+        if snapshot_path is not None:
+            _write_snapshot(snapshot_path, model)
+        return model
+
+    @classmethod
+    def load_many(cls, paths, n_jobs=None, append_path=True, use_processes=True, chunksize=None,
+                  snapshot_dir=None):
+        """Load many yaml files in parallel
+
+        Files failing to load don't abort the run, their errors are collected instead.
+
+        Args:
+          paths: list of yaml file paths
+          n_jobs: number of worker processes (default: number of cpus).
+            If 1, the files are loaded sequentially in the current process
+          append_path, snapshot_dir: see `load`
+          use_processes: if False, use threads instead of processes
+          chunksize: number of files sent to a worker at once
+            (default: spread the files evenly across 4 chunks per worker)
+
+        Returns:
+          BulkLoadResult
+        """
+        paths = list(paths)
+        start = time.time()
+        tasks = [(cls, path, append_path, snapshot_dir) for path in paths]
+        if n_jobs == 1 or len(paths) <= 1:
+            results = [_load_timed(t) for t in tasks]
+        else:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+            n_jobs = n_jobs or multiprocessing.cpu_count()
+            if chunksize is None:
+                chunksize = max(1, len(paths) // (4 * n_jobs))
+            if use_processes:
+                with ProcessPoolExecutor(n_jobs) as executor:
+                    results = list(executor.map(_load_timed, tasks, chunksize=chunksize))
+            else:
+                with ThreadPoolExecutor(n_jobs) as executor:
+                    results = list(executor.map(_load_timed, tasks))
+
+        models, errors = OrderedDict(), OrderedDict()
+        load_times = []
+        for path, model, error, load_time in results:
+            if error is None:
+                models[path] = model
+            else:
+                errors[path] = error
+            load_times.append((load_time, path))
+        stats = {"n_files": len(paths),
+                 "n_loaded": len(models),
+                 "n_failed": len(errors),
+                 "wall_time": time.time() - start,
+                 "total_load_time": sum([t for t, _ in load_times]),
+                 "mean_load_time": sum([t for t, _ in load_times]) / max(len(paths), 1),
+                 "max_load_time": max(load_times)[0] if load_times else 0.0,
+                 "slowest_path": max(load_times)[1] if load_times else None}
+        return BulkLoadResult(models, errors, stats)
 
     @classmethod
     def from_string(cls, string):
         """Loads model from a yaml file
         """
-        parsed_dict = related.from_yaml(string)
+        parsed_dict = _parse_yaml(string)
         try:
             return cls.from_config(parsed_dict)
         except Exception as e:
@@ -83,8 +364,5 @@ class RelatedLoadSaveMixin(RelatedConfigMixin):
     def dump(self, path):
         """Dump the object to a yaml file
         """
-        generated_yaml = related.to_yaml(self,
-                                         suppress_empty_values=True,
-                                         suppress_map_key_values=True)  # .strip()
         with open(path, "w") as f:
-            f.write(generated_yaml)
+            yaml_ordered_dump(_config_dict(self), f, default_flow_style=False)
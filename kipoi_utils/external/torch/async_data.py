@@ -0,0 +1,140 @@
+"""asyncio iteration over the DataLoader
+
+>>> async for batch in DataLoader(dataset, batch_size=32, num_workers=4):
+...     await handle(batch)
+
+The worker results are awaited without blocking the event loop: the pipe of
+the worker data queue is watched with `loop.add_reader`. Cancelling the
+iterating task (or calling `aclose`) shuts the workers down.
+"""
+import asyncio
+import logging
+import time
+
+from .data import DataLoaderIter, WorkerRetired
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+_STOP = object()
+
+
+def _next_or_stop(it):
+    # StopIteration can't be raised through a Future
+    try:
+        return next(it)
+    except StopIteration:
+        return _STOP
+
+
+def _shutdown(it, timeout=5.0):
+    """Stop the workers of a DataLoaderIter and wait for them to exit
+
+    The data queue is drained meanwhile so that no worker blocks on putting
+    its results. Workers not exiting within `timeout` seconds are terminated.
+    """
+    if it.num_workers == 0:
+        return
+    it._shutdown_workers()
+    reader = getattr(it.data_queue, "_reader", None)
+    deadline = time.time() + timeout
+    for w in it.workers:
+        while w.is_alive() and time.time() < deadline:
+            if reader is not None and reader.poll(0.05):
+                it.data_queue.get()
+            else:
+                w.join(0.05)
+        if w.is_alive() and hasattr(w, "terminate"):
+            # worker process (remote worker connections use threads)
+            w.terminate()
+            w.join()
+
+
+def _log_shutdown_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Failed to shut down the DataLoader workers", exc_info=future.exception())
+
+
+class AsyncDataLoaderIter(object):
+    """Asynchronous iterator over the DataLoader. See `DataLoader.__aiter__`
+    """
+
+    def __init__(self, loader):
+        self._it = DataLoaderIter(loader)
+        self._closed = False
+        # shutdown started on cancellation
+        self._shutdown_future = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            batch = await self._next()
+        except asyncio.CancelledError:
+            # stop the workers in the background. Awaited by `aclose`
+            self._closed = True
+            self._shutdown_future = asyncio.get_event_loop().run_in_executor(
+                None, _shutdown, self._it)
+            self._shutdown_future.add_done_callback(_log_shutdown_error)
+            raise
+        if batch is _STOP:
+            await self.aclose()
+            raise StopAsyncIteration
+        return batch
+
+    async def _next(self):
+        it = self._it
+        if it.num_workers == 0:
+            # same-process loading in a thread
+            return await asyncio.get_event_loop().run_in_executor(None, _next_or_stop, it)
+
+        # check if the next sample has already been generated
+        if it.rcvd_idx in it.reorder_dict:
+            batch = it.reorder_dict.pop(it.rcvd_idx)
+            return it._process_next_batch(batch)
+
+        if it.batches_outstanding == 0:
+            return _STOP
+
+        while True:
+            idx, batch = await self._get()
+            if isinstance(batch, WorkerRetired):
+                it._recycle_worker(batch)
+                continue
+            it.batches_outstanding -= 1
+            if idx != it.rcvd_idx:
+                # store out-of-order samples
+                it.reorder_dict[idx] = batch
+                continue
+            return it._process_next_batch(batch)
+
+    async def _get(self):
+        """Get the next item of the data queue without blocking the event loop
+        """
+        loop = asyncio.get_event_loop()
+        data_queue = self._it.data_queue
+        reader = getattr(data_queue, "_reader", None)
+        if reader is None:
+            # pin_memory thread queue
+            return await loop.run_in_executor(None, data_queue.get)
+        fd = reader.fileno()
+        while not reader.poll():
+            readable = loop.create_future()
+            loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(fd)
+        return data_queue.get()
+
+    async def aclose(self):
+        """Stop the workers and wait for them to exit
+        """
+        if not self._closed:
+            self._closed = True
+            await asyncio.get_event_loop().run_in_executor(None, _shutdown, self._it)
+        elif self._shutdown_future is not None:
+            await self._shutdown_future
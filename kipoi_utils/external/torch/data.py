@@ -4,13 +4,17 @@ As I was getting the ImportError: dlopen: cannot load any more object with stati
 error
 """
 import multiprocessing
+import os
 from .sampler import SequentialSampler, RandomSampler, BatchSampler
+from .dataset import fetch_batch
+from .pipeline import BatchPipeline, add_timings
 import collections
 import sys
 import traceback
 import threading
 # TODO THIS NEEDS TO BE SOMEWHERE ELSE
 from kipoi_utils.data_utils import numpy_collate
+from kipoi_utils.tree import tree_map
 # string_classes
 if sys.version_info[0] == 2:
     string_classes = basestring
@@ -30,6 +34,27 @@ default_collate = numpy_collate
 _use_shared_memory = False
 """Whether to use shared memory in default_collate"""
 
+_worker_id = None
+
+
+def get_worker_id():
+    """Id (0, ..., num_workers - 1) of the DataLoader worker process running the
+    code. None in the main process. Recycled workers keep the id of the worker they replace
+    """
+    return _worker_id
+
+
+_worker_seed = None
+
+
+def get_worker_seed():
+    """Seed sequence `(epoch, worker id, respawns)` identifying the DataLoader
+    worker process running the code. It differs between the epochs (iterations
+    over the DataLoader) and between a recycled worker and its replacement.
+    None in the main process
+    """
+    return _worker_seed
+
 # -------
 
 
@@ -41,14 +66,81 @@ class ExceptionWrapper(object):
         self.exc_msg = "".join(traceback.format_exception(*exc_info))
 
 
-def _worker_loop(dataset, index_queue, data_queue, collate_fn):
-    global _use_shared_memory
+class TransformedBatch(object):
+    "Batch transformed by a BatchPipeline in a worker, with the stage timings"
+    __slots__ = ("batch", "timings")
+
+    def __init__(self, batch, timings):
+        self.batch = batch
+        self.timings = timings
+
+    def __getstate__(self):
+        return (self.batch, self.timings)
+
+    def __setstate__(self, state):
+        self.batch, self.timings = state
+
+
+def make_batch(dataset, batch_indices, collate_fn, transforms=None):
+    """Fetch, collate and transform a batch
+    """
+    batch = collate_fn(fetch_batch(dataset, batch_indices))
+    if transforms is not None:
+        batch = TransformedBatch(*transforms.run(batch))
+    return batch
+
+
+class WorkerRetired(object):
+    "Sent by a worker exiting because of the recycling policy of the DataLoader"
+
+    def __init__(self, worker_id, reason, batches, rss):
+        self.worker_id = worker_id
+        self.reason = reason
+        self.batches = batches
+        self.rss = rss
+
+
+def _current_rss():
+    """Resident set size of the current process in bytes (None if unknown)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    # peak instead of current rss. Kilobytes on linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _retire_reason(batches, max_batches, max_rss):
+    """Reason for the worker to exit after `batches` batches (None to keep running)
+    """
+    if max_batches is not None and batches >= max_batches:
+        return "max_batches", None
+    if max_rss is not None:
+        rss = _current_rss()
+        if rss is not None and rss > max_rss:
+            return "max_rss", rss
+    return None, None
+
+
+def _worker_loop(dataset, index_queue, data_queue, collate_fn, transforms=None,
+                 worker_id=0, max_batches=None, max_rss=None, worker_seed=None):
+    global _use_shared_memory, _worker_id, _worker_seed
     _use_shared_memory = True
+    _worker_id = worker_id
+    _worker_seed = worker_seed
 
     if hasattr(dataset, 'build'):
         # Run the build method on the dataset
         dataset.build()
     # torch.set_num_threads(1)
+    batches = 0
     while True:
         r = index_queue.get()
         if r is None:
@@ -56,11 +148,17 @@ def _worker_loop(dataset, index_queue, data_queue, collate_fn):
             break
         idx, batch_indices = r
         try:
-            samples = collate_fn([dataset[i] for i in batch_indices])
+            samples = make_batch(dataset, batch_indices, collate_fn, transforms)
         except Exception:
             data_queue.put((idx, ExceptionWrapper(sys.exc_info())))
         else:
             data_queue.put((idx, samples))
+        batches += 1
+        # retire between batches, the next indices stay in the index queue
+        reason, rss = _retire_reason(batches, max_batches, max_rss)
+        if reason is not None:
+            data_queue.put((None, WorkerRetired(worker_id, reason, batches, rss)))
+            break
 
 
 def _pin_memory_loop(in_queue, out_queue, done_event):
@@ -86,14 +184,7 @@ def _pin_memory_loop(in_queue, out_queue, done_event):
 
 
 def pin_memory_batch(batch):
-    if isinstance(batch, string_classes):
-        return batch
-    elif isinstance(batch, collections.Mapping):
-        return {k: pin_memory_batch(sample) for k, sample in batch.items()}
-    elif isinstance(batch, collections.Sequence):
-        return [pin_memory_batch(sample) for sample in batch]
-    else:
-        return batch
+    return tree_map(lambda x: x, batch)
 
 
 class DataLoaderIter(object):
@@ -105,28 +196,42 @@ class DataLoaderIter(object):
         self.batch_sampler = loader.batch_sampler
         self.num_workers = loader.num_workers
         self.pin_memory = loader.pin_memory
+        self.transforms = loader.transforms
+        self.max_batches_per_worker = loader.max_batches_per_worker
+        self.max_worker_rss = loader.max_worker_rss
+        self.stats = loader.stats = {"transforms": collections.OrderedDict(),
+                                     "recycled_workers": []}
+        self.remote_workers = loader.remote_workers
+        if self.remote_workers:
+            self.num_workers = len(self.remote_workers)
         self.done_event = threading.Event()
+        self.epoch = loader._epoch
+        loader._epoch += 1
 
         self.sample_iter = iter(self.batch_sampler)
 
         if self.num_workers > 0:
-            self.index_queue = SimpleQueue()
-            self.data_queue = SimpleQueue()
             self.batches_outstanding = 0
             self.shutdown = False
             self.send_idx = 0
             self.rcvd_idx = 0
             self.reorder_dict = {}
 
-            self.workers = [
-                multiprocessing.Process(
-                    target=_worker_loop,
-                    args=(self.dataset, self.index_queue, self.data_queue, self.collate_fn))
-                for _ in range(self.num_workers)]
-
-            for w in self.workers:
-                w.daemon = True  # ensure that the worker exits on process exit
-                w.start()
+            if self.remote_workers:
+                from .remote import RemoteWorkerPool
+                self.workers = []
+                self.data_queue = queue.Queue()
+                self.index_queue = RemoteWorkerPool(self.remote_workers, self.data_queue,
+                                                    authkey=loader.authkey)
+                # receiver threads of the connections
+                self.workers = self.index_queue.workers
+            else:
+                self.index_queue = SimpleQueue()
+                # the pin_memory thread replaces data_queue, respawned workers need this one
+                self.worker_result_queue = SimpleQueue()
+                self.data_queue = self.worker_result_queue
+                self.respawns = [0] * self.num_workers
+                self.workers = [self._start_worker(i) for i in range(self.num_workers)]
 
             if self.pin_memory:
                 in_data = self.data_queue
@@ -145,13 +250,36 @@ class DataLoaderIter(object):
                 # Run the build method for the dataset
                 self.dataset.build()
 
+    def _start_worker(self, worker_id):
+        w = multiprocessing.Process(
+            target=_worker_loop,
+            args=(self.dataset, self.index_queue, self.worker_result_queue, self.collate_fn,
+                  self.transforms, worker_id, self.max_batches_per_worker,
+                  self.max_worker_rss, (self.epoch, worker_id, self.respawns[worker_id])))
+        w.daemon = True  # ensure that the worker exits on process exit
+        w.start()
+        return w
+
+    def _recycle_worker(self, retired):
+        """Replace a retired worker by a new one
+        """
+        self.workers[retired.worker_id].join()
+        self.stats["recycled_workers"].append({"worker_id": retired.worker_id,
+                                               "reason": retired.reason,
+                                               "batches": retired.batches,
+                                               "rss": retired.rss})
+        if not self.shutdown:
+            self.respawns[retired.worker_id] += 1
+            self.workers[retired.worker_id] = self._start_worker(retired.worker_id)
+
     def __len__(self):
         return len(self.batch_sampler)
 
     def __next__(self):
         if self.num_workers == 0:  # same-process loading
             indices = next(self.sample_iter)  # may raise StopIteration
-            batch = self.collate_fn([self.dataset[i] for i in indices])
+            batch = self._unwrap(make_batch(self.dataset, indices, self.collate_fn,
+                                            self.transforms))
             if self.pin_memory:
                 batch = pin_memory_batch(batch)
             return batch
@@ -168,6 +296,9 @@ class DataLoaderIter(object):
         while True:
             assert (not self.shutdown and self.batches_outstanding > 0)
             idx, batch = self.data_queue.get()
+            if isinstance(batch, WorkerRetired):
+                self._recycle_worker(batch)
+                continue
             self.batches_outstanding -= 1
             if idx != self.rcvd_idx:
                 # store out-of-order samples
@@ -194,6 +325,12 @@ class DataLoaderIter(object):
         self._put_indices()
         if isinstance(batch, ExceptionWrapper):
             raise batch.exc_type(batch.exc_msg)
+        return self._unwrap(batch)
+
+    def _unwrap(self, batch):
+        if isinstance(batch, TransformedBatch):
+            add_timings(self.stats["transforms"], batch.timings)
+            return batch.batch
         return batch
 
     def __getstate__(self):
@@ -210,6 +347,8 @@ class DataLoaderIter(object):
             self.done_event.set()
             for _ in self.workers:
                 self.index_queue.put(None)
+            if self.remote_workers and hasattr(self, "index_queue"):
+                self.index_queue.close()
 
     def __del__(self):
         if self.num_workers > 0:
@@ -242,16 +381,55 @@ class DataLoader(object):
             if the dataset size is not divisible by the batch size. If False and
             the size of dataset is not divisible by the batch size, then the last batch
             will be smaller. (default: False)
+        remote_workers (list, optional): (host, port) addresses of remote worker
+            daemons (see `kipoi_utils.external.torch.remote.serve_worker`) used
+            instead of local worker processes. ``num_workers`` is ignored.
+        authkey (bytes, optional): key authenticating the remote worker connections.
+            Required with ``remote_workers``.
+        transforms (BatchPipeline or list, optional): batch-level transforms
+            executed by the workers after ``collate_fn`` (see
+            `kipoi_utils.external.torch.pipeline`). The accumulated stage timings
+            of the last iteration are available in ``stats["transforms"]``.
+            Remote worker daemons apply their own ``transforms``.
+        max_batches_per_worker (int, optional): replace the worker processes
+            by new ones (re-running ``dataset.build()``) after they loaded this
+            many batches. Limits the memory growth of leaky datasets.
+        max_worker_rss (int, optional): replace the worker processes once
+            their resident memory exceeds this many bytes (checked after
+            each batch). The recycled workers are listed in
+            ``stats["recycled_workers"]``.
     """
 
     def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
-                 num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False):
+                 num_workers=0, collate_fn=default_collate, pin_memory=False, drop_last=False,
+                 remote_workers=None, authkey=None, transforms=None,
+                 max_batches_per_worker=None, max_worker_rss=None):
         self.dataset = dataset
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.collate_fn = collate_fn
         self.pin_memory = pin_memory
         self.drop_last = drop_last
+        self.remote_workers = remote_workers
+        self.authkey = authkey
+        if remote_workers and not authkey:
+            raise ValueError("remote_workers require a non-empty authkey")
+        if transforms is not None and not isinstance(transforms, BatchPipeline):
+            transforms = BatchPipeline(transforms)
+        if transforms is not None and remote_workers:
+            raise ValueError("transforms can't be sent to the remote workers. "
+                             "Pass them to the remote worker daemons instead")
+        if remote_workers and (max_batches_per_worker is not None or max_worker_rss is not None):
+            raise ValueError("max_batches_per_worker and max_worker_rss only apply to "
+                             "local worker processes, not to remote_workers")
+        self.transforms = transforms
+        if max_batches_per_worker is not None and max_batches_per_worker < 1:
+            raise ValueError("max_batches_per_worker has to be at least 1")
+        self.max_batches_per_worker = max_batches_per_worker
+        self.max_worker_rss = max_worker_rss
+        self.stats = {"transforms": collections.OrderedDict(), "recycled_workers": []}
+        # number of iterators created, see `get_worker_seed`
+        self._epoch = 0
 
         if batch_sampler is not None:
             if batch_size > 1 or shuffle or sampler is not None or drop_last:
@@ -275,5 +453,12 @@ class DataLoader(object):
     def __iter__(self):
         return DataLoaderIter(self)
 
+    def __aiter__(self):
+        """Asynchronous iterator (`async for batch in loader`) awaiting
+        the batches without blocking the event loop
+        """
+        from .async_data import AsyncDataLoaderIter
+        return AsyncDataLoaderIter(self)
+
     def __len__(self):
         return len(self.batch_sampler)
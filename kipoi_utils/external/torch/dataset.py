@@ -0,0 +1,127 @@
+"""Dataset views adapted from https://github.com/pytorch/pytorch/blob/master/torch/utils/data/dataset.py
+
+Indices are mapped with numpy (vectorized for batches of indices) and
+batches are fetched from the underlying datasets block by block
+(see `fetch_batch`).
+"""
+import numpy as np
+
+
+def fetch_batch(dataset, indices):
+    """Get the list of samples `[dataset[i] for i in indices]`
+
+    Uses `dataset.get_batch(indices)` if the dataset implements it.
+    """
+    if hasattr(dataset, "get_batch"):
+        return dataset.get_batch(indices)
+    return [dataset[i] for i in indices]
+
+
+def _build(datasets):
+    for d in datasets:
+        if hasattr(d, 'build'):
+            d.build()
+
+
+class Dataset(object):
+    """An abstract class representing a Dataset.
+
+    All other datasets should subclass it. All subclasses should override
+    ``__len__``, that provides the size of the dataset, and ``__getitem__``,
+    supporting integer indexing in range from 0 to len(self) exclusive.
+    """
+
+    def __getitem__(self, index):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __add__(self, other):
+        return ConcatDataset([self, other])
+
+
+class ConcatDataset(Dataset):
+    """Dataset as a concatenation of multiple datasets
+
+    A global index is mapped to (dataset, local index) by binary search in
+    the cumulative dataset sizes.
+
+    Arguments:
+        datasets (sequence): list of datasets to be concatenated
+    """
+
+    def __init__(self, datasets):
+        self.datasets = list(datasets)
+        self.cumulative_sizes = np.cumsum([len(d) for d in self.datasets], dtype=np.int64)
+
+    def __len__(self):
+        return int(self.cumulative_sizes[-1]) if len(self.cumulative_sizes) else 0
+
+    def build(self):
+        _build(self.datasets)
+
+    def locate(self, indices):
+        """Map global indices to the dataset indices and the indices within the datasets
+
+        Args:
+          indices: int or array of ints (negative indices are supported)
+
+        Returns:
+          tuple (dataset indices, local indices)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        n = len(self)
+        indices = np.where(indices < 0, indices + n, indices)
+        if indices.size and (indices.min() < 0 or indices.max() >= n):
+            raise IndexError("index out of range for a dataset of length {0}".format(n))
+        dataset_idx = np.searchsorted(self.cumulative_sizes, indices, side='right')
+        starts = np.concatenate([[0], self.cumulative_sizes[:-1]])
+        return dataset_idx, indices - starts[dataset_idx]
+
+    def __getitem__(self, idx):
+        dataset_idx, sample_idx = self.locate(idx)
+        return self.datasets[int(dataset_idx)][int(sample_idx)]
+
+    def get_batch(self, indices):
+        """Get the samples of a batch of indices. The indices belonging to the
+        same dataset are fetched together (see `fetch_batch`)
+        """
+        if len(indices) == 0:
+            return []
+        dataset_idx, sample_idx = self.locate(indices)
+        out = [None] * len(dataset_idx)
+        # group the positions by dataset
+        order = np.argsort(dataset_idx, kind="mergesort")
+        splits = np.flatnonzero(np.diff(dataset_idx[order])) + 1
+        for positions in np.split(order, splits):
+            samples = fetch_batch(self.datasets[int(dataset_idx[positions[0]])],
+                                  sample_idx[positions].tolist())
+            for p, sample in zip(positions, samples):
+                out[p] = sample
+        return out
+
+
+class Subset(Dataset):
+    """Subset of a dataset at specified indices
+
+    Arguments:
+        dataset (Dataset): the whole dataset
+        indices (sequence): indices in the whole set selected for the subset
+    """
+
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def build(self):
+        _build([self.dataset])
+
+    def __getitem__(self, idx):
+        return self.dataset[int(self.indices[idx])]
+
+    def get_batch(self, indices):
+        return fetch_batch(self.dataset, self.indices[np.asarray(indices, dtype=np.int64)].tolist())
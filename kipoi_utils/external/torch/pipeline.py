@@ -0,0 +1,210 @@
+"""Batch-level transforms executed by the DataLoader workers after `collate_fn`
+
+>>> transforms = BatchPipeline([ReverseComplement("inputs/seq"),
+...                             Cast("float32", "inputs")])
+>>> dl = DataLoader(dataset, batch_size=32, num_workers=4, transforms=transforms)
+>>> for batch in dl:
+...     pass
+>>> dl.stats["transforms"]
+OrderedDict([('ReverseComplement', {'calls': 100, 'seconds': 0.31}),
+             ('Cast', {'calls': 100, 'seconds': 0.05})])
+
+The stages get the whole collated numpy batch and return the transformed batch.
+Stages have to be picklable (module-level functions or class instances) to be
+sent to the worker processes.
+"""
+import os
+from timeit import default_timer
+
+import numpy as np
+
+from kipoi_utils.data_utils import flatten_batch
+from kipoi_utils.tree import Mapping, tree_map
+
+
+def _stage_name(fn):
+    return getattr(fn, "__name__", type(fn).__name__)
+
+
+class BatchPipeline(object):
+    """Sequence of batch transforms
+
+    Args:
+      stages: list of callables `batch -> batch` or of tuples (name, callable)
+    """
+
+    def __init__(self, stages=()):
+        self.stages = []
+        for stage in stages:
+            if isinstance(stage, tuple):
+                name, fn = stage
+            else:
+                name, fn = _stage_name(stage), stage
+            if not callable(fn):
+                raise ValueError("Stage {0} is not callable".format(name))
+            self.stages.append((name, fn))
+
+    def then(self, stage, name=None):
+        """New pipeline with an additional stage
+        """
+        return BatchPipeline(self.stages + [(name or _stage_name(stage), stage)])
+
+    def __add__(self, other):
+        if not isinstance(other, BatchPipeline):
+            other = BatchPipeline(other)
+        return BatchPipeline(self.stages + other.stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __repr__(self):
+        return "BatchPipeline([{0}])".format(", ".join([name for name, _ in self.stages]))
+
+    def run(self, batch):
+        """Transform the batch
+
+        Returns:
+          tuple (transformed batch, list of (stage name, seconds))
+        """
+        timings = []
+        for name, fn in self.stages:
+            start = default_timer()
+            batch = fn(batch)
+            timings.append((name, default_timer() - start))
+        return batch, timings
+
+    def __call__(self, batch):
+        return self.run(batch)[0]
+
+
+def add_timings(stats, timings):
+    """Accumulate the stage timings returned by `BatchPipeline.run` in
+    `stats = {stage name: {"calls": n, "seconds": total}}`
+    """
+    for name, seconds in timings:
+        stage_stats = stats.setdefault(name, {"calls": 0, "seconds": 0.0})
+        stage_stats["calls"] += 1
+        stage_stats["seconds"] += seconds
+
+
+# --------------------------------------------
+# Stages
+
+
+def _apply_at(batch, key, fn):
+    """Apply `fn` to the arrays of batch[k1][k2]... for key="k1/k2/..."
+    """
+    if key is None:
+        return tree_map(fn, batch)
+    k, _, rest = key.partition("/")
+    if not isinstance(batch, Mapping) or k not in batch:
+        raise KeyError("{0} not found in the batch".format(key))
+    out = batch.copy()
+    out[k] = _apply_at(batch[k], rest or None, fn)
+    return out
+
+
+class Cast(object):
+    """Cast the arrays to `dtype`
+
+    Args:
+      dtype: numpy dtype
+      key: "/"-separated path of the batch entry to cast. None casts all the
+        numeric arrays
+    """
+
+    def __init__(self, dtype, key=None):
+        self.dtype = np.dtype(dtype)
+        self.key = key
+
+    def _cast(self, x):
+        if isinstance(x, np.ndarray) and x.dtype.kind in "biuf":
+            return x.astype(self.dtype, copy=False)
+        return x
+
+    def __call__(self, batch):
+        return _apply_at(batch, self.key, self._cast)
+
+
+class Normalize(object):
+    """Compute `(x - mean) / std` (broadcast over the last axes)
+
+    Args:
+      mean, std: scalars or arrays
+      key: "/"-separated path of the batch entry to normalize. Only the numeric
+        arrays are normalized, other entries (e.g. ids or strings) are kept
+    """
+
+    def __init__(self, mean, std, key=None):
+        self.mean = np.asarray(mean)
+        self.std = np.asarray(std)
+        self.key = key
+
+    def _normalize(self, x):
+        if isinstance(x, np.ndarray) and x.dtype.kind in "biuf":
+            return (x - self.mean) / self.std
+        return x
+
+    def __call__(self, batch):
+        return _apply_at(batch, self.key, self._normalize)
+
+
+class ReverseComplement(object):
+    """Randomly reverse-complement one-hot encoded sequences
+    of shape (batch, length, 4) with the ACGT base order
+
+    Args:
+      key: "/"-separated path of the sequences in the batch
+      p: probability of reverse-complementing a sequence
+      seed: random seed. Each DataLoader worker derives its random state
+        from the seed, the epoch, its worker id and its respawns (see `get_worker_seed`)
+    """
+
+    def __init__(self, key=None, p=0.5, seed=None):
+        self.key = key
+        self.p = p
+        self.seed = seed
+        self._rng = None
+        self._pid = None
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d["_rng"] = None
+        d["_pid"] = None
+        return d
+
+    def _random_state(self):
+        if self._rng is None or self._pid != os.getpid():
+            # forked workers would otherwise share the random state
+            from .data import get_worker_seed
+            self._pid = os.getpid()
+            worker_seed = get_worker_seed()
+            if self.seed is None:
+                seed = None
+            elif worker_seed is None:
+                seed = self.seed
+            else:
+                seed = [self.seed] + list(worker_seed)
+            self._rng = np.random.RandomState(seed)
+        return self._rng
+
+    def _rc(self, x):
+        flip = self._random_state().rand(len(x)) < self.p
+        x = x.copy()
+        x[flip] = x[flip][:, ::-1, ::-1]
+        return x
+
+    def __call__(self, batch):
+        return _apply_at(batch, self.key, self._rc)
+
+
+class Flatten(object):
+    """Flatten the nested batch into a dictionary of 1-dimensional arrays.
+    See `kipoi_utils.data_utils.flatten_batch`
+    """
+
+    def __init__(self, nested_sep="/"):
+        self.nested_sep = nested_sep
+
+    def __call__(self, batch):
+        return flatten_batch(batch, nested_sep=self.nested_sep)
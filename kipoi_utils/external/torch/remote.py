@@ -0,0 +1,274 @@
+"""Remote DataLoader workers over TCP
+
+Worker daemons on other hosts load and collate the batches:
+
+>>> # on each worker host
+>>> serve_worker(dataset, ("0.0.0.0", 6000), authkey=b"secret")
+>>> # on the training host
+>>> loader = DataLoader(dataset, batch_size=32, authkey=b"secret",
+...                     remote_workers=[("node1", 6000), ("node2", 6000)])
+
+The requests `(batch idx, indices)` and the collated batches are sent as
+binary pickles over `multiprocessing.connection` (numpy arrays are sent as
+raw buffers). Since the messages are pickles, connections have to be
+authenticated with a shared `authkey`. Only expose the daemons on trusted
+networks.
+"""
+import logging
+import socket
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from .data import ExceptionWrapper, default_collate, make_batch
+from .pipeline import BatchPipeline
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def _check_authkey(authkey):
+    # unauthenticated peers could send arbitrary pickles -> remote code execution
+    if not authkey:
+        raise ValueError("Remote workers require a non-empty authkey (bytes)")
+    if not isinstance(authkey, bytes):
+        raise ValueError("authkey has to be bytes")
+
+
+def _exception_wrapper(exc_type, msg):
+    try:
+        raise exc_type(msg)
+    except exc_type:
+        return ExceptionWrapper(sys.exc_info())
+
+
+class RemoteWorkerServer(object):
+    """Worker daemon computing `collate_fn([dataset[i] for i in indices])`
+    for remote DataLoaders. Each connection is served by its own thread.
+    Run one daemon per CPU to load batches in parallel on a host.
+
+    Args:
+      dataset: dataset. `dataset.build()` is run before serving the first request
+      address: (host, port) to listen on. Port 0 picks a free port (see `address`)
+      collate_fn: merges a list of samples to form a mini-batch
+      authkey: bytes shared with the DataLoader to authenticate the connections (required)
+      transforms: BatchPipeline or list of batch transforms applied after
+        `collate_fn`. Their timings are reported in the stats of the DataLoader
+    """
+
+    def __init__(self, dataset, address=("127.0.0.1", 0), collate_fn=default_collate,
+                 authkey=None, transforms=None):
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+        if transforms is not None and not isinstance(transforms, BatchPipeline):
+            transforms = BatchPipeline(transforms)
+        self.transforms = transforms
+        _check_authkey(authkey)
+        self.listener = Listener(address, authkey=authkey)
+        self._build_lock = threading.Lock()
+        self._build_error = None
+        self._built = False
+        self._closed = False
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def _build(self):
+        with self._build_lock:
+            if not self._built:
+                self._built = True
+                if hasattr(self.dataset, 'build'):
+                    try:
+                        self.dataset.build()
+                    except Exception:
+                        self._build_error = ExceptionWrapper(sys.exc_info())
+
+    def handle(self, conn):
+        """Serve the requests of a single DataLoader connection
+        """
+        try:
+            self._build()
+            while True:
+                r = conn.recv()
+                if r is None:
+                    conn.send(None)
+                    break
+                idx, batch_indices = r
+                if self._build_error is not None:
+                    conn.send((idx, self._build_error))
+                    continue
+                try:
+                    samples = make_batch(self.dataset, batch_indices, self.collate_fn,
+                                         self.transforms)
+                except Exception:
+                    conn.send((idx, ExceptionWrapper(sys.exc_info())))
+                else:
+                    conn.send((idx, samples))
+        except (EOFError, OSError):
+            # the loader went away
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        """Accept connections until `close()` is called
+        """
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except (EOFError, OSError, AuthenticationError) as e:
+                if not self._closed:
+                    logger.warning("Rejected a connection: {0}".format(e))
+                continue
+            if self._closed:
+                conn.close()
+                break
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def close(self):
+        self._closed = True
+        # wake up the blocking accept
+        try:
+            socket.create_connection(self.address[:2], timeout=1).close()
+        except (OSError, socket.error):
+            pass
+        self.listener.close()
+
+
+def serve_worker(dataset, address, collate_fn=default_collate, authkey=None, transforms=None):
+    """Run a remote worker daemon for `dataset` (blocks forever)
+
+    Args:
+      dataset: dataset
+      address: (host, port) to listen on
+      collate_fn: merges a list of samples to form a mini-batch
+      authkey: bytes shared with the DataLoader to authenticate the connections (required)
+      transforms: batch transforms applied after `collate_fn`
+    """
+    server = RemoteWorkerServer(dataset, address, collate_fn=collate_fn, authkey=authkey,
+                                transforms=transforms)
+    logger.info("Serving the dataset on {0}".format(server.address))
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+class RemoteWorkerPool(object):
+    """Connections to remote worker daemons, used as the index queue of DataLoaderIter
+
+    Each request is sent to the worker with the fewest outstanding batches.
+    A receiver thread per connection puts the batches to `data_queue`. The
+    outstanding batches of a lost connection are re-sent to the other workers,
+    or fail once no worker is left.
+
+    Args:
+      addresses: list of (host, port) of the worker daemons
+      data_queue: queue receiving the `(batch idx, batch)` tuples
+      authkey: bytes shared with the daemons (required)
+    """
+
+    def __init__(self, addresses, data_queue, authkey):
+        _check_authkey(authkey)
+        self.data_queue = data_queue
+        self.conns = []
+        try:
+            for address in addresses:
+                self.conns.append(Client(tuple(address), authkey=authkey))
+        except Exception:
+            for conn in self.conns:
+                conn.close()
+            raise
+        self.pending = [{} for _ in self.conns]
+        self.alive = [True for _ in self.conns]
+        # requests are also re-sent from the receiver threads
+        self.send_locks = [threading.Lock() for _ in self.conns]
+        self.n_closed = 0
+        self.lock = threading.Lock()
+
+        self.workers = [threading.Thread(target=self._receive, args=(i,))
+                        for i in range(len(self.conns))]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+
+    def put(self, r):
+        """Send a request `(batch idx, indices)`. None shuts down one of the workers
+        """
+        if r is None:
+            with self.lock:
+                i = self.n_closed
+                self.n_closed += 1
+            self._send(i, None)
+            return
+        self._dispatch(*r)
+
+    def _dispatch(self, idx, indices):
+        with self.lock:
+            alive = [i for i in range(len(self.conns)) if self.alive[i]]
+            if alive:
+                i = min(alive, key=lambda i: len(self.pending[i]))
+                self.pending[i][idx] = indices
+        if not alive:
+            self.data_queue.put((idx, _exception_wrapper(IOError,
+                                                         "No remote worker left")))
+            return
+        if not self._send(i, (idx, indices)):
+            # re-sends the request
+            self._lost(i)
+
+    def _send(self, i, obj):
+        try:
+            with self.send_locks[i]:
+                self.conns[i].send(obj)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def _lost(self, i):
+        with self.lock:
+            if not self.alive[i]:
+                return
+            self.alive[i] = False
+            pending = self.pending[i]
+            self.pending[i] = {}
+            closing = self.n_closed > 0
+        self.conns[i].close()
+        if closing:
+            return
+        logger.warning("Lost the connection to remote worker {0}".format(i))
+        for idx in sorted(pending):
+            self._dispatch(idx, pending[idx])
+
+    def _receive(self, i):
+        conn = self.conns[i]
+        while True:
+            try:
+                r = conn.recv()
+            except (EOFError, OSError):
+                self._lost(i)
+                break
+            if r is None:
+                # shut down
+                conn.close()
+                break
+            with self.lock:
+                # drop batches already re-sent to other workers
+                if self.pending[i].pop(r[0], None) is None:
+                    continue
+            self.data_queue.put(r)
+
+    def close(self, timeout=5.0):
+        """Wait for the workers to acknowledge the shut down (see `put(None)`)
+        and close the connections
+        """
+        deadline = time.time() + timeout
+        for w in self.workers:
+            w.join(max(0, deadline - time.time()))
+        for conn in self.conns:
+            conn.close()
@@ -86,6 +86,13 @@ class BatchSampler(object):
         self.drop_last = drop_last
 
     def __iter__(self):
+        if isinstance(self.sampler, SequentialSampler):
+            # contiguous index blocks
+            n = len(self.sampler)
+            stop = n - n % self.batch_size if self.drop_last else n
+            for start in range(0, stop, self.batch_size):
+                yield list(range(start, min(start + self.batch_size, n)))
+            return
         batch = []
         for idx in self.sampler:
             batch.append(idx)
@@ -2,8 +2,18 @@ import os
 import os.path
 import hashlib
 import errno
+import json
+import logging
+import tempfile
+import threading
+import time
+from contextlib import closing
+import six
 from tqdm import tqdm
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
 
 def gen_bar_updater(pbar):
     def bar_update(count, block_size, total_size):
@@ -16,20 +26,153 @@ def gen_bar_updater(pbar):
     return bar_update
 
 
-def check_integrity(fpath, md5=None):
-    if md5 is None:
+# size of the read buffer used to hash the files
+_HASH_BUFFER_SIZE = 4 * 1024 * 1024
+
+# name of the sidecar file caching the digests of the files in a directory
+DIGEST_CACHE_FILE = ".kipoi_digests.json"
+_DIGEST_CACHE_LOCK = threading.Lock()
+
+HASH_ALGORITHMS = ("md5", "sha1", "sha256", "sha512", "blake2b")
+
+
+def _hash_file(fpath, algorithms):
+    """Compute the hex digests of a file for multiple algorithms in a single pass
+    """
+    hashers = [hashlib.new(a) for a in algorithms]
+    buf = bytearray(_HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(fpath, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            # hashlib releases the GIL for large buffers -> files can be hashed in threads
+            for h in hashers:
+                h.update(view[:n])
+    return dict(zip(algorithms, [h.hexdigest() for h in hashers]))
+
+
+def _file_key(st):
+    return [st.st_size, st.st_mtime, getattr(st, "st_ino", 0)]
+
+
+def _read_digest_cache(cache_path):
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _update_digest_cache(cache_path, entries):
+    """Add the entries (file name -> entry) to the sidecar cache file
+    """
+    with _DIGEST_CACHE_LOCK:
+        cache = _read_digest_cache(cache_path)
+        for name, entry in six.iteritems(entries):
+            old = cache.get(name)
+            if old is not None and old["key"] == entry["key"]:
+                old["digests"].update(entry["digests"])
+            else:
+                cache[name] = entry
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+        except (IOError, OSError):
+            # read-only directory
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            # atomic replace
+            if hasattr(os, "replace"):
+                os.replace(tmp_path, cache_path)
+            else:
+                os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            # the cache is optional
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def file_digests(fpath, algorithms=("md5",), cache=False):
+    """Hex digests of a file
+
+    Args:
+      fpath: file path
+      algorithms: list of hashlib algorithm names (say md5, sha256 or blake2b)
+      cache: if True, the digests are stored in a sidecar file
+        (`DIGEST_CACHE_FILE` in the same directory) keyed by the file size,
+        mtime and inode. Unchanged files are not hashed again. The cache is
+        not written if the directory is read-only.
+
+    Returns:
+      dict: algorithm -> hex digest
+    """
+    algorithms = list(algorithms)
+    st = os.stat(fpath)
+    key = _file_key(st)
+    cache_path = os.path.join(os.path.dirname(os.path.abspath(fpath)), DIGEST_CACHE_FILE)
+    name = os.path.basename(fpath)
+    digests = {}
+    if cache:
+        entry = _read_digest_cache(cache_path).get(name)
+        # file modified in the same second as hashed -> mtime not conclusive
+        if entry is not None and entry["key"] == key and st.st_mtime < entry["hashed_at"] - 1:
+            digests = dict([(a, entry["digests"][a]) for a in algorithms if a in entry["digests"]])
+    missing = [a for a in algorithms if a not in digests]
+    if missing:
+        hashed_at = time.time()
+        new = _hash_file(fpath, missing)
+        digests.update(new)
+        if cache and _file_key(os.stat(fpath)) == key:
+            _update_digest_cache(cache_path, {name: {"key": key, "hashed_at": hashed_at,
+                                                     "digests": new}})
+    return digests
+
+
+def check_integrity(fpath, md5=None, sha256=None, blake2b=None, cache=False):
+    """Check that the file has the expected digests (all the specified ones)
+
+    Args:
+      fpath: file path
+      md5, sha256, blake2b: expected hex digests. None to not check
+      cache: use the sidecar digest cache (see `file_digests`)
+    """
+    expected = dict([(a, d) for a, d in [("md5", md5), ("sha256", sha256), ("blake2b", blake2b)]
+                     if d is not None])
+    if not expected:
         return True
+    return _matches_digests(fpath, expected, cache)
+
+
+def _matches_digests(fpath, expected, cache):
     if not os.path.isfile(fpath):
         return False
-    md5o = hashlib.md5()
-    with open(fpath, 'rb') as f:
-        # read in 1MB chunks
-        for chunk in iter(lambda: f.read(1024 * 1024), b''):
-            md5o.update(chunk)
-    md5c = md5o.hexdigest()
-    if md5c != md5:
-        return False
-    return True
+    if not expected:
+        return True
+    digests = file_digests(fpath, list(expected), cache=cache)
+    return all([digests[a] == d.lower() for a, d in six.iteritems(expected)])
+
+
+def verify_files(files, n_jobs=4, cache=False):
+    """Check the integrity of many files concurrently
+
+    Args:
+      files: dict file path -> dict of expected digests (algorithm -> hex digest),
+        say `{"weights.h5": {"sha256": "..."}}`
+      n_jobs: number of files hashed in parallel (threads)
+      cache: use the sidecar digest cache (see `file_digests`)
+
+    Returns:
+      dict: file path -> True if the file exists and matches all the digests
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    paths = list(files)
+    with ThreadPoolExecutor(max(1, n_jobs)) as executor:
+        return dict(zip(paths, executor.map(lambda p: _matches_digests(p, files[p], cache),
+                                            paths)))
 
 
 def makedir_exist_ok(dirpath):
@@ -45,30 +188,350 @@ def makedir_exist_ok(dirpath):
             raise
 
 
-def download_url(url, root, filename, md5=''):
+# size of the chunks read from the http responses
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _open_url(url, start=None, end=None, method=None, timeout=60):
+    """Open the url, optionally requesting the byte range start-end (inclusive)
+    """
     from six.moves import urllib
+    headers = {}
+    if start is not None:
+        headers["Range"] = "bytes={0}-{1}".format(start, "" if end is None else end)
+    request = urllib.request.Request(url, headers=headers)
+    if method is not None:
+        request.get_method = lambda: method
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def _url_info(url):
+    """Get the size of the file (None if unknown) and if the server supports range requests
+    """
+    try:
+        response = _open_url(url, method="HEAD")
+    except Exception:
+        # HEAD not supported
+        return None, False
+    with closing(response):
+        info = response.info()
+        size = info.get("Content-Length")
+        accept_ranges = info.get("Accept-Ranges", "").lower() == "bytes"
+    return (int(size) if size else None), accept_ranges
+
+
+def _copy_response(response, f, hashers, on_bytes):
+    for chunk in iter(lambda: response.read(_DOWNLOAD_CHUNK_SIZE), b''):
+        f.write(chunk)
+        for h in hashers:
+            h.update(chunk)
+        on_bytes(len(chunk))
+
+
+def _hash_into(fpath, hashers, on_bytes=None):
+    """Update the hashers with the content of the file
+    """
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_BUFFER_SIZE), b''):
+            for h in hashers:
+                h.update(chunk)
+            if on_bytes is not None:
+                on_bytes(len(chunk))
+
+
+def _download_single(url, part_path, size, accept_ranges, algorithms, on_bytes):
+    """Download the url to `part_path` in a single stream
+
+    A partially downloaded `part_path` is resumed if the server supports range requests.
+    The digests are computed while streaming.
+    """
+    hashers = [hashlib.new(a) for a in algorithms]
+    start = os.path.getsize(part_path) if accept_ranges and os.path.isfile(part_path) else 0
+    if size is not None and start > size:
+        start = 0
+    if start and start == size:
+        response = None
+    else:
+        response = _open_url(url, start=start or None)
+        if start and response.getcode() != 206:
+            # range request not honored -> start over
+            start = 0
+    if start:
+        _hash_into(part_path, hashers, on_bytes)
+    if response is not None:
+        with closing(response), open(part_path, 'ab' if start else 'wb') as f:
+            _copy_response(response, f, hashers, on_bytes)
+    if size is not None and os.path.getsize(part_path) != size:
+        raise IOError("Incomplete download of {0}: got {1} of {2} bytes"
+                      .format(url, os.path.getsize(part_path), size))
+    return dict(zip(algorithms, [h.hexdigest() for h in hashers]))
 
+
+class _OrderedHasher(object):
+    """Hash concurrently downloaded segments in file order while they are streamed
+
+    Chunks of the segment being hashed are hashed from memory. The bytes a
+    segment received before its turn (or before a resume) are read back from
+    its file once the previous segments are complete.
+    """
+
+    def __init__(self, algorithms, segment_paths):
+        self.hashers = [hashlib.new(a) for a in algorithms]
+        self.segment_paths = segment_paths
+        self.complete = [False] * len(segment_paths)
+        self.current = 0
+        # number of bytes of the current segment hashed so far
+        self.hashed = 0
+        self.lock = threading.Lock()
+
+    def _update(self, data):
+        for h in self.hashers:
+            h.update(data)
+
+    def _catch_up(self, end=None):
+        """Hash the current segment from its file up to `end` (default: its current size)
+        """
+        with open(self.segment_paths[self.current], 'rb') as f:
+            f.seek(self.hashed)
+            while end is None or self.hashed < end:
+                n = _HASH_BUFFER_SIZE if end is None else min(_HASH_BUFFER_SIZE, end - self.hashed)
+                data = f.read(n)
+                if not data:
+                    break
+                self._update(data)
+                self.hashed += len(data)
+
+    def add_chunk(self, i, offset, chunk):
+        """Chunk written to segment i at `offset` (and flushed)
+        """
+        with self.lock:
+            if i != self.current:
+                return
+            if self.hashed < offset:
+                self._catch_up(offset)
+            if offset <= self.hashed < offset + len(chunk):
+                self._update(memoryview(chunk)[self.hashed - offset:])
+                self.hashed = offset + len(chunk)
+
+    def segment_complete(self, i):
+        with self.lock:
+            self.complete[i] = True
+            while self.current < len(self.segment_paths) and self.complete[self.current]:
+                self._catch_up()
+                self.current += 1
+                self.hashed = 0
+            if self.current < len(self.segment_paths) and \
+                    os.path.isfile(self.segment_paths[self.current]):
+                # bytes the next segment received so far
+                self._catch_up()
+
+    def hexdigests(self, algorithms):
+        return dict(zip(algorithms, [h.hexdigest() for h in self.hashers]))
+
+
+def _download_segmented(url, part_path, size, n_segments, algorithms, on_bytes):
+    """Download the url with concurrent range requests
+
+    Segment i is downloaded to `part_path.i` (resumed if present) and the
+    digests are computed in file order while streaming (see `_OrderedHasher`).
+    The segments are then concatenated to `part_path`.
+    """
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    segment_size = -(-size // n_segments)
+    bounds = [(start, min(start + segment_size, size) - 1)
+              for start in range(0, size, segment_size)]
+    segment_paths = ["{0}.{1}".format(part_path, i) for i in range(len(bounds))]
+    hasher = _OrderedHasher(algorithms, segment_paths)
+
+    def fetch(i):
+        start, end = bounds[i]
+        path = segment_paths[i]
+        length = end - start + 1
+        done = os.path.getsize(path) if os.path.isfile(path) else 0
+        if done > length:
+            done = 0
+        on_bytes(done)
+        if done < length:
+            response = _open_url(url, start=start + done, end=end)
+            with closing(response):
+                if response.getcode() != 206:
+                    raise IOError("Server doesn't support range requests: {0}".format(url))
+                with open(path, 'ab' if done else 'wb') as f:
+                    offset = done
+                    for chunk in iter(lambda: response.read(_DOWNLOAD_CHUNK_SIZE), b''):
+                        f.write(chunk)
+                        f.flush()
+                        hasher.add_chunk(i, offset, chunk)
+                        offset += len(chunk)
+                        on_bytes(len(chunk))
+        if os.path.getsize(path) != length:
+            raise IOError("Incomplete download of {0}: segment {1}".format(url, i))
+        hasher.segment_complete(i)
+
+    with ThreadPoolExecutor(len(bounds)) as executor:
+        list(executor.map(fetch, range(len(bounds))))
+
+    with open(part_path, 'wb') as out:
+        for path in segment_paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, _HASH_BUFFER_SIZE)
+    for path in segment_paths:
+        os.remove(path)
+    return hasher.hexdigests(algorithms)
+
+
+def _download_file(url, fpath, expected, n_segments=4, min_segment_size=8 * 1024 * 1024,
+                   max_retries=3, algorithms=()):
+    """Download the url to fpath via `fpath.part`
+
+    Args:
+      expected: dict algorithm -> expected hex digest
+      n_segments: maximal number of concurrent range requests
+      min_segment_size: minimal size of a segment in bytes
+      max_retries: number of times the interrupted download is resumed
+      algorithms: additional digests to compute
+
+    Returns:
+      dict algorithm -> hex digest of the downloaded file
+    """
+    from six.moves.urllib.error import HTTPError
+    from six.moves.http_client import HTTPException
+    part_path = fpath + ".part"
+    size, accept_ranges = _url_info(url)
+    algorithms = list(expected) + [a for a in algorithms if a not in expected]
+    n_segments = min(n_segments, (size or 0) // max(min_segment_size, 1))
+
+    pbar = tqdm(total=size, unit='B', unit_scale=True)
+    lock = threading.Lock()
+
+    def on_bytes(n):
+        with lock:
+            pbar.update(n)
+
+    try:
+        for attempt in range(max_retries + 1):
+            try:
+                if accept_ranges and n_segments > 1:
+                    digests = _download_segmented(url, part_path, size, n_segments,
+                                                  algorithms, on_bytes)
+                else:
+                    digests = _download_single(url, part_path, size, accept_ranges,
+                                               algorithms, on_bytes)
+                break
+            except (IOError, OSError, HTTPException) as e:
+                if isinstance(e, HTTPError) and 400 <= e.code < 500 or attempt == max_retries:
+                    raise
+                print('Download interrupted ({0}). Resuming'.format(e))
+                pbar.n = 0
+    finally:
+        pbar.close()
+
+    for algorithm, digest in six.iteritems(expected):
+        if digests[algorithm] != digest.lower():
+            os.remove(part_path)
+            raise RuntimeError("Integrity check failed for {0}: {1} digest {2} != {3}"
+                               .format(url, algorithm, digests[algorithm], digest))
+    # atomic replace
+    if hasattr(os, "replace"):
+        os.replace(part_path, fpath)
+    else:
+        os.rename(part_path, fpath)
+    return digests
+
+
+# the https port is refused or unreachable
+_CONNECTION_ERRNOS = (errno.ECONNREFUSED, errno.ENETUNREACH, errno.EHOSTUNREACH,
+                      errno.ETIMEDOUT)
+
+
+def _is_connection_error(e):
+    """Whether the connection to the server couldn't be established.
+    HTTP status and TLS errors don't count
+    """
+    import ssl
+    from six.moves.urllib.error import HTTPError, URLError
+    if isinstance(e, HTTPError):
+        return False
+    if isinstance(e, URLError):
+        e = e.reason
+    if isinstance(e, ssl.SSLError):
+        return False
+    return getattr(e, "errno", None) in _CONNECTION_ERRNOS
+
+
+def _download_with_fallback(url, fpath, expected, **kwargs):
+    """`_download_file` retrying with http if the https server can't be reached
+    """
+    try:
+        print('Downloading ' + url + ' to ' + fpath)
+        return _download_file(url, fpath, expected, **kwargs)
+    except (IOError, OSError) as e:
+        if url[:6] != 'https:' or not _is_connection_error(e):
+            raise
+        url = url.replace('https:', 'http:', 1)
+        logger.warning("Couldn't connect to the https server ({0}). Falling back to the "
+                       "unencrypted download from {1}".format(e, url))
+        return _download_file(url, fpath, expected, **kwargs)
+
+
+def download_url(url, root, filename, md5='', sha256=None, n_segments=4,
+                 min_segment_size=8 * 1024 * 1024, max_retries=3, cache=None,
+                 digest_cache=False):
+    """Download the url to root/filename
+
+    The file is first downloaded to root/filename.part. Interrupted downloads
+    are resumed using range requests (if supported by the server) and large
+    files are downloaded in `n_segments` concurrent segments.
+    The digests are checked while downloading.
+
+    Args:
+      url: url to download
+      root: output directory
+      filename: output file name
+      md5, sha256: expected hex digests
+      n_segments: maximal number of concurrent range requests per file
+      min_segment_size: minimal size of a segment in bytes
+      max_retries: number of times an interrupted download is resumed
+      cache: optional `kipoi_utils.artifact_cache.ArtifactCache`. The file is
+        downloaded into the shared cache (unless already present) and linked
+        to root/filename
+      digest_cache: use the sidecar digest cache (see `file_digests`) to check
+        an already downloaded root/filename without hashing it again
+    """
     root = os.path.expanduser(root)
     fpath = os.path.join(root, filename)
 
     makedir_exist_ok(root)
 
     # downloads file
-    if os.path.isfile(fpath) and check_integrity(fpath, md5):
+    if os.path.isfile(fpath) and check_integrity(fpath, md5, sha256=sha256,
+                                                    cache=digest_cache):
         print('Using downloaded and verified file: ' + fpath)
-    else:
-        try:
-            print('Downloading ' + url + ' to ' + fpath)
-            urllib.request.urlretrieve(
-                url, fpath,
-                reporthook=gen_bar_updater(tqdm(unit='B', unit_scale=True))
-            )
-        except Exception:
-            if url[:5] == 'https':
-                url = url.replace('https:', 'http:')
-                print('Failed download. Trying https -> http instead.'
-                      ' Downloading ' + url + ' to ' + fpath)
-                urllib.request.urlretrieve(
-                    url, fpath,
-                    reporthook=gen_bar_updater(tqdm(unit='B', unit_scale=True))
-                )
+        return
+    kwargs = dict(n_segments=n_segments, min_segment_size=min_segment_size,
+                  max_retries=max_retries)
+    if cache is not None:
+        cache.fetch(url, fpath, md5=md5 or None, sha256=sha256, **kwargs)
+        return
+    expected = dict([(a, d) for a, d in [("md5", md5), ("sha256", sha256)] if d])
+    _download_with_fallback(url, fpath, expected, **kwargs)
+
+
+def download_urls(downloads, root, n_jobs=4, **kwargs):
+    """Download multiple urls in parallel
+
+    Args:
+      downloads: list of tuples (url, filename) or (url, filename, md5)
+      root: output directory
+      n_jobs: number of files downloaded in parallel
+      **kwargs: additional arguments passed to `download_url` (say `digest_cache=True`)
+
+    Returns:
+      list of the downloaded file paths
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    downloads = [tuple(d) for d in downloads]
+    with ThreadPoolExecutor(max(1, n_jobs)) as executor:
+        list(executor.map(lambda d: download_url(d[0], root, *d[1:], **kwargs), downloads))
+    return [os.path.join(os.path.expanduser(root), d[1]) for d in downloads]
@@ -0,0 +1,243 @@
+"""Tools for working with nested data structures (trees) of dictionaries and lists
+
+A tree is split once into a flat list of leaves and a `TreeDef` describing
+its structure. The tree can be rebuilt from the `TreeDef` and a new list of
+leaves:
+
+>>> leaves, treedef = tree_flatten({"a": [1, 2], "b": 3})
+>>> leaves
+[1, 2, 3]
+>>> tree_unflatten(treedef, [x * 10 for x in leaves])
+{'a': [10, 20], 'b': 30}
+
+Mappings are nodes of the tree, as are sequences (except strings and bytes).
+Everything else (numpy arrays, numbers, None, ...) is a leaf.
+"""
+from __future__ import absolute_import
+
+import six
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:  # python 2
+    from collections import Mapping, Sequence
+
+if six.PY2:
+    string_classes = basestring
+else:
+    string_classes = (str, bytes)
+
+
+def is_sequence(x):
+    """Default test for sequence nodes: sequences which are not strings
+    """
+    return isinstance(x, Sequence) and not isinstance(x, string_classes)
+
+
+class TreeDef(object):
+    """Structure of a nested data structure
+
+    The structure is stored as nested tuples: None for a leaf,
+    (keys, children) for a mapping and (None, children) for a sequence.
+    TreeDefs are hashable and compare equal if the structures are the same.
+    """
+
+    def __init__(self, spec, num_leaves):
+        self.spec = spec
+        self.num_leaves = num_leaves
+
+    def __eq__(self, other):
+        return isinstance(other, TreeDef) and self.spec == other.spec
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.spec)
+
+    def __repr__(self):
+        return "TreeDef({0})".format(_spec_repr(self.spec))
+
+    def unflatten(self, leaves, mapping_type=dict, sequence_type=list):
+        """Build the nested data structure from the leaves
+
+        Args:
+          leaves: iterable of leaves ordered as returned by `tree_flatten`
+          mapping_type: type used to construct the mappings
+          sequence_type: type used to construct the sequences
+        """
+        leaves = list(leaves)
+        if len(leaves) != self.num_leaves:
+            raise ValueError("Expected {0} leaves, got {1}".format(self.num_leaves, len(leaves)))
+        return _build(self.spec, iter(leaves), mapping_type, sequence_type)
+
+    def flatten_up_to(self, tree, is_leaf=None, is_sequence=is_sequence, strict=True):
+        """Get the leaves of a tree having this structure
+
+        Faster than `tree_flatten` as the structure doesn't have to be discovered.
+
+        Args:
+          tree: nested data structure
+          is_leaf, is_sequence: see `tree_flatten`
+          strict: if True, raise ValueError if `tree` doesn't have exactly
+            this structure. If False, the leaves are taken by indexing
+            the tree with the known keys (extra keys are ignored).
+        """
+        leaves = []
+        _flatten_up_to(self.spec, tree, leaves, is_leaf, is_sequence, strict)
+        return leaves
+
+
+def _spec_repr(spec):
+    if spec is None:
+        return "*"
+    keys, children = spec
+    if keys is None:
+        return "[" + ", ".join([_spec_repr(c) for c in children]) + "]"
+    return "{" + ", ".join(["{0!r}: {1}".format(k, _spec_repr(c))
+                            for k, c in zip(keys, children)]) + "}"
+
+
+def _is_node(x, is_leaf, is_sequence):
+    if is_leaf is not None and is_leaf(x):
+        return False
+    return isinstance(x, Mapping) or is_sequence(x)
+
+
+def _flatten(tree, leaves, is_leaf, is_sequence):
+    if is_leaf is not None and is_leaf(tree):
+        leaves.append(tree)
+        return None
+    if isinstance(tree, Mapping):
+        keys = tuple(tree)
+        return (keys, tuple([_flatten(tree[k], leaves, is_leaf, is_sequence) for k in keys]))
+    if is_sequence(tree):
+        return (None, tuple([_flatten(x, leaves, is_leaf, is_sequence) for x in tree]))
+    leaves.append(tree)
+    return None
+
+
+def _build(spec, leaves, mapping_type, sequence_type):
+    if spec is None:
+        return next(leaves)
+    keys, children = spec
+    if keys is None:
+        return sequence_type([_build(c, leaves, mapping_type, sequence_type) for c in children])
+    return mapping_type([(k, _build(c, leaves, mapping_type, sequence_type))
+                         for k, c in zip(keys, children)])
+
+
+def _flatten_up_to(spec, tree, leaves, is_leaf, is_sequence, strict):
+    if spec is None:
+        if strict and _is_node(tree, is_leaf, is_sequence):
+            raise ValueError("Expected a leaf, got: {0}".format(type(tree)))
+        leaves.append(tree)
+        return
+    keys, children = spec
+    if strict:
+        if not _is_node(tree, is_leaf, is_sequence) or \
+                isinstance(tree, Mapping) != (keys is not None) or \
+                len(tree) != len(children):
+            raise ValueError("Tree structure doesn't match")
+    if keys is None:
+        values = tree
+    else:
+        try:
+            values = [tree[k] for k in keys]
+        except KeyError as e:
+            if strict:
+                raise ValueError("Tree structure doesn't match. Missing key: {0}".format(e))
+            raise
+    for c, v in zip(children, values):
+        _flatten_up_to(c, v, leaves, is_leaf, is_sequence, strict)
+
+
+def tree_flatten(tree, is_leaf=None, is_sequence=is_sequence):
+    """Split the nested data structure into the list of leaves and its structure
+
+    Args:
+      tree: nested data structure
+      is_leaf: optional function. If it returns True, the object is considered a
+        leaf (also if it is a mapping or a sequence)
+      is_sequence: function determining if an object is a sequence node
+
+    Returns:
+      tuple (leaves, treedef)
+    """
+    leaves = []
+    spec = _flatten(tree, leaves, is_leaf, is_sequence)
+    return leaves, TreeDef(spec, len(leaves))
+
+
+def tree_unflatten(treedef, leaves, mapping_type=dict, sequence_type=list):
+    """Build the nested data structure from the treedef and the leaves
+    """
+    return treedef.unflatten(leaves, mapping_type, sequence_type)
+
+
+def tree_iter_leaves(tree, is_leaf=None, is_sequence=is_sequence):
+    """Iterate over the leaves of the nested data structure (lazily)
+    """
+    stack = [iter([tree])]
+    while stack:
+        for x in stack[-1]:
+            if is_leaf is not None and is_leaf(x):
+                yield x
+            elif isinstance(x, Mapping):
+                stack.append(six.itervalues(x))
+                break
+            elif is_sequence(x):
+                stack.append(iter(x))
+                break
+            else:
+                yield x
+        else:
+            stack.pop()
+
+
+def tree_leaves(tree, is_leaf=None, is_sequence=is_sequence):
+    """List of the leaves of the nested data structure
+    """
+    return tree_flatten(tree, is_leaf, is_sequence)[0]
+
+
+def _leaves_with_treedef(tree, treedef, is_leaf, is_sequence):
+    """Flatten the tree re-using the treedef if the structure matches
+    """
+    if treedef is not None:
+        try:
+            return treedef.flatten_up_to(tree, is_leaf, is_sequence), treedef
+        except ValueError:
+            pass
+    return tree_flatten(tree, is_leaf, is_sequence)
+
+
+def tree_map(fn, tree, is_leaf=None, is_sequence=is_sequence,
+             mapping_type=dict, sequence_type=list, treedef=None):
+    """Map a function to each leaf of a nested data structure
+
+    Args:
+      fn: function to apply to each leaf
+      tree: nested data structure
+      is_leaf, is_sequence: see `tree_flatten`
+      mapping_type, sequence_type: see `TreeDef.unflatten`
+      treedef: known structure of the tree (say from a previous batch).
+        If the tree doesn't have this structure, it is re-discovered.
+    """
+    leaves, treedef = _leaves_with_treedef(tree, treedef, is_leaf, is_sequence)
+    return treedef.unflatten([fn(x) for x in leaves], mapping_type, sequence_type)
+
+
+def tree_map_many(fn, trees, is_leaf=None, is_sequence=is_sequence,
+                  mapping_type=dict, sequence_type=list):
+    """Map a function to each leaf of many nested data structures (say batches)
+
+    The structure is discovered only once and then re-used
+    for all the trees having the same structure.
+
+    Returns:
+      generator of mapped trees
+    """
+    treedef = None
+    for tree in trees:
+        leaves, treedef = _leaves_with_treedef(tree, treedef, is_leaf, is_sequence)
+        yield treedef.unflatten([fn(x) for x in leaves], mapping_type, sequence_type)
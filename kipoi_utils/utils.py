@@ -7,24 +7,28 @@ import os.path
 import hashlib
 import errno
 # import psutil
-from tqdm import tqdm
-import imp
 import six
 import pickle
 import glob
-import os
 import sys
 import subprocess
 from subprocess import Popen, PIPE, STDOUT
-import numpy as np
+import copy
+import collections
 import functools
-import yaml
 from collections import OrderedDict
 from contextlib import contextmanager
 import inspect
 import logging
-import collections
+import threading
+import time
 import ast
+import weakref
+from kipoi_utils.tree import tree_flatten, tree_map, tree_iter_leaves, Mapping
+
+# heavy modules (numpy, yaml, tqdm) are imported in the functions using them
+# to keep `import kipoi_utils` fast
+
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -45,6 +49,10 @@ logger.addHandler(logging.NullHandler())
 #         proc.kill()
 
 
+# number of output lines shown in the _call_command error message
+_ERROR_TAIL_LINES = 1000
+
+
 def _call_command(cmd, extra_args, use_stdout=False,
                   return_logs_with_stdout=False, dry_run=False, **kwargs):
     """
@@ -63,7 +71,8 @@ def _call_command(cmd, extra_args, use_stdout=False,
         if use_stdout:
             p = Popen(cmd_list, stdout=PIPE, universal_newlines=True, **kwargs)
             # Poll process for new output until finished
-            error_out = []
+            # (only the last lines are kept for the error message)
+            error_out = collections.deque(maxlen=_ERROR_TAIL_LINES)
             if return_logs_with_stdout:
                 out = []
             for stdout_line in iter(p.stdout.readline, ""):
@@ -125,10 +134,18 @@ class add_sys_path(object):
         sys.path.remove(self.path)
 
 
-def load_obj(obj_import):
+def load_obj(obj_import, cache=False):
     """Load object from string
+
+    Args:
+      obj_import: object description: module.submodule.Object
+      cache: if True and the module is a python source file, use the
+        module cache of `load_module` (the file is not re-executed unless
+        it changed)
     """
     import importlib
+    import importlib.machinery
+    import importlib.util
     if "." not in obj_import:
         raise ValueError("Object descripiton needs to be of the form: "
                          "module.submodule.Object. currently lacking a dot (.)")
@@ -138,66 +155,132 @@ def load_obj(obj_import):
         # manually run the import (don't rely on importlib.import_module)
         # the latter was caching modules which caused trouble when
         # loading multiple modules of the same kind
-        fp, pathname, description = imp.find_module(module_name)
-        e = None
+        spec = importlib.machinery.PathFinder.find_spec(module_name)
         try:
-            module = imp.load_module(module_name, fp, pathname, description)
+            if spec is None:
+                # built-in or frozen module
+                module = importlib.import_module(module_name)
+            elif (cache and isinstance(spec.loader, importlib.machinery.SourceFileLoader) and
+                  spec.submodule_search_locations is None):
+                module = load_module(spec.origin, module_name, cache=True)
+                # register the module as the uncached path does (required for pickling)
+                sys.modules[module_name] = module
+            else:
+                module = sys.modules.get(module_name)
+                if module is None:
+                    module = importlib.util.module_from_spec(spec)
+                    sys.modules[module_name] = module
+                else:
+                    # re-execute in the existing module object (as imp.load_module did)
+                    module.__spec__ = spec
+                    module.__loader__ = spec.loader
+                    module.__file__ = spec.origin
+                    if spec.submodule_search_locations is not None:
+                        module.__path__ = spec.submodule_search_locations
+                spec.loader.exec_module(module)
             obj = rgetattr(module, obj_name)  # recursively get the module
         except Exception as e:
-            if fp:
-                fp.close()
             raise ImportError("object {} couldn't be imported. Error {}".format(obj_import, str(e)))
-        finally:
-            # Since we may exit via an exception, close fp explicitly.
-            if fp:
-                fp.close()
-        # module = importlib.import_module(module_name)
     return obj
 
 
-def load_module(path, module_name=None):
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class _FileCache(object):
+    """Cache of values computed from files, invalidated when the files change
+
+    Entries are keyed by the absolute path and an extra key. A cached value is
+    re-used while the file's mtime and size didn't change. If they changed
+    (or if the file was modified too recently for the mtime to be reliable),
+    the content hash decides.
+
+    Args:
+      maxsize: maximal number of entries. The least recently used entries
+        are evicted first. None for an unbounded cache
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        # key -> [(mtime, size), time of the stat, sha1 digest, value]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, path, load_fn, key=None):
+        """Get the cached `load_fn(path)`
+        """
+        cache_key = (os.path.abspath(path), key)
+        st = os.stat(path)
+        stat_key = (st.st_mtime, st.st_size)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+        if entry is not None:
+            # file modified in the same second as checked -> mtime not conclusive
+            racy = stat_key[0] >= entry[1] - 1
+            if entry[0] == stat_key and not racy:
+                self._set(cache_key, entry)
+                return entry[3]
+            digest = _file_digest(path)
+            if digest == entry[2]:
+                self._set(cache_key, [stat_key, now, digest, entry[3]])
+                return entry[3]
+        else:
+            digest = _file_digest(path)
+        logger.debug("file cache miss: {0}".format(path))
+        value = load_fn(path)
+        self._set(cache_key, [stat_key, now, digest, value])
+        return value
+
+    def _set(self, cache_key, entry):
+        with self._lock:
+            self._entries.pop(cache_key, None)
+            self._entries[cache_key] = entry
+            if self.maxsize is not None:
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+
+# modules loaded with load_module(..., cache=True)
+_MODULE_CACHE = _FileCache()
+
+
+def clear_module_cache():
+    """Clear the module cache used by `load_module(..., cache=True)`
+    """
+    _MODULE_CACHE.clear()
+
+
+def load_module(path, module_name=None, cache=False):
     """Load python module from file
 
     Args:
        path: python file path
        module_name: import as `module_name` name. If none, use `path[:-3]`
+       cache: if True, return the already executed module if the file was
+         loaded before (with the same `module_name`) and didn't change since.
+         Different files always give different module objects.
     """
     assert path.endswith(".py")
     if module_name is None:
         module_name = os.path.basename(path)[:-3]  # omit .py
+    if cache:
+        return _MODULE_CACHE.get(path, lambda p: load_module(p, module_name), key=module_name)
 
     logger.debug("loading module: {0} as {1}".format(path, module_name))
-    if sys.version_info[0] == 2:
-        import imp
-        # add the directory to system's path - allows loading submodules
-        with add_sys_path(os.path.join(os.path.dirname(module_name))):
-            module = imp.load_source(module_name, path)
-    elif sys.version_info[0] == 3:
-        """
-        import importlib.machinery
-        loader = importlib.machinery.SourceFileLoader
-        handle = loader.load_module
-        """
-        if sys.version_info[1] == 4:
-            # way 1 (=python3.4)
-            from importlib.machinery import SourceFileLoader
-            module = SourceFileLoader(module_name, path).load_module()
-        if sys.version_info[1] >= 5:
-            # way 2 (>=python3.5)
-            import importlib.util
-
-            # alternative
-            import types
-            loader = importlib.machinery.SourceFileLoader(module_name, path)
-            module = types.ModuleType(loader.name)
-            loader.exec_module(module)
-
-            # module_spec_ = importlib.util.spec_from_file_location(module_name, path)
-            # module = importlib.util.module_from_spec(module_spec_)
-            # module_spec_.loader.exec_module(module)
-        else:
-            raise RuntimeError(
-                'dynamic loading of preprocessor module is not implemented for python3!')
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
     return module
 
 
@@ -229,41 +312,200 @@ def pip_install_requirements(requirements_fname):
         logger.info('requirements.txt not found under {}'.format(requirements_fname))
 
 
-def compare_numpy_dict(a, b, exact=True, decimal=7):
+class LeafDiff(object):
+    """Difference between two leaves (or nodes) of nested data structures
+
+    Attributes:
+      path: tuple of keys / indices leading to the leaf
+      reason: 'type', 'keys', 'length', 'shape' or 'value'
+      message: human readable description
+      n_mismatch: number of mismatching elements (reason 'value')
+      n_total: number of compared elements (reason 'value')
+      max_abs_err: maximal absolute difference (numeric values)
+      max_rel_err: maximal relative difference w.r.t. b (numeric values)
     """
-    Compare two recursive numpy dictionaries or lists
+
+    def __init__(self, path, reason, message, n_mismatch=None, n_total=None,
+                 max_abs_err=None, max_rel_err=None):
+        self.path = path
+        self.reason = reason
+        self.message = message
+        self.n_mismatch = n_mismatch
+        self.n_total = n_total
+        self.max_abs_err = max_abs_err
+        self.max_rel_err = max_rel_err
+
+    def __repr__(self):
+        return "LeafDiff(path={0!r}, reason={1!r}, message={2!r})".format(self.path, self.reason,
+                                                                        self.message)
+
+
+class DiffReport(object):
+    """Result of `diff_numpy_dict`. Evaluates to True if the structures are equal
+
+    Attributes:
+      diffs: list of LeafDiff
+      complete: False if the comparison stopped at the first difference
     """
-    if type(a) != type(b) and type(a) != np.ndarray and type(b) != np.ndarray:
-        return False
 
-    # Compare two dictionaries
-    if type(a) == dict and type(b) == dict:
-        if not a.keys() == b.keys():
-            return False
-        for key in a.keys():
-            res = compare_numpy_dict(a[key], b[key], exact)
-            if not res:
-                print("false for key = ", key)
-                return False
-        return True
-
-    # compare two lists
-    if type(a) == list and type(b) == list:
-        assert len(a) == len(b)
-        return all([compare_numpy_dict(a[i], b[i], exact=exact)
-                    for i in range(len(a))])
-
-    # if type(a) == np.ndarray and type(b) == np.ndarray:
-    if type(a) == np.ndarray or type(b) == np.ndarray:
-        if exact:
-            return (a == b).all()
+    def __init__(self, diffs, complete=True):
+        self.diffs = diffs
+        self.complete = complete
+
+    @property
+    def equal(self):
+        return not self.diffs
+
+    def __bool__(self):
+        return self.equal
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        if self.equal:
+            return "equal"
+        return "\n".join(["{0}: {1}".format("/".join([str(p) for p in d.path]) or "<root>",
+                                             d.message)
+                           for d in self.diffs])
+
+    def __repr__(self):
+        return "DiffReport(n_diffs={0}, complete={1})".format(len(self.diffs), self.complete)
+
+
+def _iter_blocks(x, chunk_size):
+    """Iterate over flat blocks of an array with at most ~chunk_size elements
+    (without copying contiguous arrays)
+    """
+    if x.ndim == 0:
+        yield x.reshape(1)
+        return
+    row_size = max(1, x.size // max(1, len(x)))
+    n_rows = max(1, chunk_size // row_size)
+    for i in range(0, len(x), n_rows):
+        yield x[i:i + n_rows].reshape(-1)
+
+
+def _compare_arrays(path, a, b, rtol, atol, equal_nan, chunk_size, stop_early):
+    """Compare two arrays chunk by chunk. Returns None if they are equal, else LeafDiff
+    """
+    import numpy as np
+    a = np.asanyarray(a)
+    b = np.asanyarray(b)
+    if a.shape != b.shape:
+        return LeafDiff(path, "shape", "shapes differ: {0} != {1}".format(a.shape, b.shape))
+    numeric = a.dtype.kind in "biufc" and b.dtype.kind in "biufc"
+    tolerance = numeric and (rtol or atol)
+    check_nan = equal_nan and (a.dtype.kind in "fc" or b.dtype.kind in "fc")
+    n_mismatch = 0
+    n_total = 0
+    max_abs_err = 0.0 if numeric else None
+    max_rel_err = 0.0 if numeric else None
+    for x, y in zip(_iter_blocks(a, chunk_size), _iter_blocks(b, chunk_size)):
+        ok = np.asarray(x == y)
+        if ok.shape != x.shape:
+            # not comparable element-wise
+            ok = np.zeros(x.shape, dtype=bool)
+        if numeric and not ok.all():
+            if x.dtype.kind in "bui" or y.dtype.kind in "bui":
+                # avoid integer overflows
+                x, y = x.astype(np.float64), y.astype(np.float64)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                abs_err = np.abs(x - y)
+                if tolerance:
+                    ok |= abs_err <= atol + rtol * np.abs(y)
+                if check_nan:
+                    ok |= np.isnan(x) & np.isnan(y)
+                finite = np.isfinite(abs_err) & ~ok
+                if finite.any():
+                    max_abs_err = max(max_abs_err, float(abs_err[finite].max()))
+                    rel_err = abs_err[finite] / np.abs(y[finite])
+                    max_rel_err = max(max_rel_err, float(rel_err.max()))
+        n_bad = ok.size - int(np.count_nonzero(ok))
+        n_mismatch += n_bad
+        n_total += ok.size
+        if n_bad and stop_early:
+            break
+    if not n_mismatch:
+        return None
+    message = "{0} / {1} elements differ".format(n_mismatch, n_total)
+    if numeric:
+        message += " (max abs err: {0:g}, max rel err: {1:g})".format(max_abs_err, max_rel_err)
+    return LeafDiff(path, "value", message, n_mismatch, n_total, max_abs_err, max_rel_err)
+
+
+def diff_numpy_dict(a, b, rtol=0, atol=0, equal_nan=False, chunk_size=1 << 20, stop_early=False):
+    """Compare two nested structures of dictionaries / lists with numpy arrays as leaves
+
+    Arrays are compared in chunks of `chunk_size` elements, so memory-mapped
+    arrays are not loaded completely into memory.
+
+    Args:
+      a, b: nested data structures
+      rtol, atol: relative and absolute tolerance for numeric values:
+        `abs(a - b) <= atol + rtol * abs(b)`
+      equal_nan: if True, NaNs at the same position are considered equal
+      chunk_size: number of array elements compared at once
+      stop_early: if True, stop at the first difference
+
+    Returns:
+      DiffReport
+    """
+    import numpy as np
+    diffs = []
+    stack = [((), a, b)]
+    while stack:
+        path, x, y = stack.pop()
+        diff = None
+        is_array = isinstance(x, np.ndarray) or isinstance(y, np.ndarray)
+        if not is_array and isinstance(x, Mapping) and isinstance(y, Mapping):
+            if set(x) != set(y):
+                diff = LeafDiff(path, "keys", "keys differ. Only in a: {0}, only in b: {1}".format(
+                    sorted([str(k) for k in set(x) - set(y)]),
+                    sorted([str(k) for k in set(y) - set(x)])))
+            stack.extend(reversed([(path + (k,), x[k], y[k]) for k in x if k in y]))
+        elif not is_array and isinstance(x, (list, tuple)) and isinstance(y, (list, tuple)) \
+                and type(x) == type(y):
+            if len(x) != len(y):
+                diff = LeafDiff(path, "length", "lengths differ: {0} != {1}".format(len(x), len(y)))
+            else:
+                stack.extend(reversed([(path + (i,), xi, yi) for i, (xi, yi) in enumerate(zip(x, y))]))
+        elif not is_array and type(x) != type(y):
+            diff = LeafDiff(path, "type", "types differ: {0} != {1}".format(type(x), type(y)))
+        elif x is None and y is None:
+            pass
         else:
-            return np.testing.assert_almost_equal(a, b, decimal=decimal)
+            diff = _compare_arrays(path, x, y, rtol, atol, equal_nan, chunk_size, stop_early)
+        if diff is not None:
+            diffs.append(diff)
+            if stop_early:
+                return DiffReport(diffs, complete=False)
+    return DiffReport(diffs)
 
-    if a is None and b is None:
-        return True
 
-    raise NotImplementedError
+def compare_numpy_dict(a, b, exact=True, decimal=7, rtol=None, atol=None, equal_nan=None):
+    """
+    Compare two recursive numpy dictionaries or lists
+
+    Args:
+      a, b: nested data structures
+      exact: if True, the values have to be exactly equal. Otherwise, they
+        have to be equal up to `decimal` decimals (as `np.testing.assert_almost_equal`)
+      rtol, atol: relative and absolute tolerance (override exact and decimal)
+      equal_nan: if True, NaNs at the same position are considered equal.
+        Default: False if exact else True
+
+    Returns:
+      bool. See `diff_numpy_dict` for a detailed comparison
+    """
+    if rtol is None and atol is None:
+        rtol, atol = 0, (0 if exact else 1.5 * 10 ** (-decimal))
+    if equal_nan is None:
+        equal_nan = not exact
+    report = diff_numpy_dict(a, b, rtol=rtol or 0, atol=atol or 0, equal_nan=equal_nan,
+                             stop_early=True)
+    if not report.equal:
+        logger.debug("Objects differ: {0}".format(report))
+    return report.equal
 
 
 def parse_json_file_str(extractor_args):
@@ -273,13 +515,12 @@ def parse_json_file_str(extractor_args):
     extractor_args = extractor_args.strip("'").strip('"')
     if extractor_args.startswith("{") or extractor_args.endswith("}"):
         logger.debug("Parsing the extractor_args as a json string")
-        return yaml.load(extractor_args, Loader=yaml.FullLoader)
+        return _yaml_full_load(extractor_args)
     else:
         if not os.path.exists(extractor_args):
             raise ValueError("File path: {0} doesn't exist".format(extractor_args))
         logger.debug("Parsing the extractor_args as a json file path")
-        with open(extractor_args, "r", encoding="utf-8") as f:
-            return yaml.load(f.read(), Loader=yaml.FullLoader)
+        return load_yaml_file(extractor_args, _yaml_full_load)
 
 
 def parse_json_file_str_or_arglist(dataloader_args, parser=None):
@@ -334,29 +575,151 @@ def parse_json_file_str_or_arglist(dataloader_args, parser=None):
     return kwargs
 
 
+def _yaml_cls(name):
+    """Get the libyaml (C) based version of the yaml Loader/Dumper class `name`
+    if available (say CFullLoader for FullLoader)
+    """
+    import yaml
+    return getattr(yaml, "C" + name, None) or getattr(yaml, name)
+
+
+def _yaml_load(text, loader_name):
+    """yaml.load using the libyaml-based loader if available
+    """
+    import yaml
+    loader = _yaml_cls(loader_name)
+    try:
+        return yaml.load(text, Loader=loader)
+    except yaml.YAMLError:
+        if loader is getattr(yaml, loader_name):
+            raise
+        # libyaml is stricter in a few corner cases. Use the pure-python loader
+        return yaml.load(text, Loader=getattr(yaml, loader_name))
+
+
+def _yaml_full_load(text):
+    return _yaml_load(text, "FullLoader")
+
+
+# parsed yaml files
+_YAML_CACHE = _FileCache(maxsize=256)
+
+
+def clear_yaml_cache():
+    """Clear the cache of parsed yaml files
+    """
+    _YAML_CACHE.clear()
+
+
+def load_yaml_file(path, parse_fn, cache=True):
+    """Parse a (utf-8 encoded) yaml file with `parse_fn`
+
+    Args:
+      path: file path
+      parse_fn: function parsing the file content (string)
+      cache: if True, re-use the parsed object if the same file was already
+        parsed with `parse_fn` and didn't change since. A deep copy
+        is returned, so the results can be safely modified
+    """
+    def parse(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return parse_fn(f.read())
+    if not cache:
+        return parse(path)
+    return copy.deepcopy(_YAML_CACHE.get(path, parse, key=parse_fn))
+
+
 # https://stackoverflow.com/questions/5121931/in-python-how-can-you-load-yaml-mappings-as-ordereddicts
 
+# Loader -> OrderedLoader
+_ORDERED_LOADERS = {}
+
+
+def _ordered_loader(Loader):
+    if Loader not in _ORDERED_LOADERS:
+        import yaml
 
-def yaml_ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
-    class OrderedLoader(Loader):
-        pass
+        class OrderedLoader(Loader):
+            pass
+
+        def dict_constructor(loader, node):
+            return OrderedDict(loader.construct_pairs(node))
+
+        _mapping_tag = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
+        OrderedLoader.add_constructor(_mapping_tag, dict_constructor)
+        _ORDERED_LOADERS[Loader] = OrderedLoader
+    return _ORDERED_LOADERS[Loader]
+
+
+def yaml_ordered_load(stream, Loader=None, object_pairs_hook=OrderedDict):
+    """Load yaml with mappings as OrderedDicts
+
+    Args:
+      stream: yaml string or file
+      Loader: base yaml loader class. By default yaml.Loader (its libyaml
+        version yaml.CLoader if available)
+    """
+    import yaml
+    if Loader is not None:
+        return yaml.load(stream, _ordered_loader(Loader))
+    if hasattr(stream, "read"):
+        # read the stream to be able to fall back to the pure-python loader
+        stream = stream.read()
+    try:
+        return yaml.load(stream, _ordered_loader(_yaml_cls("Loader")))
+    except yaml.YAMLError:
+        if _yaml_cls("Loader") is yaml.Loader:
+            raise
+        return yaml.load(stream, _ordered_loader(yaml.Loader))
+
+
+# Dumper -> OrderedDumper class
+_ORDERED_DUMPERS = {}
+
+
+def _ordered_dumper(Dumper):
+    """Get the (cached) subclass of Dumper representing OrderedDicts as ordered mappings
+    """
+    if Dumper not in _ORDERED_DUMPERS:
+        class OrderedDumper(Dumper):
+            pass
 
-    def dict_constructor(loader, node):
-        return OrderedDict(loader.construct_pairs(node))
+        def dict_representer(dumper, data):
+            return dumper.represent_dict(six.iteritems(data))
+        OrderedDumper.add_representer(OrderedDict, dict_representer)
+        _ORDERED_DUMPERS[Dumper] = OrderedDumper
+    return _ORDERED_DUMPERS[Dumper]
 
-    _mapping_tag = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
-    OrderedLoader.add_constructor(_mapping_tag, dict_constructor)
-    return yaml.load(stream, OrderedLoader)
 
+def yaml_ordered_dump(data, stream=None, Dumper=None, **kwds):
+    """Dump yaml with OrderedDicts as ordered mappings
 
-def yaml_ordered_dump(data, stream=None, Dumper=yaml.Dumper, **kwds):
-    class OrderedDumper(Dumper):
-        pass
+    Args:
+      data: object to dump
+      stream: output stream. If None, the yaml string is returned
+      Dumper: base yaml dumper class. By default yaml.Dumper (its libyaml
+        version yaml.CDumper if available for mappings and sequences)
+    """
+    import yaml
+    if Dumper is None:
+        # yaml.CDumper omits the document end marker ('...') for scalars
+        Dumper = _yaml_cls("Dumper") if isinstance(data, (Mapping, list)) else yaml.Dumper
+    return yaml.dump(data, stream, _ordered_dumper(Dumper), **kwds)
+
+
+def yaml_ordered_dump_all(documents, stream=None, Dumper=None, **kwds):
+    """Dump many documents into a single yaml stream (separated by '---')
 
-    def dict_representer(dumper, data):
-        return dumper.represent_dict(six.iteritems(data))
-    OrderedDumper.add_representer(OrderedDict, dict_representer)
-    return yaml.dump(data, stream, OrderedDumper, **kwds)
+    The documents are written one by one, hence `documents` can be a generator.
+
+    Args:
+      documents: iterable of objects to dump
+      stream: output stream. If None, the yaml string is returned
+      Dumper: base yaml dumper class. By default yaml.CDumper if available
+    """
+    import yaml
+    return yaml.dump_all(documents, stream, _ordered_dumper(Dumper or _yaml_cls("Dumper")),
+                         **kwds)
 
 
 @contextmanager
@@ -371,39 +734,111 @@ def cd(newdir):
         os.chdir(prevdir)
 
 
-def getargs(x):
-    """Get function arguments
+# fn_cls -> {name: (token, value)} (see `_cached_introspection`)
+_INTROSPECTION_CACHE = weakref.WeakKeyDictionary()
+# fn_cls -> {frozen kwargs: (token, weakref to the overridden fn_cls)}
+_OVERRIDE_CACHE = weakref.WeakKeyDictionary()
+
+
+def _weak(obj):
+    """Weak reference to obj if supported (the cache must not keep the classes alive)
     """
+    try:
+        return weakref.ref(obj)
+    except TypeError:
+        # None, builtin slot wrappers, code objects
+        return obj
+
+
+def _introspection_token(fn_cls):
+    """Objects determining the signature of the function / class.
+    If any of them is replaced, the cached introspection results are invalid
+
+    Classes and functions are referenced weakly: `__mro__` contains the class
+    itself and `__init__` may reference it (`super()` closure cell).
+    """
+    if isinstance(fn_cls, type):
+        return ((_weak(fn_cls.__dict__.get("__init__")), _weak(fn_cls.__init__)) +
+                tuple([_weak(c) for c in fn_cls.__mro__]))
+    return (fn_cls.__code__, fn_cls.__dict__.get("__signature__"))
+
+
+def _deref(x):
+    return x() if isinstance(x, weakref.ref) else x
+
+
+def _same_token(a, b):
+    return len(a) == len(b) and all([_deref(x) is _deref(y) for x, y in zip(a, b)])
+
+
+def _cacheable(fn_cls):
+    return inspect.isfunction(fn_cls) or inspect.isclass(fn_cls)
+
+
+def _cached_introspection(fn_cls, name, compute):
+    """Cache `compute(fn_cls)` for functions and classes
+
+    The cache holds only weak references to fn_cls.
+    """
+    if not _cacheable(fn_cls):
+        return compute(fn_cls)
+    token = _introspection_token(fn_cls)
+    entries = _INTROSPECTION_CACHE.get(fn_cls)
+    if entries is None:
+        entries = {}
+        _INTROSPECTION_CACHE[fn_cls] = entries
+    elif name in entries and _same_token(entries[name][0], token):
+        return entries[name][1]
+    value = compute(fn_cls)
+    entries[name] = (token, value)
+    return value
+
+
+def _getargs(x):
     if sys.version_info[0] == 2:
         if inspect.isfunction(x):
-            return set(inspect.getargspec(x).args)
+            return frozenset(inspect.getargspec(x).args)
         else:
             # skip the self parameter
-            return set(inspect.getargspec(x.__init__).args[1:])
+            return frozenset(inspect.getargspec(x.__init__).args[1:])
     else:
-        return set(inspect.signature(x).parameters.keys())
+        return frozenset(inspect.signature(x).parameters.keys())
 
 
-def _get_arg_name_values(fn_cls):
-    """Get the function/class default argument list (and their values)
-
-    Args:
-      fn_cls: function or a class. In the class case,
-          arguments for  `__init__` are returned
+def getargs(x):
+    """Get function arguments
     """
+    return set(_cached_introspection(x, "getargs", _getargs))
+
+
+def _get_arg_names(fn_cls):
     if sys.version_info[0] == 2:
         getargspec = inspect.getargspec
     else:
         getargspec = inspect.getfullargspec
 
     if inspect.isfunction(fn_cls):
-        args = getargspec(fn_cls).args
-        values = fn_cls.__defaults__
+        return tuple(getargspec(fn_cls).args)
     else:
         # skip the self parameter
-        args = getargspec(fn_cls.__init__).args[1:]
-        values = fn_cls.__init__.__defaults__
-    return args, values
+        return tuple(getargspec(fn_cls.__init__).args[1:])
+
+
+def _get_defaults(fn_cls):
+    if inspect.isfunction(fn_cls):
+        return fn_cls.__defaults__
+    return fn_cls.__init__.__defaults__
+
+
+def _get_arg_name_values(fn_cls):
+    """Get the function/class default argument list (and their values)
+
+    Args:
+      fn_cls: function or a class. In the class case,
+          arguments for  `__init__` are returned
+    """
+    args = _cached_introspection(fn_cls, "arg_names", _get_arg_names)
+    return list(args), _get_defaults(fn_cls)
 
 
 def default_kwargs(fn_cls):
@@ -438,12 +873,38 @@ def override_default_kwargs(fn_cls, kwargs):
     """Override default kwargs in fn_cls. It keeps the original
     function / class intact.
 
+    The overridden functions / classes are cached: calling it again with the same
+    fn_cls and kwargs returns the same object.
+
     # Arguments
       fn_cls: function or a class
 
     # Returns
       new function or a class with the original attributes overriden
     """
+    try:
+        key = frozenset([(k, type(v), v) for k, v in six.iteritems(kwargs)])
+    except TypeError:
+        # unhashable values
+        key = None
+    if key is None or not _cacheable(fn_cls):
+        return _override_default_kwargs(fn_cls, kwargs)
+
+    token = _introspection_token(fn_cls) + (_get_defaults(fn_cls),)
+    entries = _OVERRIDE_CACHE.get(fn_cls)
+    if entries is None:
+        entries = {}
+        _OVERRIDE_CACHE[fn_cls] = entries
+    elif key in entries and _same_token(entries[key][0], token):
+        out = entries[key][1]()
+        if out is not None:
+            return out
+    out = _override_default_kwargs(fn_cls, kwargs)
+    entries[key] = (token, weakref.ref(out))
+    return out
+
+
+def _override_default_kwargs(fn_cls, kwargs):
     if inspect.isfunction(fn_cls):
         # make a copy of the object
         fn_cls = copy_func(fn_cls)
@@ -485,9 +946,15 @@ def override_default_kwargs(fn_cls, kwargs):
     return fn_cls
 
 
-def read_yaml(path):
-    with open(path, "r", encoding="utf-8") as f:
-        return yaml.load(f, Loader=yaml.FullLoader)
+def read_yaml(path, cache=True):
+    """Read a yaml file
+
+    Args:
+      path: file path
+      cache: re-use the parsed yaml if the file didn't change since it was
+        last read (see `load_yaml_file`)
+    """
+    return load_yaml_file(path, _yaml_full_load, cache=cache)
 
 
 def cmd_exists(cmd):
@@ -524,10 +991,188 @@ def get_file_path(file_dir, basename, extensions=[".yml", ".yaml"],
         return None
 
 
-def du(path):
-    """disk usage in human readable format (e.g. '2,1GB')"""
+# directory path -> [mtime, time of the scan, (disk usage, apparent size)
+#                     of the non-hardlinked files, hardlinked files, sub-directories]
+_DU_CACHE = {}
+_DU_CACHE_LOCK = threading.Lock()
+
+
+def clear_du_cache():
+    """Clear the directory cache used by `disk_usage`
+    """
+    with _DU_CACHE_LOCK:
+        _DU_CACHE.clear()
+
+
+def _stat_sizes(st):
+    """(disk usage, apparent size) of a stat result"""
+    blocks = getattr(st, "st_blocks", None)
+    return (st.st_size if blocks is None else blocks * 512), st.st_size
+
+
+def _scan_dir_stat(path):
+    """List the sub-directories and the lstat of the other entries of a directory
+    """
+    dirs, stats = [], []
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                else:
+                    stats.append(entry.stat(follow_symlinks=False))
+            except OSError:
+                pass
+    else:
+        import stat
+        for name in os.listdir(path):
+            try:
+                st = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(name)
+            else:
+                stats.append(st)
+    return dirs, stats
+
+
+def _du_entry(path, cache):
+    """Get the cache entry of a directory (see `_DU_CACHE`)
+
+    The directory is only scanned if its mtime changed since the
+    previous scan. Returns None if the directory can't be read.
+    """
+    try:
+        dir_stat = os.lstat(path)
+    except OSError:
+        return None
+    mtime = dir_stat.st_mtime
+    if cache:
+        entry = _DU_CACHE.get(path)
+        # directory modified in the same second as scanned -> mtime not conclusive
+        if entry is not None and entry[0] == mtime and mtime < entry[1] - 1:
+            return entry
+    scanned_at = time.time()
+    try:
+        dirs, stats = _scan_dir_stat(path)
+    except OSError:
+        return None
+    disk, apparent = _stat_sizes(dir_stat)
+    linked = []
+    for st in stats:
+        sizes = _stat_sizes(st)
+        if st.st_nlink > 1:
+            linked.append((st.st_dev, st.st_ino) + sizes)
+        else:
+            disk += sizes[0]
+            apparent += sizes[1]
+    entry = [mtime, scanned_at, (disk, apparent), linked, dirs]
+    if cache:
+        with _DU_CACHE_LOCK:
+            _DU_CACHE[path] = entry
+    return entry
+
+
+def _du_walk(path, cache, root_entry=None):
+    """Sum the sizes of the directory tree under `path`
+
+    Returns:
+      tuple (disk usage, apparent size, {(dev, inode): (disk usage, apparent size)}
+      of the hardlinked files)
+    """
+    disk, apparent = 0, 0
+    linked = {}
+    stack = [(path, root_entry)]
+    while stack:
+        dir_path, entry = stack.pop()
+        if entry is None:
+            entry = _du_entry(dir_path, cache)
+            if entry is None:
+                continue
+        disk += entry[2][0]
+        apparent += entry[2][1]
+        for dev, ino, d, a in entry[3]:
+            linked[(dev, ino)] = (d, a)
+        stack.extend([(os.path.join(dir_path, d), None) for d in entry[4]])
+    return disk, apparent, linked
+
+
+def disk_usage(path, apparent_size=False, n_jobs=1, cache=False):
+    """Disk usage of a file or a directory tree in bytes (as `du -s`)
+
+    Symbolic links are not followed and hardlinked files are counted once.
+
+    Args:
+      path: file or directory path
+      apparent_size: if True, sum the file sizes instead of the allocated disk space
+      n_jobs: number of threads used to traverse the top-level
+        sub-directories in parallel
+      cache: if True, the directory listings are cached and a directory is
+        only re-scanned if its mtime changed. Note: changing the content of a
+        file doesn't change the mtime of its directory, so the cached size
+        can be stale. Disabled by default
+
+    Returns:
+      int: number of bytes
+    """
+    path = os.path.abspath(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        return _stat_sizes(os.lstat(path))[1 if apparent_size else 0]
+    root_entry = _du_entry(path, cache)
+    if root_entry is None:
+        raise OSError(errno.EACCES, "Unable to read the directory", path)
+
+    if n_jobs is not None and n_jobs > 1 and len(root_entry[4]) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        # traverse the top-level sub-directories in parallel
+        with ThreadPoolExecutor(n_jobs) as executor:
+            results = list(executor.map(lambda d: _du_walk(os.path.join(path, d), cache),
+                                        root_entry[4]))
+        disk, apparent = root_entry[2]
+        linked = dict([((dev, ino), (d, a)) for dev, ino, d, a in root_entry[3]])
+        for d, a, sub_linked in results:
+            disk += d
+            apparent += a
+            linked.update(sub_linked)
+    else:
+        disk, apparent, linked = _du_walk(path, cache, root_entry)
+    for d, a in six.itervalues(linked):
+        disk += d
+        apparent += a
+    return apparent if apparent_size else disk
+
+
+def format_size(nbytes):
+    """Human-readable size as printed by `du -h` (e.g. '2.1G', '12K' or '512')
+
+    The size is rounded up, with one decimal for values below 10.
+    """
+    import math
+    if nbytes < 1024:
+        return str(int(nbytes))
+    value = float(nbytes)
+    for unit in "KMGTPEZY":
+        value /= 1024
+        if value < 10:
+            rounded = math.ceil(value * 10) / 10
+            if rounded < 10:
+                return "{0:.1f}{1}".format(rounded, unit)
+            return "10" + unit
+        rounded = int(math.ceil(value))
+        if rounded < 1024 or unit == "Y":
+            return "{0}{1}".format(rounded, unit)
+
+
+def du(path, n_jobs=1, cache=False):
+    """disk usage in human readable format (e.g. '2.1G'). "NA" if not available
+
+    Args:
+      path: file or directory path
+      n_jobs, cache: see `disk_usage`
+    """
     try:
-        return subprocess.check_output(['du', '-sh', path]).split()[0].decode('utf-8')
+        return format_size(disk_usage(path, n_jobs=n_jobs, cache=cache))
     except Exception:
         return "NA"
 
@@ -574,20 +1219,172 @@ def merge_dicts(x, y):
     return z
 
 
-def list_files_recursively(root_dir, basename, suffix='y?ml'):
+def _scan_dir(path):
+    """List the sub-directories and the files of a directory
+    """
+    dirs, files = [], []
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            (dirs if is_dir else files).append(entry.name)
+    else:
+        for name in os.listdir(path):
+            (dirs if os.path.isdir(os.path.join(path, name)) else files).append(name)
+    return dirs, files
+
+
+def _dir_entry(root_dir, rel, match_file, skip_dir, old_index):
+    """Get the index entry of a directory:
+    [mtime, time of the scan, sub-directories, matching files]
+
+    The directory is only scanned if its mtime changed since it was indexed
+    in `old_index`. If `old_index` is None, the mtime is not determined.
+    Returns None if the directory can't be read.
+    """
+    path = os.path.join(root_dir, rel)
+    mtime = None
+    if old_index is not None:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        entry = old_index.get(rel)
+        # directory modified in the same second as scanned -> mtime not conclusive
+        if entry is not None and entry[0] == mtime and mtime < entry[1] - 1:
+            return entry
+    scanned_at = time.time()
+    try:
+        dirs, files = _scan_dir(path)
+    except OSError:
+        return None
+    return [mtime, scanned_at,
+            [d for d in dirs if not skip_dir(d, os.path.join(rel, d))],
+            [f for f in files if match_file(f)]]
+
+
+def _walk_matches(root_dir, rel_dir, match_file, skip_dir, old_index, new_index):
+    """Walk the directory tree under `root_dir/rel_dir` and return the
+    relative paths of the matching files. The entries of all the visited
+    directories are added to `new_index`
+    """
+    out = []
+    stack = [rel_dir]
+    while stack:
+        rel = stack.pop()
+        entry = _dir_entry(root_dir, rel, match_file, skip_dir, old_index)
+        if entry is None:
+            continue
+        new_index[rel] = entry
+        out.extend([os.path.join(rel, f) for f in entry[3]])
+        stack.extend([os.path.join(rel, d) for d in reversed(entry[2])])
+    return out
+
+
+def _read_file_index(index_path, header):
+    import json
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except ValueError:
+        logger.warning("Unable to parse the file index: {0}. Ignoring it".format(index_path))
+        return {}
+    if index.get("header") != header:
+        return {}
+    return index["dirs"]
+
+
+def _write_file_index(index_path, header, dirs):
+    import json
+    import tempfile
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    makedir_exist_ok(index_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=index_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"header": header, "dirs": dirs}, f)
+    # atomic replace
+    if hasattr(os, "replace"):
+        os.replace(tmp_path, index_path)
+    else:
+        os.rename(tmp_path, index_path)
+
+
+def list_files_recursively(root_dir, basename, suffix='y?ml', skip=None, n_jobs=1, index_path=None):
     """search for filenames matching the pattern: {root_dir}/**/{basename}.{suffix}
+
+    As with glob, hidden files and directories (starting with a dot) are skipped.
+
+    Args:
+      root_dir: root directory
+      basename: file basename (glob pattern)
+      suffix: file suffix (glob pattern)
+      skip: list of glob patterns for directories not to descend into (say
+        `["envs", "downloaded"]`). The patterns are matched against the
+        directory name and its path relative to `root_dir`
+      n_jobs: number of threads used to traverse the top-level
+        sub-directories in parallel
+      index_path: json file storing the directory listings of the previous
+        searches. Only the directories which changed since the previous
+        search (with the same root_dir, pattern and skip) are scanned again
+
+    Returns:
+      sorted list of file paths relative to `root_dir`
     """
-    root_dir = os.path.join(root_dir, "")  # make sure root dir ends with "/"
-    # TODO - implement skip
-    if sys.version_info >= (3, 5):
-        return [filename[len(root_dir):] for filename in
-                glob.iglob(root_dir + '**/{0}.{1}'.format(basename, suffix), recursive=True)]
+    import fnmatch
+    import re
+    pattern = '{0}.{1}'.format(basename, suffix)
+    pattern_re = re.compile(fnmatch.translate(os.path.normcase(pattern)))
+    skip_patterns = ['.*'] + list(skip or [])
+    skip_res = [re.compile(fnmatch.translate(os.path.normcase(p))) for p in skip_patterns]
+
+    match_hidden = pattern.startswith(".")
+    normcase = os.path.normcase if os.path.normcase("A") != "A" else None
+
+    def match_file(name):
+        if name[0] == "." and not match_hidden:
+            return False
+        return pattern_re.match(normcase(name) if normcase else name) is not None
+
+    def skip_dir(name, rel_path):
+        if normcase:
+            name, rel_path = normcase(name), normcase(rel_path)
+        for r in skip_res:
+            if r.match(name) or r.match(rel_path):
+                return True
+        return False
+
+    root_dir = os.path.abspath(root_dir)
+    header = [root_dir, pattern, skip_patterns]
+    old_index = _read_file_index(index_path, header) if index_path is not None else None
+    new_index = {}
+
+    if n_jobs is not None and n_jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        # traverse the top-level sub-directories in parallel
+        out = []
+        root_entry = _dir_entry(root_dir, "", match_file, skip_dir, old_index)
+        if root_entry is not None:
+            new_index[""] = root_entry
+            out.extend(root_entry[3])
+            sub_indices = [{} for _ in root_entry[2]]
+            with ThreadPoolExecutor(n_jobs) as executor:
+                results = list(executor.map(
+                    lambda args: _walk_matches(root_dir, args[0], match_file, skip_dir,
+                                               old_index, args[1]),
+                    zip(root_entry[2], sub_indices)))
+            for sub_out, sub_index in zip(results, sub_indices):
+                out.extend(sub_out)
+                new_index.update(sub_index)
     else:
-        # TODO - implement skip
-        import fnmatch
-        return [os.path.join(root, filename)[len(root_dir):]
-                for root, dirnames, filenames in os.walk(root_dir)
-                for filename in fnmatch.filter(filenames, '{0}.{1}'.format(basename, suffix))]
+        out = _walk_matches(root_dir, "", match_file, skip_dir, old_index, new_index)
+
+    if index_path is not None:
+        _write_file_index(index_path, header, new_index)
+    return sorted(out)
 
 
 def map_nested(dd, fn):
@@ -597,12 +1394,40 @@ def map_nested(dd, fn):
       dd: nested data structure
       fn: function to apply to each leaf
     """
-    if isinstance(dd, collections.Mapping):
-        return {key: map_nested(dd[key], fn) for key in dd}
-    elif isinstance(dd, collections.Sequence):
-        return [map_nested(x, fn) for x in dd]
-    else:
-        return fn(dd)
+    return tree_map(fn, dd)
+
+
+def map_nested_parallel(dd, fn, executor=None, n_jobs=None, use_processes=False,
+                        min_nbytes=1 << 20):
+    """Map a function to a nested data structure in parallel (one task per leaf)
+
+    Useful for structures with many large numpy arrays as most numpy
+    functions release the GIL. Structures with fewer than two leaves or
+    with less than `min_nbytes` of data are mapped serially.
+
+    Args:
+      dd: nested data structure
+      fn: function to apply to each leaf. Needs to be picklable if
+        `use_processes=True`
+      executor: concurrent.futures executor to use. If None, a new
+        thread (or process) pool is created for the call
+      n_jobs: number of workers of the created pool (default: number of CPUs)
+      use_processes: use a process instead of a thread pool
+      min_nbytes: minimal total size of the leaves (`.nbytes` of numpy arrays)
+        to map them in parallel
+    """
+    leaves, treedef = tree_flatten(dd)
+    nbytes = sum([getattr(x, 'nbytes', 0) for x in leaves])
+    if len(leaves) < 2 or nbytes < min_nbytes:
+        return treedef.unflatten([fn(x) for x in leaves])
+
+    if executor is not None:
+        return treedef.unflatten(list(executor.map(fn, leaves)))
+
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    pool_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_cls(max_workers=n_jobs) as executor:
+        return treedef.unflatten(list(executor.map(fn, leaves)))
 
 
 def take_first_nested(dd):
@@ -613,12 +1438,7 @@ def take_first_nested(dd):
 
     Example: take_first_nested({"a": [1,2,3], "b": 4}) == 1
     """
-    if isinstance(dd, collections.Mapping):
-        return take_first_nested(six.next(six.itervalues(dd)))
-    elif isinstance(dd, collections.Sequence):
-        return take_first_nested(dd[0])
-    else:
-        return dd
+    return six.next(tree_iter_leaves(dd))
 
 
 class classproperty(object):
@@ -682,16 +1502,13 @@ def recursive_dict_parse(d, key, fn):
       fn: when a dict with `key` is found, apply a function
          to this dictionary
     """
-    if isinstance(d, collections.Mapping):
-        if key in d:
-            return fn(d)
-        else:
-            return OrderedDict([(k, recursive_dict_parse(v, key, fn)) for k, v in six.iteritems(d)])
-    elif isinstance(d, list):
-        return [recursive_dict_parse(v, key, fn) for v in d]
-    else:
-        # nothing to iterate over. stop recursion
-        return d
+    def is_leaf(x):
+        return isinstance(x, Mapping) and key in x
+
+    return tree_map(lambda x: fn(x) if is_leaf(x) else x, d,
+                    is_leaf=is_leaf,
+                    is_sequence=lambda x: isinstance(x, list),
+                    mapping_type=OrderedDict)
 
 
 def makedir_exist_ok(dirpath):
@@ -0,0 +1,77 @@
+"""Shared test fixtures
+"""
+import os
+import threading
+import pytest
+from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.SimpleHTTPServer import SimpleHTTPRequestHandler
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """http.server handler supporting single range requests"""
+    requests = []
+    support_ranges = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        range_header = self.headers.get("Range")
+        type(self).requests.append((self.command, range_header))
+        if range_header and self.support_ranges:
+            start, end = range_header.split("=")[1].split("-")
+            start, end = int(start), int(end) if end else size - 1
+            f.seek(start)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, size))
+            length = end - start + 1
+        else:
+            self.send_response(200)
+            length = size
+        if self.support_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        self._remaining = length
+        return f
+
+    def copyfile(self, source, outputfile):
+        outputfile.write(source.read(self._remaining))
+
+
+class NoRangeHandler(RangeHandler):
+    support_ranges = False
+
+
+def serve(directory, handler):
+    handler = type("Handler", (handler,), {"requests": [],
+                                           "translate_path": lambda self, path: os.path.join(
+                                               directory, path.lstrip("/"))})
+    server = HTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.daemon = True
+    thread.start()
+    return server, handler, "http://127.0.0.1:{0}/".format(server.server_address[1])
+
+
+@pytest.fixture
+def served(tmpdir):
+    src = tmpdir.mkdir("src")
+    data = os.urandom(100000)
+    src.join("data.bin").write_binary(data)
+    servers = []
+
+    def start(support_ranges=True):
+        server, handler, url = serve(str(src), RangeHandler if support_ranges else NoRangeHandler)
+        servers.append(server)
+        return handler, url
+    yield data, start, tmpdir.mkdir("out")
+    for server in servers:
+        server.shutdown()
+        server.server_close()
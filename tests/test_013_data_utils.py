@@ -57,3 +57,109 @@ def test_preloaded_dataset(data):
     assert len(d) == 3
     assert d[1] == {"a": [1], "b": {"d": 1}, "c": np.array([1])}
     assert list(d.batch_iter(2))[1] == {'a': [np.array([2])], 'b': {'d': np.array([2])}, 'c': np.array([[2]])}
+
+
+class CountingDataset(object):
+    def __init__(self, n=20, fail=False):
+        self.n = n
+        self.fail = fail
+        self.calls = 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        if self.fail:
+            raise AssertionError("sample computed")
+        self.calls += 1
+        return {"inputs": np.full((4, 3), idx, dtype=np.float32),
+                "metadata": {"id": idx, "chr": "chr1"}}
+
+
+def test_cached_dataset_lru():
+    from kipoi_utils.data_utils import CachedDataset, _sample_nbytes
+    ds = CountingDataset()
+    sample_nbytes = _sample_nbytes(ds[0])
+    cached = CachedDataset(ds, max_bytes=5 * sample_nbytes)
+    ds.calls = 0
+    for i in range(5):
+        assert cached[i]["metadata"]["id"] == i
+    for i in range(5):
+        cached[i]
+    assert ds.calls == 5
+    assert cached.hits == 5
+    cached[5]  # evicts 0
+    cached[0]
+    assert ds.calls == 7
+    assert len(cached) == 20
+
+
+def test_cached_dataset_disk(tmpdir):
+    from kipoi_utils.data_utils import CachedDataset
+    from kipoi_utils.external.torch.data import DataLoader
+    cache_dir = str(tmpdir.join("cache"))
+    cached = CachedDataset(CountingDataset(), max_bytes=0, cache_dir=cache_dir)
+    batches = list(DataLoader(cached, batch_size=5, num_workers=2))
+    assert len(batches) == 4
+
+    # new run reads everything from the disk cache
+    cached2 = CachedDataset(CountingDataset(fail=True), cache_dir=cache_dir)
+    batches2 = list(DataLoader(cached2, batch_size=5))
+    for b1, b2 in zip(batches, batches2):
+        assert np.array_equal(b1["inputs"], b2["inputs"])
+        assert list(b1["metadata"]["chr"]) == list(b2["metadata"]["chr"])
+        assert np.array_equal(b1["metadata"]["id"], b2["metadata"]["id"])
+    assert cached2.disk_hits == 20
+    sample = cached2[3]
+    assert isinstance(sample["metadata"]["id"], int)
+    assert sample["metadata"]["chr"] == "chr1"
+
+
+def test_cached_dataset_get_batch():
+    from kipoi_utils.data_utils import CachedDataset
+
+    class BatchDataset(CountingDataset):
+        batches = []
+
+        def get_batch(self, indices):
+            self.batches.append(list(indices))
+            return [self[i] for i in indices]
+
+    ds = BatchDataset()
+    cached = CachedDataset(ds)
+    cached[1]
+    samples = cached.get_batch([0, 1, 2])
+    assert [s["metadata"]["id"] for s in samples] == [0, 1, 2]
+    assert ds.batches == [[0, 2]]
+    assert ds.calls == 3
+
+
+def test_cached_dataset_worker_budget(monkeypatch):
+    from kipoi_utils.data_utils import CachedDataset
+    from kipoi_utils.external.torch import data
+    cached = CachedDataset(CountingDataset())
+    # worker processes don't keep samples in memory unless requested
+    monkeypatch.setattr(data, "_worker_id", 0)
+    cached[0]
+    assert len(cached._lru) == 0
+    cached = CachedDataset(CountingDataset(), worker_max_bytes=1 << 20)
+    cached[0]
+    assert len(cached._lru) == 1
+
+
+def test_cached_dataset_disk_fingerprint(tmpdir):
+    from kipoi_utils.data_utils import CachedDataset
+    cache_dir = str(tmpdir.join("cache"))
+    cached = CachedDataset(CountingDataset(), max_bytes=0, cache_dir=cache_dir,
+                           fingerprint="v1")
+    cached[0]
+    # same fingerprint -> shared cache
+    assert CachedDataset(CountingDataset(fail=True), cache_dir=cache_dir,
+                         fingerprint="v1")[0]["metadata"]["id"] == 0
+    # other dataset of the same length -> not served from the v1 cache
+    ds = CountingDataset()
+    cached2 = CachedDataset(ds, max_bytes=0, cache_dir=cache_dir, fingerprint="v2")
+    cached2[0]
+    assert ds.calls == 1
+    assert cached2.disk_hits == 0
+    assert len(tmpdir.join("cache").listdir()) == 2
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import pytest
+from kipoi_utils.artifact_cache import ArtifactCache
+from kipoi_utils.external.torchvision.dataset_utils import download_url
+
+
+def test_fetch(served):
+    data, start, out = served
+    handler, url = start()
+    cache = ArtifactCache(str(out.join("cache")))
+    md5 = hashlib.md5(data).hexdigest()
+    download_url(url + "data.bin", str(out.join("m1")), "w.bin", md5=md5, cache=cache)
+    n_requests = len(handler.requests)
+    download_url(url + "data.bin", str(out.join("m2")), "w.bin", md5=md5, cache=cache)
+    # url lookup
+    cache.fetch(url + "data.bin", str(out.join("m3", "w.bin")))
+    assert len(handler.requests) == n_requests
+    assert len(cache) == 1
+    paths = [str(out.join(m, "w.bin")) for m in ["m1", "m2", "m3"]]
+    assert [open(p, "rb").read() for p in paths] == [data] * 3
+    if hasattr(os, "link"):
+        # hardlinks
+        assert len(set([os.stat(p).st_ino for p in paths])) == 1
+    assert cache.get(sha256=hashlib.sha256(data).hexdigest()) is not None
+
+
+def test_fetch_changed_upstream(served):
+    data, start, out = served
+    handler, url = start()
+    cache = ArtifactCache(str(out.join("cache")))
+    cache.fetch(url + "data.bin", str(out.join("m1", "w.bin")), md5=hashlib.md5(data).hexdigest())
+    # new version of the file behind the same url
+    new_data = os.urandom(5000)
+    with open(str(out.join("..", "src", "data.bin")), "wb") as f:
+        f.write(new_data)
+    new_md5 = hashlib.md5(new_data).hexdigest()
+    assert cache.get(url + "data.bin", md5=new_md5) is None
+    cache.fetch(url + "data.bin", str(out.join("m2", "w.bin")), md5=new_md5)
+    assert out.join("m2", "w.bin").read_binary() == new_data
+    assert len(cache) == 2
+    # the url now points to the new version
+    cache.fetch(url + "data.bin", str(out.join("m3", "w.bin")))
+    assert out.join("m3", "w.bin").read_binary() == new_data
+    # the old version is still found by its digest
+    cache.fetch(url + "data.bin", str(out.join("m4", "w.bin")), md5=hashlib.md5(data).hexdigest())
+    assert out.join("m4", "w.bin").read_binary() == data
+
+
+def test_add_wrong_md5(tmpdir):
+    cache = ArtifactCache(str(tmpdir.join("cache")))
+    p = tmpdir.join("f")
+    p.write_binary(b"data")
+    with pytest.raises(ValueError):
+        cache.add(str(p), md5="0" * 32)
+    assert len(cache) == 0
+    assert os.listdir(str(tmpdir.join("cache", "tmp"))) == []
+
+
+def test_fetch_symlink(served):
+    data, start, out = served
+    handler, url = start()
+    cache = ArtifactCache(str(out.join("cache")), link="symlink")
+    dest = str(out.join("w.bin"))
+    cache.fetch(url + "data.bin", dest)
+    assert os.path.islink(dest)
+    assert open(dest, "rb").read() == data
+
+
+def test_integrity_error(served):
+    data, start, out = served
+    handler, url = start()
+    cache = ArtifactCache(str(out.join("cache")))
+    with pytest.raises(RuntimeError):
+        cache.fetch(url + "data.bin", str(out.join("w.bin")), md5="0" * 32)
+    assert len(cache) == 0
+    assert not out.join("w.bin").check()
+    assert os.listdir(str(out.join("cache", "tmp"))) == []
+
+
+def test_lru_eviction(tmpdir):
+    cache = ArtifactCache(str(tmpdir.join("cache")), max_bytes=2500)
+    paths = []
+    for i in range(3):
+        p = tmpdir.join("f{0}".format(i))
+        p.write_binary(os.urandom(1000))
+        paths.append(str(p))
+    obj0 = cache.add(paths[0])
+    cache.add(paths[1])
+    # f0 used more recently than f1
+    assert cache.get(md5=hashlib.md5(open(paths[0], "rb").read()).hexdigest()) == obj0
+    cache.add(paths[2])
+    assert len(cache) == 2
+    assert cache.total_bytes() == 2000
+    assert os.path.isfile(obj0)
+    assert cache.get(md5=hashlib.md5(open(paths[1], "rb").read()).hexdigest()) is None
+    cache.evict(max_bytes=0)
+    assert len(cache) == 0
+    assert not os.path.isfile(obj0)
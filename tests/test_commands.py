@@ -0,0 +1,73 @@
+import asyncio
+import sys
+import time
+from kipoi_utils.commands import run_commands
+
+
+def py(code):
+    return [sys.executable, "-c", code]
+
+
+def test_run_commands():
+    results = run_commands([py("print('a'); print('b')"),
+                            py("import sys; sys.stderr.write('err\\n'); sys.exit(3)")])
+    assert results[0].returncode == 0
+    assert results[0].ok
+    assert results[0].stdout_tail == ["a", "b"]
+    assert results[1].returncode == 3
+    assert results[1].stderr_tail == ["err"]
+    assert results[1].wall_time > 0
+
+
+def test_run_commands_tail():
+    res, = run_commands([py("for i in range(1000): print(i)")], tail_lines=10)
+    assert res.stdout_tail == [str(i) for i in range(990, 1000)]
+
+
+def test_run_commands_timeout():
+    start = time.time()
+    res, = run_commands([py("import time; time.sleep(30)")], timeout=0.5)
+    assert res.timed_out
+    assert res.returncode is None
+    assert time.time() - start < 10
+
+
+def test_run_commands_concurrency():
+    lines = []
+    code = "import time; print(time.time()); time.sleep(0.3); print(time.time())"
+    results = run_commands([py(code) for i in range(4)], max_concurrent=4,
+                           on_line=lambda i, name, line: lines.append((i, name)))
+    assert sorted(lines) == [(i, "stdout") for i in range(4) for _ in range(2)]
+    starts, ends = zip(*[[float(x) for x in r.stdout_tail] for r in results])
+    # all the commands were running at the same time
+    assert max(starts) < min(ends)
+
+
+def test_run_commands_max_concurrent():
+    code = "import time; print(time.time()); time.sleep(0.2); print(time.time())"
+    results = run_commands([py(code) for i in range(4)], max_concurrent=2)
+    intervals = [[float(x) for x in r.stdout_tail] for r in results]
+    for start, _ in intervals:
+        assert sum([s <= start < e for s, e in intervals]) <= 2
+
+
+def test_run_commands_event_loop():
+    previous = asyncio.new_event_loop()
+    asyncio.set_event_loop(previous)
+    try:
+        loops = []
+        run_commands([py("print(1)")], on_line=lambda *args: loops.append(
+            asyncio.get_event_loop_policy().get_event_loop()))
+        # the loop running the commands is the current loop
+        assert loops[0] is not previous
+        assert loops[0].is_closed()
+        assert asyncio.get_event_loop_policy().get_event_loop() is previous
+    finally:
+        asyncio.set_event_loop(None)
+        previous.close()
+
+
+def test_run_commands_missing():
+    res, = run_commands([["this-command-does-not-exist-kipoi"]])
+    assert res.returncode is None
+    assert res.error is not None
@@ -0,0 +1,205 @@
+import hashlib
+import os
+import time
+import pytest
+from kipoi_utils.external.torchvision import dataset_utils
+from kipoi_utils.external.torchvision.dataset_utils import (check_integrity, file_digests,
+                                                            verify_files, DIGEST_CACHE_FILE,
+                                                            download_url, download_urls)
+
+
+def write_old(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    past = time.time() - 10
+    os.utime(path, (past, past))
+
+
+def test_check_integrity(tmpdir):
+    fpath = str(tmpdir.join("file"))
+    data = b"kipoi" * 100000
+    write_old(fpath, data)
+    md5 = hashlib.md5(data).hexdigest()
+    sha256 = hashlib.sha256(data).hexdigest()
+    assert check_integrity(fpath)
+    assert check_integrity(fpath, md5)
+    assert check_integrity(fpath, md5=md5.upper(), sha256=sha256)
+    assert check_integrity(fpath, blake2b=hashlib.blake2b(data).hexdigest(), cache=True)
+    assert not check_integrity(fpath, md5="0" * 32)
+    assert not check_integrity(fpath, md5=md5, sha256="0" * 64)
+    assert not check_integrity(str(tmpdir.join("missing")), md5)
+    # the digest cache is only written on request
+    assert sorted(os.listdir(str(tmpdir))) == sorted(["file", DIGEST_CACHE_FILE])
+
+
+def test_no_digest_cache_by_default(tmpdir):
+    fpath = str(tmpdir.join("file"))
+    write_old(fpath, b"a" * 1000)
+    assert check_integrity(fpath, md5=hashlib.md5(b"a" * 1000).hexdigest())
+    assert verify_files({fpath: {"md5": hashlib.md5(b"a" * 1000).hexdigest()}})[fpath]
+    assert os.listdir(str(tmpdir)) == ["file"]
+
+
+def test_digest_cache(tmpdir, monkeypatch):
+    fpath = str(tmpdir.join("file"))
+    write_old(fpath, b"a" * 1000)
+    digests = file_digests(fpath, ["md5", "sha256"], cache=True)
+    assert digests["md5"] == hashlib.md5(b"a" * 1000).hexdigest()
+    assert tmpdir.join(DIGEST_CACHE_FILE).check()
+
+    calls = []
+    hash_file = dataset_utils._hash_file
+    monkeypatch.setattr(dataset_utils, "_hash_file",
+                        lambda *args: calls.append(args) or hash_file(*args))
+    assert file_digests(fpath, ["md5"], cache=True) == {"md5": digests["md5"]}
+    assert calls == []
+
+    # modified file is re-hashed
+    write_old(fpath, b"b" * 1001)
+    assert file_digests(fpath, ["md5"], cache=True)["md5"] == hashlib.md5(b"b" * 1001).hexdigest()
+    assert len(calls) == 1
+
+
+def test_verify_files(tmpdir):
+    files = {}
+    for i in range(5):
+        fpath = str(tmpdir.join("f{0}".format(i)))
+        data = os.urandom(10000)
+        write_old(fpath, data)
+        files[fpath] = {"sha256": hashlib.sha256(data).hexdigest()}
+    files[str(tmpdir.join("f0"))] = {"sha256": "0" * 64}
+    files[str(tmpdir.join("missing"))] = {}
+    res = verify_files(files, n_jobs=3, cache=True)
+    assert res == dict([(p, not (p.endswith("f0") or p.endswith("missing"))) for p in files])
+    assert verify_files(files, n_jobs=3, cache=True) == res
+    assert verify_files(files, n_jobs=3) == res
+
+
+def test_download_url_segmented(served):
+    data, start, out = served
+    handler, url = start()
+    md5 = hashlib.md5(data).hexdigest()
+    download_url(url + "data.bin", str(out), "data.bin", md5=md5, n_segments=4,
+                 min_segment_size=10000)
+    assert out.join("data.bin").read_binary() == data
+    assert not out.join("data.bin.part").check()
+    assert len([r for r in handler.requests if r[1] is not None]) == 4
+
+
+def test_download_url_segmented_resume(served):
+    data, start, out = served
+    handler, url = start()
+    # partially downloaded segments 0 and 2 (of 25000 bytes each)
+    out.join("data.bin.part.0").write_binary(data[:10000])
+    out.join("data.bin.part.2").write_binary(data[50000:70000])
+    download_url(url + "data.bin", str(out), "data.bin", sha256=hashlib.sha256(data).hexdigest(),
+                 n_segments=4, min_segment_size=10000)
+    assert out.join("data.bin").read_binary() == data
+    assert ("GET", "bytes=10000-24999") in handler.requests
+    assert ("GET", "bytes=70000-74999") in handler.requests
+
+
+def test_ordered_hasher(tmpdir):
+    data = os.urandom(1000)
+    bounds = [(0, 400), (400, 700), (700, 1000)]
+    paths = [str(tmpdir.join("seg{0}".format(i))) for i in range(3)]
+    hasher = dataset_utils._OrderedHasher(["md5", "sha256"], paths)
+    # (segment, start, end) chunks arriving out of order
+    chunks = [(2, 0, 100), (1, 0, 150), (0, 0, 200), (1, 150, 300), (0, 200, 400),
+              (2, 100, 300)]
+    files = [open(p, "wb") for p in paths]
+    for i, start, end in chunks:
+        seg_start = bounds[i][0]
+        files[i].write(data[seg_start + start:seg_start + end])
+        files[i].flush()
+        hasher.add_chunk(i, start, data[seg_start + start:seg_start + end])
+        if end == bounds[i][1] - bounds[i][0]:
+            files[i].close()
+            hasher.segment_complete(i)
+    assert hasher.hexdigests(["md5", "sha256"]) == {"md5": hashlib.md5(data).hexdigest(),
+                                                     "sha256": hashlib.sha256(data).hexdigest()}
+
+
+def test_download_url_resume(served):
+    data, start, out = served
+    handler, url = start()
+    out.join("data.bin.part").write_binary(data[:60000])
+    download_url(url + "data.bin", str(out), "data.bin", sha256=hashlib.sha256(data).hexdigest())
+    assert out.join("data.bin").read_binary() == data
+    assert ("GET", "bytes=60000-") in handler.requests
+
+
+def test_download_url_no_ranges(served):
+    data, start, out = served
+    handler, url = start(support_ranges=False)
+    out.join("data.bin.part").write_binary(b"garbage")
+    download_url(url + "data.bin", str(out), "data.bin", n_segments=4, min_segment_size=10000)
+    assert out.join("data.bin").read_binary() == data
+
+
+def test_download_url_integrity(served):
+    data, start, out = served
+    handler, url = start()
+    with pytest.raises(RuntimeError):
+        download_url(url + "data.bin", str(out), "data.bin", md5="0" * 32)
+    assert not out.join("data.bin").check()
+    assert not out.join("data.bin.part").check()
+
+
+def test_download_urls(served):
+    data, start, out = served
+    handler, url = start()
+    paths = download_urls([(url + "data.bin", "a.bin"),
+                           (url + "data.bin", "b.bin", hashlib.md5(data).hexdigest())],
+                          str(out), n_jobs=2)
+    assert [open(p, "rb").read() for p in paths] == [data, data]
+
+
+@pytest.mark.parametrize("error,fallback", [
+    ("refused", True),
+    ("ssl", False),
+    ("404", False),
+])
+def test_download_https_fallback(tmpdir, monkeypatch, error, fallback):
+    import errno
+    import socket
+    import ssl
+    from six.moves.urllib.error import HTTPError, URLError
+    errors = {"refused": URLError(socket.error(errno.ECONNREFUSED, "Connection refused")),
+              "ssl": URLError(ssl.SSLError("certificate verify failed")),
+              "404": HTTPError("https://example.org/a.bin", 404, "Not Found", {}, None)}
+    urls = []
+
+    def download_file(url, fpath, expected, **kwargs):
+        urls.append(url)
+        if url.startswith("https:"):
+            raise errors[error]
+        return {}
+    monkeypatch.setattr(dataset_utils, "_download_file", download_file)
+    if fallback:
+        download_url("https://example.org/a.bin", str(tmpdir), "a.bin")
+        assert urls == ["https://example.org/a.bin", "http://example.org/a.bin"]
+    else:
+        with pytest.raises((IOError, OSError)):
+            download_url("https://example.org/a.bin", str(tmpdir), "a.bin")
+        assert urls == ["https://example.org/a.bin"]
+
+
+def test_download_url_digest_cache(served, monkeypatch):
+    data, start, out = served
+    handler, url = start()
+    write_old(str(out.join("data.bin")), data)
+    md5 = hashlib.md5(data).hexdigest()
+    calls = []
+    hash_file = dataset_utils._hash_file
+    monkeypatch.setattr(dataset_utils, "_hash_file",
+                        lambda *args: calls.append(args) or hash_file(*args))
+    download_urls([(url + "data.bin", "data.bin", md5)], str(out), digest_cache=True)
+    assert len(calls) == 1
+    # verified from the digest cache
+    download_url(url + "data.bin", str(out), "data.bin", md5=md5, digest_cache=True)
+    assert len(calls) == 1
+    assert handler.requests == []
+    # no digest cache
+    download_url(url + "data.bin", str(out), "data.bin", md5=md5)
+    assert len(calls) == 2
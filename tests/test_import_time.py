@@ -0,0 +1,49 @@
+"""Test that `import kipoi_utils` stays fast
+"""
+import subprocess
+import sys
+import pytest
+
+# heavy dependencies which should only be imported on first use
+HEAVY_MODULES = ["numpy", "pandas", "yaml", "tqdm", "related"]
+
+# generous budget for the cumulative import time of kipoi_utils (in seconds)
+IMPORT_TIME_BUDGET = 0.1
+
+
+def _run(code, *args):
+    return subprocess.check_output([sys.executable] + list(args) + ["-c", code],
+                                   stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def test_no_heavy_imports():
+    out = _run("import sys, kipoi_utils; "
+               "print(','.join([m for m in {0!r} if m in sys.modules]))".format(HEAVY_MODULES))
+    assert out.strip() == ""
+
+
+def test_data_utils_no_pandas():
+    out = _run("import sys, kipoi_utils.data_utils; print('pandas' in sys.modules)")
+    assert out.strip() == "False"
+
+
+def test_star_import_names():
+    # the same names are exported on every python version
+    ns = {}
+    exec("from kipoi_utils.utils import *", ns)
+    for name in ["Popen", "PIPE", "STDOUT", "subprocess", "pickle", "glob", "hashlib",
+                 "inspect", "ast"]:
+        assert name in ns
+    import kipoi_utils
+    assert kipoi_utils.utils.Popen is kipoi_utils.Popen
+    with pytest.raises(AttributeError):
+        kipoi_utils.utils.does_not_exist
+
+
+def test_import_time():
+    # warm-up (writes the .pyc files)
+    _run("import kipoi_utils")
+    # -X importtime requires python >= 3.7
+    out = _run("import time; start = time.time(); import kipoi_utils; "
+               "print(time.time() - start)")
+    assert float(out.strip()) < IMPORT_TIME_BUDGET
@@ -0,0 +1,80 @@
+"""Test the asynchronous iteration over the DataLoader
+"""
+import asyncio
+import time
+import numpy as np
+import pytest
+from kipoi_utils.external.torch.data import DataLoader
+
+
+class SlowDataset(object):
+    def __init__(self, n=12, delay=0.0):
+        self.n = n
+        self.delay = delay
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        time.sleep(self.delay)
+        return {"x": np.array([idx])}
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def collect(loader):
+    return [b async for b in loader]
+
+
+@pytest.mark.parametrize("num_workers,pin_memory", [(0, False), (2, False), (2, True)])
+def test_async_iteration(num_workers, pin_memory):
+    loader = DataLoader(SlowDataset(), batch_size=5, num_workers=num_workers,
+                        pin_memory=pin_memory)
+    batches = run(collect(loader))
+    assert [b["x"][:, 0].tolist() for b in batches] == [b["x"][:, 0].tolist() for b in loader]
+    assert len(batches) == 3
+
+
+def test_async_iteration_doesnt_block():
+    async def main():
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+        task = asyncio.ensure_future(ticker())
+        loader = DataLoader(SlowDataset(n=8, delay=0.05), batch_size=4, num_workers=1)
+        batches = await collect(loader)
+        task.cancel()
+        return batches, ticks
+    batches, ticks = run(main())
+    assert len(batches) == 2
+    # the event loop kept running while the batches were loaded
+    assert len(ticks) > 10
+
+
+def test_async_cancellation():
+    async def main():
+        loader = DataLoader(SlowDataset(n=1000, delay=0.01), batch_size=2, num_workers=2)
+        it = loader.__aiter__()
+
+        async def consume():
+            async for _ in it:
+                pass
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # waits for the shutdown started on cancellation
+        await it.aclose()
+        return it._it.workers
+    workers = run(main())
+    assert not any([w.is_alive() for w in workers])
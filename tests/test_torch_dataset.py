@@ -0,0 +1,126 @@
+"""Test the dataset views and the DataLoader
+"""
+import numpy as np
+import pytest
+from kipoi_utils.external.torch.dataset import ConcatDataset, Subset, Dataset
+from kipoi_utils.external.torch.sampler import BatchSampler, SequentialSampler
+from kipoi_utils.external.torch.data import DataLoader
+
+
+class RangeDataset(Dataset):
+    def __init__(self, start, n):
+        self.start = start
+        self.n = n
+        self.batches = []
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.n:
+            raise IndexError(idx)
+        return {"x": np.array([self.start + idx])}
+
+    def get_batch(self, indices):
+        self.batches.append(list(indices))
+        return [self[i] for i in indices]
+
+
+def test_concat_dataset():
+    datasets = [RangeDataset(0, 3), RangeDataset(100, 0), RangeDataset(200, 4)]
+    ds = ConcatDataset(datasets)
+    assert len(ds) == 7
+    assert [ds[i]["x"][0] for i in range(7)] == [0, 1, 2, 200, 201, 202, 203]
+    assert ds[-1]["x"][0] == 203
+    with pytest.raises(IndexError):
+        ds[7]
+    dataset_idx, sample_idx = ds.locate([0, 3, 6, 2])
+    assert list(dataset_idx) == [0, 2, 2, 0]
+    assert list(sample_idx) == [0, 0, 3, 2]
+
+    # batches are routed in blocks
+    samples = ds.get_batch([4, 0, 5, 1])
+    assert [s["x"][0] for s in samples] == [201, 0, 202, 1]
+    assert datasets[0].batches == [[0, 1]]
+    assert datasets[2].batches == [[1, 2]]
+    assert len(RangeDataset(0, 2) + RangeDataset(0, 3)) == 5
+
+
+def test_subset():
+    ds = Subset(ConcatDataset([RangeDataset(0, 3), RangeDataset(10, 3)]), [5, 0, 3])
+    assert len(ds) == 3
+    assert [ds[i]["x"][0] for i in range(3)] == [12, 0, 10]
+    assert [s["x"][0] for s in ds.get_batch([2, 1])] == [10, 0]
+
+
+def test_batch_sampler_blocks():
+    sampler = SequentialSampler(range(10))
+    assert list(BatchSampler(sampler, 3, False)) == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    assert list(BatchSampler(sampler, 3, True)) == [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+    assert list(BatchSampler(range(10), 3, False)) == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_dataloader_concat(num_workers):
+    datasets = [RangeDataset(0, 5), RangeDataset(100, 5)]
+    dl = DataLoader(ConcatDataset(datasets), batch_size=4, num_workers=num_workers)
+    batches = list(dl)
+    assert np.concatenate([b["x"][:, 0] for b in batches]).tolist() == \
+        list(range(5)) + list(range(100, 105))
+    if num_workers == 0:
+        assert datasets[0].batches == [[0, 1, 2, 3], [4]]
+        assert datasets[1].batches == [[0, 1, 2], [3, 4]]
+
+
+class PidDataset(Dataset):
+    """Returns the pid of the loading process and the number of builds in that process"""
+
+    def __init__(self, n=20):
+        self.n = n
+        self.n_builds = 0
+
+    def build(self):
+        self.n_builds += 1
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        import os
+        return {"x": np.array([idx]), "pid": os.getpid(), "n_builds": self.n_builds}
+
+
+@pytest.mark.parametrize("pin_memory", [False, True])
+def test_dataloader_max_batches_per_worker(pin_memory):
+    dl = DataLoader(PidDataset(), batch_size=2, num_workers=2, max_batches_per_worker=2,
+                    pin_memory=pin_memory)
+    batches = list(dl)
+    np.testing.assert_array_equal(np.concatenate([b["x"][:, 0] for b in batches]),
+                                  np.arange(20))
+    pids = [b["pid"][0] for b in batches]
+    # each process loaded at most 2 batches
+    assert max([pids.count(pid) for pid in set(pids)]) <= 2
+    assert len(set(pids)) >= 5
+    # the dataset is built in each new worker
+    assert all([b["n_builds"][0] == 1 for b in batches])
+    events = dl.stats["recycled_workers"]
+    assert len(events) >= 4
+    assert set([e["reason"] for e in events]) == {"max_batches"}
+    assert set([e["worker_id"] for e in events]) <= {0, 1}
+    assert all([e["batches"] == 2 for e in events])
+
+
+def test_dataloader_max_worker_rss():
+    dl = DataLoader(PidDataset(n=8), batch_size=2, num_workers=2, max_worker_rss=1)
+    batches = list(dl)
+    np.testing.assert_array_equal(np.concatenate([b["x"][:, 0] for b in batches]),
+                                  np.arange(8))
+    assert len(set([b["pid"][0] for b in batches])) == 4
+    events = dl.stats["recycled_workers"]
+    assert events and all([e["reason"] == "max_rss" and e["rss"] > 1 for e in events])
+
+
+def test_dataloader_recycling_remote_workers():
+    with pytest.raises(ValueError):
+        DataLoader(PidDataset(), max_batches_per_worker=2, remote_workers=[("localhost", 1)],
+                   authkey=b"key")
@@ -0,0 +1,134 @@
+"""Test the batch-level transform pipeline of the DataLoader
+"""
+import numpy as np
+import pytest
+from kipoi_utils.external.torch.data import DataLoader
+from kipoi_utils.external.torch.pipeline import (BatchPipeline, Cast, Flatten, Normalize,
+                                                 ReverseComplement)
+
+
+class SeqDataset(object):
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, idx):
+        seq = np.zeros((5, 4))
+        seq[np.arange(5), np.arange(5) % 4] = 1
+        return {"inputs": {"seq": seq, "x": np.array([idx, 2 * idx])},
+                "targets": float(idx)}
+
+
+def double_x(batch):
+    batch["inputs"]["x"] = batch["inputs"]["x"] * 2
+    return batch
+
+
+def failing(batch):
+    raise ValueError("stage failed")
+
+
+def test_pipeline():
+    p = BatchPipeline([double_x, ("cast", Cast("float32", "inputs/x"))])
+    p = p.then(Normalize(1, 2, "targets")) + [Flatten()]
+    assert [name for name, _ in p.stages] == ["double_x", "cast", "Normalize", "Flatten"]
+    batch = next(iter(DataLoader(SeqDataset(), batch_size=3)))
+    out, timings = p.run(batch)
+    assert [name for name, _ in timings] == ["double_x", "cast", "Normalize", "Flatten"]
+    assert out["inputs/x/1"].dtype == np.float32
+    np.testing.assert_array_equal(out["inputs/x/1"], [0, 4, 8])
+    np.testing.assert_array_equal(out["targets"], [-0.5, 0, 0.5])
+    with pytest.raises(KeyError):
+        Cast("float32", "inputs/missing")(batch)
+
+
+def test_reverse_complement():
+    batch = next(iter(DataLoader(SeqDataset(), batch_size=10)))
+    seq = batch["inputs"]["seq"]
+    out = ReverseComplement("inputs/seq", p=1)(batch)["inputs"]["seq"]
+    np.testing.assert_array_equal(out, seq[:, ::-1, ::-1])
+    out = ReverseComplement("inputs/seq", p=0)(batch)["inputs"]["seq"]
+    np.testing.assert_array_equal(out, seq)
+    out = ReverseComplement("inputs/seq", p=0.5, seed=1)(batch)["inputs"]["seq"]
+    assert all([np.array_equal(o, s) or np.array_equal(o, s[::-1, ::-1])
+                for o, s in zip(out, seq)])
+
+
+def test_reverse_complement_seed():
+    import copy
+    import pickle
+    batch = next(iter(DataLoader(SeqDataset(), batch_size=10)))
+    rc = ReverseComplement("inputs/seq", seed=1)
+    out = rc(batch)["inputs"]["seq"]
+    # copies restart from the seed
+    for rc2 in [copy.deepcopy(rc), pickle.loads(pickle.dumps(rc))]:
+        np.testing.assert_array_equal(rc2(batch)["inputs"]["seq"], out)
+    np.testing.assert_array_equal(ReverseComplement("inputs/seq", seed=1)(batch)["inputs"]["seq"],
+                                  out)
+
+
+def test_reverse_complement_worker_seed(monkeypatch):
+    from kipoi_utils.external.torch import data
+    # poly-A sequences -> poly-T if reverse-complemented
+    seq = np.zeros((100, 3, 4))
+    seq[:, :, 0] = 1
+    batch = {"seq": seq}
+
+    def flips(worker_seed):
+        monkeypatch.setattr(data, "_worker_seed", worker_seed)
+        return ReverseComplement("seq", seed=1)(batch)["seq"][:, 0, 3] == 1
+    # the random state depends on the seed, the epoch, the worker id and the
+    # respawns, not on the process
+    np.testing.assert_array_equal(flips((0, 0, 0)), flips((0, 0, 0)))
+    assert not np.array_equal(flips((0, 0, 0)), flips((0, 1, 0)))
+    assert not np.array_equal(flips((0, 0, 0)), flips((1, 0, 0)))
+    assert not np.array_equal(flips((0, 0, 0)), flips((0, 0, 1)))
+    assert not np.array_equal(flips((0, 0, 0)), flips(None))
+
+
+class PolyADataset(object):
+    def __len__(self):
+        return 64
+
+    def __getitem__(self, idx):
+        seq = np.zeros((3, 4))
+        seq[:, 0] = 1
+        return seq
+
+
+def test_dataloader_reverse_complement_epochs():
+    def epochs(n):
+        dl = DataLoader(PolyADataset(), batch_size=64, num_workers=1,
+                        transforms=[ReverseComplement(seed=1)])
+        return [next(iter(dl))[:, 0, 3] == 1 for _ in range(n)]
+    first, second = epochs(2)
+    # new flips every epoch, reproducible across loaders
+    assert not np.array_equal(first, second)
+    np.testing.assert_array_equal(epochs(1)[0], first)
+
+
+def test_normalize_non_numeric():
+    batch = {"x": np.array([1., 3.]), "id": np.array(["a", "b"])}
+    out = Normalize(1, 2)(batch)
+    np.testing.assert_array_equal(out["x"], [0, 1])
+    np.testing.assert_array_equal(out["id"], ["a", "b"])
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_dataloader_transforms(num_workers):
+    dl = DataLoader(SeqDataset(), batch_size=4, num_workers=num_workers,
+                    transforms=[double_x, Cast("float32")])
+    batches = list(dl)
+    np.testing.assert_array_equal(np.concatenate([b["inputs"]["x"][:, 0] for b in batches]),
+                                  2 * np.arange(10))
+    assert batches[0]["targets"].dtype == np.float32
+    assert list(dl.stats["transforms"]) == ["double_x", "Cast"]
+    assert dl.stats["transforms"]["Cast"]["calls"] == 3
+    assert dl.stats["transforms"]["Cast"]["seconds"] >= 0
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_dataloader_transform_exception(num_workers):
+    dl = DataLoader(SeqDataset(), batch_size=4, num_workers=num_workers, transforms=[failing])
+    with pytest.raises(ValueError) as e:
+        list(dl)
+    assert "stage failed" in str(e.value)
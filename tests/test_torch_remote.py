@@ -0,0 +1,138 @@
+"""Test the remote DataLoader workers
+"""
+import threading
+import numpy as np
+import pytest
+from kipoi_utils.external.torch.data import DataLoader
+from kipoi_utils.external.torch.remote import RemoteWorkerServer
+
+AUTHKEY = b"test-key"
+
+
+class Dataset(object):
+    def __init__(self, n=23, fail_idx=None):
+        self.n = n
+        self.fail_idx = fail_idx
+        self.built = False
+
+    def build(self):
+        self.built = True
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        if not self.built:
+            raise ValueError("Dataset not built")
+        if idx == self.fail_idx:
+            raise ValueError("Failed on {0}".format(idx))
+        return {"x": np.arange(3) + idx, "y": float(idx)}
+
+
+class DroppingServer(RemoteWorkerServer):
+    """Drops the connection after receiving the first request"""
+
+    def handle(self, conn):
+        conn.recv()
+        conn.close()
+
+
+def start_servers(dataset, n=2, cls=RemoteWorkerServer):
+    servers = [cls(dataset, authkey=AUTHKEY) for _ in range(n)]
+    for s in servers:
+        t = threading.Thread(target=s.serve_forever)
+        t.daemon = True
+        t.start()
+    return servers
+
+
+@pytest.fixture
+def servers():
+    servers = start_servers(Dataset())
+    yield servers
+    for s in servers:
+        s.close()
+
+
+def assert_same_batches(batches, expected):
+    assert len(batches) == len(expected)
+    for b, e in zip(batches, expected):
+        np.testing.assert_array_equal(b["x"], e["x"])
+        np.testing.assert_array_equal(b["y"], e["y"])
+
+
+@pytest.mark.parametrize("pin_memory", [False, True])
+def test_remote_workers(servers, pin_memory):
+    dl = DataLoader(Dataset(), batch_size=4, pin_memory=pin_memory, authkey=AUTHKEY,
+                    remote_workers=[s.address for s in servers])
+    ds = Dataset()
+    ds.build()
+    assert_same_batches(list(dl), list(DataLoader(ds, batch_size=4)))
+    # iterate a second time
+    assert len(list(dl)) == 6
+
+
+def test_remote_workers_close_connections(servers):
+    dl = DataLoader(Dataset(), batch_size=4, authkey=AUTHKEY,
+                    remote_workers=[s.address for s in servers])
+    it = iter(dl)
+    assert len(list(it)) == 6
+    assert all([conn.closed for conn in it.index_queue.conns])
+    assert not any([w.is_alive() for w in it.workers])
+
+
+def test_remote_workers_require_authkey(servers):
+    with pytest.raises(ValueError):
+        RemoteWorkerServer(Dataset())
+    with pytest.raises(ValueError):
+        DataLoader(Dataset(), remote_workers=[servers[0].address])
+
+
+def test_remote_worker_exception():
+    servers = start_servers(Dataset(fail_idx=9))
+    dl = DataLoader(Dataset(), batch_size=4, authkey=AUTHKEY,
+                    remote_workers=[s.address for s in servers])
+    it = iter(dl)
+    next(it)
+    next(it)
+    with pytest.raises(ValueError) as e:
+        next(it)
+    assert "Failed on 9" in str(e.value)
+    for s in servers:
+        s.close()
+
+
+def test_remote_worker_lost():
+    servers = start_servers(Dataset(), n=1) + start_servers(Dataset(), n=1, cls=DroppingServer)
+    dl = DataLoader(Dataset(), batch_size=4, authkey=AUTHKEY,
+                    remote_workers=[s.address for s in servers])
+    ds = Dataset()
+    ds.build()
+    # the batches sent to the dropped connection are re-sent to the other worker
+    assert_same_batches(list(dl), list(DataLoader(ds, batch_size=4)))
+    for s in servers:
+        s.close()
+
+
+def test_remote_worker_wrong_authkey(servers):
+    from multiprocessing import AuthenticationError
+    with pytest.raises(AuthenticationError):
+        iter(DataLoader(Dataset(), batch_size=4, authkey=b"wrong",
+                        remote_workers=[servers[0].address]))
+
+
+def test_remote_worker_transforms():
+    from kipoi_utils.external.torch.pipeline import Cast
+    servers = [RemoteWorkerServer(Dataset(), authkey=AUTHKEY, transforms=[Cast("float32")])]
+    t = threading.Thread(target=servers[0].serve_forever)
+    t.daemon = True
+    t.start()
+    dl = DataLoader(Dataset(), batch_size=4, authkey=AUTHKEY,
+                    remote_workers=[s.address for s in servers])
+    batches = list(dl)
+    assert batches[0]["y"].dtype == np.float32
+    assert dl.stats["transforms"]["Cast"]["calls"] == 6
+    with pytest.raises(ValueError):
+        DataLoader(Dataset(), transforms=[Cast("float32")], authkey=AUTHKEY,
+                   remote_workers=[servers[0].address])
+    servers[0].close()
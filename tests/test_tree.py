@@ -0,0 +1,56 @@
+"""Test kipoi_utils.tree
+"""
+import numpy as np
+import pytest
+from collections import OrderedDict
+from kipoi_utils.tree import (tree_flatten, tree_unflatten, tree_map, tree_map_many,
+                              tree_iter_leaves)
+
+
+def test_flatten_unflatten():
+    tree = {"a": [1, (2, "str")], "b": {"c": np.arange(3), "d": []}}
+    leaves, treedef = tree_flatten(tree)
+    assert leaves[:3] == [1, 2, "str"]
+    assert treedef.num_leaves == 4
+    out = tree_unflatten(treedef, leaves)
+    assert out["a"] == [1, [2, "str"]]
+    assert out["b"]["d"] == []
+
+    # same structure -> equal treedefs
+    assert tree_flatten({"a": [5, (6, 7)], "b": {"c": 1, "d": []}})[1] == treedef
+    assert tree_flatten({"a": [5, 6], "b": {"c": 1, "d": []}})[1] != treedef
+
+    with pytest.raises(ValueError):
+        treedef.unflatten([1, 2])
+
+    assert tree_unflatten(*reversed(tree_flatten(1))) == 1
+
+
+def test_flatten_up_to():
+    _, treedef = tree_flatten({"a": [1, 2], "b": 3})
+    assert treedef.flatten_up_to({"a": [4, 5], "b": 6}) == [4, 5, 6]
+    for bad in [{"a": [4, 5], "b": 6, "c": 7},
+                {"a": [4], "b": 6},
+                {"a": [4, 5], "b": [6]}]:
+        with pytest.raises(ValueError):
+            treedef.flatten_up_to(bad)
+    # extra keys are ignored in the non-strict mode
+    assert treedef.flatten_up_to({"a": [4, 5], "b": 6, "c": 7}, strict=False) == [4, 5, 6]
+
+
+def test_tree_map():
+    tree = OrderedDict([("a", 1), ("b", [2, {"c": 3}])])
+    assert tree_map(lambda x: x + 1, tree) == {"a": 2, "b": [3, {"c": 4}]}
+    out = tree_map(lambda x: x, tree, mapping_type=OrderedDict)
+    assert isinstance(out, OrderedDict) and isinstance(out["b"][1], OrderedDict)
+    # custom leaves
+    assert tree_map(lambda x: x if x == 1 else len(x), tree,
+                    is_leaf=lambda x: isinstance(x, list)) == {"a": 1, "b": 2}
+
+    batches = [{"a": i, "b": [i, i]} for i in range(3)] + [{"a": 1}]
+    assert list(tree_map_many(lambda x: -x, batches)) == \
+        [{"a": 0, "b": [0, 0]}, {"a": -1, "b": [-1, -1]}, {"a": -2, "b": [-2, -2]}, {"a": -1}]
+
+
+def test_tree_iter_leaves():
+    assert list(tree_iter_leaves({"a": [1, [2]], "b": [], "c": "ab"})) == [1, 2, "ab"]
@@ -0,0 +1,68 @@
+"""Test compare_numpy_dict and diff_numpy_dict
+"""
+from collections import OrderedDict
+import numpy as np
+import pytest
+from kipoi_utils.utils import compare_numpy_dict, diff_numpy_dict
+
+
+def test_compare_numpy_dict():
+    a = {"a": np.arange(10), "b": [np.ones((3, 4)), None], "c": OrderedDict([("d", 1.0)])}
+    b = {"a": np.arange(10), "b": [np.ones((3, 4)), None], "c": OrderedDict([("d", 1.0)])}
+    assert compare_numpy_dict(a, b)
+    b["b"][0] = b["b"][0] + 1e-9
+    assert not compare_numpy_dict(a, b)
+    # tolerance is forwarded at every depth
+    assert compare_numpy_dict(a, b, exact=False)
+    assert not compare_numpy_dict(a, b, exact=False, decimal=10)
+    assert compare_numpy_dict(a, b, rtol=1e-6)
+
+    assert not compare_numpy_dict({"a": 1}, {"b": 1})
+    assert not compare_numpy_dict([1, 2], [1, 2, 3])
+    assert not compare_numpy_dict([1], (1,))
+    assert not compare_numpy_dict(np.zeros(3), np.zeros(4))
+
+
+def test_compare_nan():
+    a = {"x": np.array([1.0, np.nan, np.inf])}
+    b = {"x": np.array([1.0, np.nan, np.inf])}
+    assert not compare_numpy_dict(a, b)
+    assert compare_numpy_dict(a, b, equal_nan=True)
+    assert compare_numpy_dict(a, b, exact=False)
+    b["x"][2] = -np.inf
+    assert not compare_numpy_dict(a, b, equal_nan=True)
+
+
+def test_diff_report():
+    a = {"x": [np.zeros((100, 10)), np.arange(5)], "y": {"z": np.ones(4)}, "w": 1}
+    b = {"x": [np.zeros((100, 10)), np.arange(5)], "y": {"z": np.ones(4)}, "v": 1}
+    b["x"][0][10, :3] = [1, 2, 3]
+    b["y"]["z"][0] = 2
+    report = diff_numpy_dict(a, b, chunk_size=64)
+    assert not report
+    assert report.complete
+    diffs = dict([(d.path, d) for d in report.diffs])
+    assert set(diffs) == {(), ("x", 0), ("y", "z")}
+    assert diffs[()].reason == "keys"
+    assert diffs[("x", 0)].n_mismatch == 3
+    assert diffs[("x", 0)].n_total == 1000
+    assert diffs[("x", 0)].max_abs_err == 3
+    assert diffs[("y", "z")].max_rel_err == pytest.approx(0.5)
+    assert "x/0" in str(report)
+
+    report = diff_numpy_dict(a, b, stop_early=True)
+    assert len(report.diffs) == 1
+    assert not report.complete
+
+
+def test_diff_memmap(tmpdir):
+    shape = (1000, 7)
+    a = np.lib.format.open_memmap(str(tmpdir.join("a.npy")), mode="w+", dtype=np.float32,
+                                  shape=shape)
+    a[:] = np.random.RandomState(0).randn(*shape)
+    b = np.array(a)
+    b[999, 6] += 1e-3
+    report = diff_numpy_dict({"a": a}, {"a": b}, chunk_size=100)
+    assert report.diffs[0].n_mismatch == 1
+    assert diff_numpy_dict({"a": a[:, :6]}, {"a": b[:, :6]}, chunk_size=100)
+    assert diff_numpy_dict({"a": a}, {"a": b}, atol=1e-2)
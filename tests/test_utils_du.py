@@ -0,0 +1,92 @@
+import os
+import time
+import pytest
+from kipoi_utils.utils import du, disk_usage, format_size, clear_du_cache
+
+
+def write(path, nbytes):
+    with open(path, "wb") as f:
+        f.write(b"x" * nbytes)
+
+
+@pytest.fixture
+def tree(tmpdir):
+    root = tmpdir.mkdir("root")
+    write(str(root.join("a")), 1000)
+    for d in ["d1", "d2"]:
+        sub = root.mkdir(d)
+        write(str(sub.join("b")), 2000)
+        write(str(sub.mkdir("nested").join("c")), 3000)
+    return str(root)
+
+
+def test_format_size():
+    assert format_size(0) == "0"
+    assert format_size(1023) == "1023"
+    assert format_size(1024) == "1.0K"
+    assert format_size(1025) == "1.1K"
+    assert format_size(10 * 1024 - 1) == "10K"
+    assert format_size(1024 * 1024 - 1) == "1.0M"
+    assert format_size(int(2.05 * 1024 ** 3)) == "2.1G"
+
+
+def test_disk_usage(tree):
+    files = 1000 + 2 * (2000 + 3000)
+    dirs = dir_sizes(tree)
+    assert disk_usage(tree, apparent_size=True, cache=False) == files + dirs
+    assert disk_usage(tree, apparent_size=True, n_jobs=2, cache=False) == files + dirs
+    assert disk_usage(os.path.join(tree, "a"), apparent_size=True) == 1000
+    assert disk_usage(tree, n_jobs=2, cache=True) == disk_usage(tree)
+    assert du(tree) == format_size(disk_usage(tree))
+    assert du(os.path.join(tree, "does_not_exist")) == "NA"
+
+
+def dir_sizes(root):
+    return sum([os.lstat(os.path.join(r, d)).st_size
+                for r, ds, _ in os.walk(root) for d in ds]) + os.lstat(root).st_size
+
+
+def test_disk_usage_hardlinks(tree):
+    if not hasattr(os, "link"):
+        pytest.skip("hardlinks not supported")
+    os.link(os.path.join(tree, "a"), os.path.join(tree, "d1", "a_link"))
+    os.link(os.path.join(tree, "a"), os.path.join(tree, "d2", "a_link"))
+    # hardlinked files are counted once
+    expected = 1000 + 2 * (2000 + 3000) + dir_sizes(tree)
+    assert disk_usage(tree, apparent_size=True, cache=False) == expected
+    assert disk_usage(tree, apparent_size=True, n_jobs=2, cache=False) == expected
+
+
+def test_disk_usage_cache(tree):
+    clear_du_cache()
+    # make the mtimes conclusive
+    past = time.time() - 10
+    for r, ds, _ in os.walk(tree):
+        for d in ds:
+            os.utime(os.path.join(r, d), (past, past))
+    os.utime(tree, (past, past))
+    size = disk_usage(tree, apparent_size=True, cache=True)
+
+    # the content of an unchanged directory is not re-scanned
+    write(os.path.join(tree, "d1", "b"), 5000)
+    os.utime(os.path.join(tree, "d1"), (past, past))
+    assert disk_usage(tree, apparent_size=True, cache=True) == size
+
+    # new file -> directory mtime changes
+    write(os.path.join(tree, "d1", "new"), 100)
+    assert disk_usage(tree, apparent_size=True, cache=True) == disk_usage(tree, apparent_size=True)
+    clear_du_cache()
+    assert disk_usage(tree, apparent_size=True, cache=True) == disk_usage(tree, apparent_size=True)
+
+
+def test_du_no_cache_by_default(tree):
+    clear_du_cache()
+    past = time.time() - 10
+    os.utime(os.path.join(tree, "d1"), (past, past))
+    du(tree, cache=True)
+    size = disk_usage(tree, apparent_size=True)
+    # modified file content doesn't change the directory mtime
+    write(os.path.join(tree, "d1", "b"), 5000)
+    os.utime(os.path.join(tree, "d1"), (past, past))
+    assert disk_usage(tree, apparent_size=True) == size + 3000
+    assert du(tree) == format_size(disk_usage(tree))
@@ -4,7 +4,8 @@ import numpy as np
 from collections import OrderedDict
 import kipoi_utils
 from kipoi_utils.utils import take_first_nested, map_nested
-from kipoi_utils.external.flatten_json import flatten, flatten_ordered, unflatten_list
+from kipoi_utils.tree import tree_leaves
+from kipoi_utils.external.flatten_json import flatten, flatten_ordered, unflatten_list, flatten_records
 from pytest import fixture
 
 
@@ -90,3 +91,84 @@ def test_compare_numpy_dict():
             "b": [np.arange(4)]}
     assert kipoi_utils.utils.compare_numpy_dict(obj1, obj2)
     assert not kipoi_utils.utils.compare_numpy_dict(obj1, obj3)
+
+
+def test_flatten_deep():
+    # deeper than the default recursion limit
+    depth = 5000
+    dd = 1
+    for i in range(depth):
+        dd = {"a": dd}
+    assert flatten(dd) == {"_".join(["a"] * depth): 1}
+    assert list(flatten_ordered(dd).values()) == [1]
+
+
+def test_flatten_prefix_separator(nested_dict):
+    fd = flatten_ordered(nested_dict, separator="/", prefix="p")
+    assert list(fd) == ['p/a', 'p/b/c', 'p/b/d/0', 'p/b/d/1', 'p/b/d/2',
+                        'p/b/e/0/f', 'p/b/e/1/g']
+    assert flatten(nested_dict, separator="/", prefix="p") == dict(fd)
+    # leaves at the root
+    assert flatten(1, prefix="p") == {"p": 1}
+    # empty containers
+    assert flatten({"a": {}, "b": []}) == {}
+    assert flatten_ordered({}) == {}
+
+
+def test_unflatten_list():
+    assert unflatten_list({"a_0_0": 1, "a_0_1": 2, "a_1_0": 3}) == {"a": [[1, 2], [3]]}
+    # not list-shaped: missing index, leading zeros, non-integer keys
+    assert unflatten_list({"a_1": 1}) == {"a": {"1": 1}}
+    assert unflatten_list({"a_01": 1, "a_0": 2}) == {"a": {"01": 1, "0": 2}}
+    assert unflatten_list({"a_0": 1, "a_b": 2}) == {"a": {"0": 1, "b": 2}}
+    # the root stays a dictionary
+    assert unflatten_list({"0": 1}) == {"0": 1}
+    # empty dictionaries are not lists
+    assert unflatten_list({"a": {}}) == {"a": {}}
+    assert unflatten_list({"a_b": 1, "c": {}}) == {"a": {"b": 1}, "c": {}}
+
+    dd = {"a": [{"b": list(range(12))}, [{"c": 1}, 2]]}
+    assert unflatten_list(flatten(dd)) == dd
+    assert unflatten_list(flatten(dd, separator="/"), separator="/") == dd
+
+
+def test_flatten_records(nested_dict):
+    records = [nested_dict, nested_dict]
+    cols = flatten_records(records)
+    assert list(cols) == list(flatten_ordered(nested_dict))
+    assert cols["b_d_1"] == [2, 2]
+
+    # missing and extra keys
+    cols = flatten_records([{"a": 1, "b": {"c": 2}},
+                            {"a": 3},
+                            {"a": 4, "b": {"c": 5, "d": 6}},
+                            {"a": 7, "b": {"c": 8}}], fill_value=-1)
+    assert dict(cols) == {"a": [1, 3, 4, 7],
+                          "b_c": [2, -1, 5, 8],
+                          "b_d": [-1, -1, 6, -1]}
+
+    cols = flatten_records([{"a": np.arange(2)}, {"a": np.arange(2)}],
+                           is_list_fn=lambda x: isinstance(x, np.ndarray),
+                           to_numpy=True)
+    assert np.all(cols["a_1"] == np.array([1, 1]))
+    assert len(flatten_records([])) == 0
+
+
+def test_map_nested_parallel(nested_dict2):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from kipoi_utils.utils import map_nested_parallel
+
+    # small structures are mapped serially in the calling thread
+    main_thread = threading.current_thread().ident
+    out = map_nested_parallel(nested_dict2, lambda x: threading.current_thread().ident)
+    assert set(tree_leaves(out)) == {main_thread}
+
+    big = {"a": [np.arange(10) + i for i in range(20)], "b": {"c": np.ones(5)}}
+    expected = map_nested(big, lambda x: x * 2)
+    for kwargs in [dict(min_nbytes=0), dict(min_nbytes=0, n_jobs=3)]:
+        out = map_nested_parallel(big, lambda x: x * 2, **kwargs)
+        assert all([np.all(x == y) for x, y in zip(tree_leaves(out), tree_leaves(expected))])
+    with ThreadPoolExecutor(2) as executor:
+        out = map_nested_parallel(big, lambda x: x * 2, executor=executor, min_nbytes=0)
+    assert np.all(out["a"][19] == expected["a"][19])
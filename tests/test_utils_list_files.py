@@ -1,6 +1,8 @@
 """Test 
 """
 import os
+import time
+import pytest
 from kipoi_utils.utils import list_files_recursively
 
 
@@ -31,3 +33,66 @@ def test_list_files_recursively():
     assert a[0] != a[2]
     assert all([x.endswith("model.foobar") for x in a])
     assert all([os.path.exists(os.path.join("tests", x)) for x in a])
+
+
+def test_list_files_recursively_skip():
+    assert list_files_recursively("tests", 'model', suffix='foobar', skip=["foo"]) == \
+        ['test_foo/bar/model.foobar', 'test_foo/foobar/model.foobar']
+    assert list_files_recursively("tests", 'model', suffix='foobar', skip=["test_foo/bar"]) == \
+        ['test_foo/foo/bar/model.foobar', 'test_foo/foobar/model.foobar']
+    assert list_files_recursively("tests", 'model', suffix='foobar', n_jobs=4) == \
+        list_files_recursively("tests", 'model', suffix='foobar')
+
+
+def test_list_files_recursively_index(tmpdir):
+    root = tmpdir.mkdir("root")
+    root.mkdir("a").mkdir("b").join("model.yaml").write("")
+    root.mkdir(".git").join("model.yaml").write("")
+    index_path = str(tmpdir.join("index.json"))
+
+    assert list_files_recursively(str(root), 'model', index_path=index_path) == \
+        [os.path.join('a', 'b', 'model.yaml')]
+    assert os.path.exists(index_path)
+    assert list_files_recursively(str(root), 'model', index_path=index_path) == \
+        [os.path.join('a', 'b', 'model.yaml')]
+
+    # new files are found
+    root.join("a").join("model.yaml").write("")
+    assert list_files_recursively(str(root), 'model', index_path=index_path) == \
+        [os.path.join('a', 'b', 'model.yaml'), os.path.join("a", "model.yaml")]
+    # the index is not used for different queries
+    assert list_files_recursively(str(root), 'model', skip=['b'], index_path=index_path) == \
+        [os.path.join("a", "model.yaml")]
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_list_files_recursively_index_reuse(tmpdir, monkeypatch, n_jobs):
+    from kipoi_utils import utils
+    root = tmpdir.mkdir("root")
+    root.mkdir("a").mkdir("b").join("model.yaml").write("")
+    root.mkdir("c").join("model.yaml").write("")
+    # make the directory mtimes conclusive
+    past = time.time() - 10
+    for r, ds, _ in os.walk(str(root)):
+        for d in ds:
+            os.utime(os.path.join(r, d), (past, past))
+    os.utime(str(root), (past, past))
+    index_path = str(tmpdir.join("index.json"))
+    expected = [os.path.join('a', 'b', 'model.yaml'), os.path.join('c', 'model.yaml')]
+    assert list_files_recursively(str(root), 'model', n_jobs=n_jobs,
+                                  index_path=index_path) == expected
+
+    scanned = []
+    scan_dir = utils._scan_dir
+    monkeypatch.setattr(utils, "_scan_dir", lambda path: scanned.append(path) or scan_dir(path))
+    # nothing is scanned again
+    assert list_files_recursively(str(root), 'model', n_jobs=n_jobs,
+                                  index_path=index_path) == expected
+    assert scanned == []
+
+    # only the modified directory is scanned
+    root.join("a").join("model.yaml").write("")
+    assert list_files_recursively(str(root), 'model', n_jobs=n_jobs, index_path=index_path) == \
+        [os.path.join('a', 'b', 'model.yaml'), os.path.join('a', 'model.yaml'),
+         os.path.join('c', 'model.yaml')]
+    assert scanned == [os.path.join(str(root), 'a')]
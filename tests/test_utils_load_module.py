@@ -1,8 +1,10 @@
 """Test load module
 """
 import kipoi_utils
-from kipoi_utils.utils import load_obj, inherits_from, override_default_kwargs, infer_parent_class, cd, default_kwargs
+from kipoi_utils.utils import load_obj, inherits_from, override_default_kwargs, infer_parent_class, cd, default_kwargs, getargs
 # %from kipoi_utils.data import BaseDataLoader, Dataset, AVAILABLE_DATALOADERS
+import gc
+import weakref
 import pytest
 
 from collections import OrderedDict
@@ -117,6 +119,80 @@ def test_override_default_args():
         override_default_kwargs(A, dict(c=4))
 
 
+def test_introspection_cache():
+    def fn(a, b=2):
+        return a, b
+    assert getargs(fn) == {"a", "b"}
+    getargs(fn).add("c")
+    assert getargs(fn) == {"a", "b"}
+
+    # changed defaults or code are picked up
+    fn.__defaults__ = (3,)
+    assert default_kwargs(fn) == {"b": 3}
+
+    def other(x, y=1):
+        return x, y
+    fn.__code__ = other.__code__
+    assert getargs(fn) == {"x", "y"}
+    assert default_kwargs(fn) == {"y": 3}
+
+    # only weak references are kept
+    ref = weakref.ref(fn)
+    del fn
+    gc.collect()
+    assert ref() is None
+
+
+def test_introspection_cache_class_gc():
+    class Base(object):
+        def __init__(self, a, b=2):
+            pass
+
+    class A(Base):
+        def __init__(self, a, b=3):
+            super(A, self).__init__(a, b)
+    assert getargs(A) == {"a", "b"}
+    assert default_kwargs(A) == {"b": 3}
+    assert override_default_kwargs(A, {"b": 4}) is override_default_kwargs(A, {"b": 4})
+
+    # replaced __init__ is picked up
+    def __init__(self, x, y=1):
+        pass
+    A.__init__ = __init__
+    assert getargs(A) == {"x", "y"}
+
+    # neither the cache nor the tokens keep the class alive
+    ref = weakref.ref(A)
+    del A, __init__
+    gc.collect()
+    assert ref() is None
+
+
+def test_override_default_kwargs_cache():
+    class A(object):
+        def __init__(self, a, b=2):
+            self.a = a
+            self.b = b
+
+    B = override_default_kwargs(A, dict(b=4))
+    assert override_default_kwargs(A, dict(b=4)) is B
+    assert override_default_kwargs(A, dict(b=5)) is not B
+    assert override_default_kwargs(A, dict(b=4.0)) is not B
+    # unhashable values
+    C = override_default_kwargs(A, dict(b=[1]))
+    assert C(1).b == [1]
+    assert override_default_kwargs(A, dict(b=[1])) is not C
+
+    # changed original defaults
+    def fn(a, b=2, c=3):
+        return a, b, c
+    fn2 = override_default_kwargs(fn, dict(b=4))
+    fn.__defaults__ = (5, 6)
+    fn3 = override_default_kwargs(fn, dict(b=4))
+    assert fn3 is not fn2
+    assert fn3(1) == (1, 4, 6)
+
+
 def test_load_obj():
     with pytest.raises(ImportError):
         load_obj("asd.dsa")
@@ -134,3 +210,59 @@ def test_sequential_model_loading():
         next(m2.default_dataloader.init_example().batch_iter())
     with cd(m1.source_dir):
         next(m1.default_dataloader.init_example().batch_iter())
+
+
+def test_load_module_cache(tmpdir):
+    from kipoi_utils.utils import load_module, clear_module_cache
+    path = str(tmpdir.join("mymodule.py"))
+    with open(path, "w") as f:
+        f.write("import random\nx = 1\nTOKEN = random.random()\n")
+
+    m1 = load_module(path, cache=True)
+    m2 = load_module(path, cache=True)
+    assert m1 is m2
+    # no caching by default
+    assert load_module(path).TOKEN != m1.TOKEN
+
+    # the same module name from a different file
+    path2 = str(tmpdir.mkdir("other").join("mymodule.py"))
+    with open(path2, "w") as f:
+        f.write("x = 2\n")
+    assert load_module(path2, cache=True).x == 2
+    assert load_module(path, cache=True) is m1
+
+    # changes invalidate the entry
+    with open(path, "w") as f:
+        f.write("x = 3\n")
+    m3 = load_module(path, cache=True)
+    assert m3 is not m1
+    assert m3.x == 3
+
+    clear_module_cache()
+    assert load_module(path, cache=True) is not m3
+
+
+def test_load_obj_cache(tmpdir):
+    with cd(str(tmpdir)):
+        with open("my_dl_module.py", "w") as f:
+            f.write("import random\nclass A(object):\n    pass\n")
+        A = load_obj("my_dl_module.A", cache=True)
+        assert load_obj("my_dl_module.A", cache=True) is A
+        assert load_obj("my_dl_module.A") is not A
+
+
+def test_load_obj_cache_pickle(tmpdir):
+    import pickle
+    import sys
+    try:
+        with cd(str(tmpdir)):
+            with open("my_pickled_module.py", "w") as f:
+                f.write("class A(object):\n    pass\n")
+            A = load_obj("my_pickled_module.A", cache=True)
+            assert sys.modules["my_pickled_module"].A is A
+            assert type(pickle.loads(pickle.dumps(A()))) is A
+            # cache hit
+            assert load_obj("my_pickled_module.A", cache=True) is A
+            assert type(pickle.loads(pickle.dumps(A()))) is A
+    finally:
+        sys.modules.pop("my_pickled_module", None)
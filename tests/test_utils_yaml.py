@@ -0,0 +1,162 @@
+"""Test yaml loading
+"""
+import os
+from collections import OrderedDict
+import pytest
+import related
+from kipoi_utils.utils import (read_yaml, yaml_ordered_load, yaml_ordered_dump,
+                               yaml_ordered_dump_all, clear_yaml_cache, parse_json_file_str)
+from kipoi_utils.external.related.mixins import RelatedLoadSaveMixin
+
+
+def test_read_yaml_cache(tmpdir):
+    path = str(tmpdir.join("model.yaml"))
+    with open(path, "w") as f:
+        f.write("a: 1\nb: [1, 2]\n")
+    clear_yaml_cache()
+    d = read_yaml(path)
+    assert d == {"a": 1, "b": [1, 2]}
+    # results are copies
+    d["b"].append(3)
+    assert read_yaml(path) == {"a": 1, "b": [1, 2]}
+    assert parse_json_file_str(path) == {"a": 1, "b": [1, 2]}
+
+    # changes invalidate the cache
+    with open(path, "w") as f:
+        f.write("a: 2\nb: [1, 2]\n")
+    assert read_yaml(path)["a"] == 2
+    assert read_yaml(path, cache=False)["a"] == 2
+
+
+def test_yaml_ordered_load():
+    keys = ["z", "a", "m", "b"]
+    d = yaml_ordered_load("\n".join(["{}: {}".format(k, i) for i, k in enumerate(keys)]))
+    assert isinstance(d, OrderedDict)
+    assert list(d) == keys
+    assert list(yaml_ordered_load(yaml_ordered_dump(d))) == keys
+
+
+@related.immutable(strict=False)
+class MyConfig(RelatedLoadSaveMixin):
+    name = related.StringField()
+    args = related.ChildField(dict, default=OrderedDict(), required=False)
+    path = related.StringField(required=False)
+
+
+def test_related_load(tmpdir):
+    path = str(tmpdir.join("config.yaml"))
+    with open(path, "w") as f:
+        f.write("name: foo\nargs:\n  x: 1\n")
+    c = MyConfig.load(path)
+    assert c.name == "foo"
+    assert c.args == {"x": 1}
+    assert c.path == path
+    # loading again doesn't see the modifications of the previous load
+    assert MyConfig.load(path, append_path=False).path is None
+    assert MyConfig.from_string("name: bar").name == "bar"
+
+
+@pytest.mark.parametrize("n_jobs,use_processes", [(1, True), (2, True), (2, False)])
+def test_related_load_many(tmpdir, n_jobs, use_processes):
+    paths = []
+    for i in range(6):
+        path = str(tmpdir.join("config{0}.yaml".format(i)))
+        with open(path, "w") as f:
+            f.write("name: foo{0}\n".format(i) if i != 3 else "args: [1, 2\n")
+        paths.append(path)
+    res = MyConfig.load_many(paths, n_jobs=n_jobs, use_processes=use_processes)
+    assert list(res.models) == [p for i, p in enumerate(paths) if i != 3]
+    assert res.models[paths[5]].name == "foo5"
+    assert res.models[paths[5]].path == paths[5]
+    assert list(res.errors) == [paths[3]]
+    assert res.stats["n_files"] == 6
+    assert res.stats["n_loaded"] == 5
+    assert res.stats["n_failed"] == 1
+    assert res.stats["slowest_path"] in paths
+    assert res.stats["wall_time"] > 0
+
+
+def test_related_load_snapshot(tmpdir, monkeypatch):
+    from kipoi_utils.external.related import mixins
+    path = str(tmpdir.join("config.yaml"))
+    snapshot_dir = str(tmpdir.join("snapshots"))
+    with open(path, "w") as f:
+        f.write("name: foo\nargs:\n  x: 1\n")
+    c = MyConfig.load(path, snapshot_dir=snapshot_dir)
+    assert len(os.listdir(snapshot_dir)) == 1
+
+    # warm load doesn't parse the file
+    def fail(*args, **kwargs):
+        raise AssertionError("file parsed")
+    monkeypatch.setattr(mixins, "load_yaml_file", fail)
+    c2 = MyConfig.load(path, snapshot_dir=snapshot_dir)
+    assert c2 == c
+    assert c2 is not c
+    monkeypatch.undo()
+
+    # changed file invalidates the snapshot
+    with open(path, "w") as f:
+        f.write("name: bar\n")
+    assert MyConfig.load(path, snapshot_dir=snapshot_dir).name == "bar"
+    assert len(os.listdir(snapshot_dir)) == 2
+
+    # changed class definition
+    monkeypatch.setitem(mixins._CLASS_FINGERPRINTS, MyConfig, "changed")
+    assert MyConfig.load(path, snapshot_dir=snapshot_dir).name == "bar"
+    assert len(os.listdir(snapshot_dir)) == 3
+
+
+def test_related_fingerprint_nested(tmpdir, monkeypatch):
+    import importlib
+    from kipoi_utils.external.related import mixins
+    child_path = str(tmpdir.join("snapshot_child_module.py"))
+    with open(child_path, "w") as f:
+        f.write("import related\n\n@related.immutable\nclass Child(object):\n"
+                "    x = related.IntegerField()\n")
+    monkeypatch.syspath_prepend(str(tmpdir))
+    child_module = importlib.import_module("snapshot_child_module")
+
+    @related.immutable
+    class Parent(RelatedLoadSaveMixin):
+        children = related.SequenceField(child_module.Child)
+
+    assert child_module.Child in mixins._related_classes(Parent)
+    fingerprint = mixins._class_fingerprint(Parent)
+    assert fingerprint is not None
+    # modified nested class
+    with open(child_path, "a") as f:
+        f.write("    y = related.IntegerField(required=False)\n")
+    mixins._CLASS_FINGERPRINTS.clear()
+    assert mixins._class_fingerprint(Parent) != fingerprint
+
+    # no snapshot without the converters source
+    mixins._CLASS_FINGERPRINTS.clear()
+    monkeypatch.setattr(mixins, "_source_digest", lambda obj: None)
+    assert mixins._class_fingerprint(Parent) is None
+
+
+def test_yaml_ordered_dump():
+    import yaml
+    data = OrderedDict([("b", 1), ("a", [OrderedDict([("d", None), ("c", "x: y")])])])
+    out = yaml_ordered_dump(data, default_flow_style=False)
+    assert out == "b: 1\na:\n- d: null\n  c: 'x: y'\n"
+    assert out == yaml_ordered_dump(data, Dumper=yaml.Dumper, default_flow_style=False)
+    assert yaml_ordered_dump(None) == yaml.dump(None)
+    assert list(yaml.safe_load_all(yaml_ordered_dump_all(iter([data, [1, 2]])))) == [
+        {"b": 1, "a": [{"d": None, "c": "x: y"}]}, [1, 2]]
+
+
+def test_related_dump(tmpdir):
+    import yaml
+    from kipoi_utils.external.related.mixins import dump_yaml_all
+    c = MyConfig(name="foo", args=OrderedDict([("y", 1), ("x", 2)]))
+    out = c.get_config_as_yaml()
+    assert out == related.to_yaml(c, suppress_empty_values=True, suppress_map_key_values=True)
+    path = str(tmpdir.join("c.yaml"))
+    c.dump(path)
+    assert MyConfig.load(path, append_path=False) == c
+
+    path = str(tmpdir.join("all.yaml"))
+    dump_yaml_all((MyConfig(name=str(i)) for i in range(3)), path)
+    with open(path) as f:
+        assert [d["name"] for d in yaml.safe_load_all(f)] == ["0", "1", "2"]